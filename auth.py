@@ -2,7 +2,27 @@
 class NoAuthRequired:
     method_code = 0 
 
-acceptable_auth_methods = [NoAuthRequired]
+class OptimisticData:
+    """Private method: no authentication, and the client sends its CONNECT
+    request and first payload right behind the greeting without waiting
+    for method selection. Server answers greeting and request together."""
+    method_code = 0x80
+
+class Multiplex:
+    """Private method of asocks nodes: the connection carries a session
+    of multiplexed streams, see server.mux, each stream opening with a
+    SOCKS5 handshake of its own."""
+    method_code = 0x81
+
+class UsernamePassword:
+    """RFC 1929 username/password authentication, the only method
+    accepted once the server is given credentials."""
+    method_code = 0x02
+    version = 1
+    SUCCEEDED = 0
+    FAILED = 1
+
+acceptable_auth_methods = [NoAuthRequired, OptimisticData]
 acceptable_auth_method_codes = [method.method_code for method in acceptable_auth_methods]
 
     
@@ -0,0 +1,114 @@
+#! /usr/bin/env python3
+"""Measure heap bytes the server holds per idle tunnel.
+
+Runs the proxy inside this process with tracemalloc enabled, while the
+clients and the upstream they tunnel to live in a child process, so every
+allocation traced here belongs to the proxy:
+
+  python3 bench/idle_memory.py --tunnels 5000
+  python3 bench/idle_memory.py --tunnels 2000 --relay splice
+"""
+import os
+import sys
+import gc
+import asyncio
+import argparse
+import functools
+import subprocess
+import tracemalloc
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from server.server_protocol import ServerClientProtocol, RELAY_ENGINES
+from server.resolver import Resolver
+from server.timers import TimerWheel
+from server.scheduling import RelayScheduler
+
+# Opens tunnels through the proxy to its own upstream, holds them open
+# until a line is read from stdin.
+CLIENTS = r'''
+import sys, socket, struct
+upstream = socket.socket()
+upstream.bind(('127.0.0.1', 0))
+upstream.listen(4096)
+proxy_port, tunnels = map(int, sys.stdin.readline().split())
+request = (b'\x05\x01\x00\x05\x01\x00\x01\x7f\x00\x00\x01' +
+           struct.pack('>H', upstream.getsockname()[1]))
+held = []
+for _ in range(tunnels):
+    sock = socket.create_connection(('127.0.0.1', proxy_port))
+    sock.sendall(request)
+    replied = b''
+    while len(replied) < 9:
+        replied += sock.recv(9 - len(replied))
+    held.append(sock)
+    held.append(upstream.accept()[0])
+print('ready', flush=True)
+sys.stdin.readline()
+'''
+
+@asyncio.coroutine
+def measure(loop, tunnels, relay_engine):
+    timers = TimerWheel(loop)
+    # Built like server/__main__.py does for the fair engine.
+    scheduler = None
+    if relay_engine == 'fair':
+        scheduler = RelayScheduler(loop)
+    server = yield from loop.create_server(
+        functools.partial(ServerClientProtocol, relay_engine=relay_engine,
+                          resolver=Resolver(loop), timers=timers,
+                          scheduler=scheduler),
+        '127.0.0.1', 0, backlog=4096)
+    proxy_port = server.sockets[0].getsockname()[1]
+    clients = subprocess.Popen(
+        [sys.executable, '-c', CLIENTS], stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE, universal_newlines=True)
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    clients.stdin.write('{} {}\n'.format(proxy_port, tunnels))
+    clients.stdin.flush()
+    yield from loop.run_in_executor(None, clients.stdout.readline)
+    # Let the last handshakes complete.
+    yield from asyncio.sleep(0.5)
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    clients.stdin.write('\n')
+    clients.stdin.flush()
+    clients.wait()
+    server.close()
+    yield from server.wait_closed()
+    timers.close()
+    if scheduler is not None:
+        scheduler.close()
+
+    stats = after.compare_to(before, 'filename')
+    return (sum(stat.size_diff for stat in stats) // tunnels,
+            [(stat.traceback[0].filename, stat.size_diff // tunnels)
+             for stat in stats[:8]])
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description='Measure heap bytes per idle tunnel of the server.')
+    arg_parser.add_argument('--tunnels', type=int, default=2000,
+        help='idle tunnels opened. Default to 2000')
+    arg_parser.add_argument('--relay', choices=RELAY_ENGINES,
+        default='protocol', help='relay engine. Default to protocol')
+    args = arg_parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    per_tunnel, top = loop.run_until_complete(
+        measure(loop, args.tunnels, args.relay))
+    loop.close()
+
+    print('{} bytes per idle tunnel ({} relay, {} tunnels)'.format(
+        per_tunnel, args.relay, args.tunnels))
+    for filename, size in top:
+        print('  {:>6}  {}'.format(size, os.path.relpath(filename)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+#! /usr/bin/env python3
+"""Load test of the asocks server against local upstreams on loopback.
+
+Starts the server as a subprocess, plus an echo upstream and a bulk
+source upstream inside this process, then measures:
+
+  * connections/sec and handshake latency (p50/p99) of short tunnels
+  * bulk download throughput through the proxy in MB/s
+  * server RSS per 1k idle tunnels
+
+Results are written as JSON so runs on different commits can be compared:
+
+  python3 bench/socks_bench.py --output before.json
+  python3 bench/socks_bench.py --output after.json -- --relay splice
+
+Arguments after '--' are passed on to the server.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import struct
+import asyncio
+import argparse
+import resource
+import platform
+import subprocess
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BULK_CHUNK = b'\x00' * (256 * 1024)
+
+def percentile(values, pct):
+    """Return the pct percentile of values, None when there are none."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[idx]
+
+def _milliseconds(seconds):
+    # No successful handshake leaves no latency, reported as null.
+    return None if seconds is None else seconds * 1000
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def rss_bytes(pid):
+    with open('/proc/{}/status'.format(pid)) as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+@asyncio.coroutine
+def echo_upstream(reader, writer):
+    while True:
+        data = yield from reader.read(65536)
+        if not data:
+            break
+        writer.write(data)
+        yield from writer.drain()
+    writer.close()
+
+@asyncio.coroutine
+def source_upstream(reader, writer):
+    """Send the number of bytes requested by an 8 byte big-endian count."""
+    request = yield from reader.readexactly(8)
+    remaining = struct.unpack('>Q', request)[0]
+    while remaining:
+        chunk = BULK_CHUNK[:remaining]
+        writer.write(chunk)
+        remaining -= len(chunk)
+        yield from writer.drain()
+    writer.close()
+
+@asyncio.coroutine
+def open_tunnel(proxy_port, dest_port):
+    """Handshake with the proxy, returning (reader, writer, seconds)."""
+    started = time.perf_counter()
+    reader, writer = yield from asyncio.open_connection('127.0.0.1', proxy_port)
+    writer.write(b'\x05\x01\x00' +
+                 b'\x05\x01\x00\x01' + socket.inet_aton('127.0.0.1') +
+                 struct.pack('>H', dest_port))
+    selection = yield from reader.readexactly(2)
+    reply = yield from reader.readexactly(4)
+    if selection != b'\x05\x00' or reply[1] != 0:
+        writer.close()
+        raise ConnectionError('proxy replied {!r}'.format(selection + reply))
+    if reply[3] == 1:
+        yield from reader.readexactly(4 + 2)
+    elif reply[3] == 4:
+        yield from reader.readexactly(16 + 2)
+    else:
+        length = yield from reader.readexactly(1)
+        yield from reader.readexactly(length[0] + 2)
+    return reader, writer, time.perf_counter() - started
+
+@asyncio.coroutine
+def bench_connections(proxy_port, echo_port, concurrency, duration):
+    latencies = []
+    failures = [0]
+    deadline = time.perf_counter() + duration
+
+    @asyncio.coroutine
+    def client():
+        while time.perf_counter() < deadline:
+            try:
+                reader, writer, elapsed = yield from open_tunnel(
+                    proxy_port, echo_port)
+                writer.write(b'ping')
+                yield from reader.readexactly(4)
+                writer.close()
+            except (OSError, asyncio.IncompleteReadError):
+                failures[0] += 1
+                continue
+            latencies.append(elapsed)
+
+    started = time.perf_counter()
+    yield from asyncio.gather(*[client() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+    return {'concurrency': concurrency,
+            'connections': len(latencies),
+            'failures': failures[0],
+            'connections_per_sec': len(latencies) / elapsed,
+            'handshake_p50_ms': _milliseconds(percentile(latencies, 50)),
+            'handshake_p99_ms': _milliseconds(percentile(latencies, 99))}
+
+@asyncio.coroutine
+def bench_bulk(proxy_port, source_port, streams, megabytes):
+    size = megabytes * 1024 * 1024
+
+    @asyncio.coroutine
+    def client():
+        reader, writer, _ = yield from open_tunnel(proxy_port, source_port)
+        writer.write(struct.pack('>Q', size))
+        received = 0
+        while received < size:
+            data = yield from reader.read(1024 * 1024)
+            if not data:
+                raise ConnectionError('tunnel closed after {} bytes'.format(
+                    received))
+            received += len(data)
+        writer.close()
+
+    started = time.perf_counter()
+    yield from asyncio.gather(*[client() for _ in range(streams)])
+    elapsed = time.perf_counter() - started
+    return {'streams': streams,
+            'megabytes_per_stream': megabytes,
+            'seconds': elapsed,
+            'megabytes_per_sec': streams * megabytes / elapsed}
+
+@asyncio.coroutine
+def bench_idle_rss(proxy_port, echo_port, server_pid, tunnels):
+    before = rss_bytes(server_pid)
+    writers = []
+    for _ in range(tunnels):
+        reader, writer, _ = yield from open_tunnel(proxy_port, echo_port)
+        writers.append(writer)
+    yield from asyncio.sleep(0.5)
+    after = rss_bytes(server_pid)
+    for writer in writers:
+        writer.close()
+    # Let upstream handlers see their tunnels closing.
+    yield from asyncio.sleep(0.5)
+    return {'tunnels': tunnels,
+            'rss_before_bytes': before,
+            'rss_after_bytes': after,
+            'rss_per_1k_tunnels_bytes': (after - before) * 1000 // tunnels}
+
+def wait_for_port(port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError('server did not start listening on {}'.format(port))
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=REPO_ROOT,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description='Benchmark an asocks server on loopback.')
+    arg_parser.add_argument('--concurrency', type=int, default=64,
+        help='concurrent clients opening short tunnels. Default to 64')
+    arg_parser.add_argument('--duration', type=float, default=10.0,
+        help='seconds of opening short tunnels. Default to 10')
+    arg_parser.add_argument('--bulk-streams', type=int, default=4,
+        help='parallel bulk downloads. Default to 4')
+    arg_parser.add_argument('--bulk-megabytes', type=int, default=256,
+        help='megabytes downloaded per bulk stream. Default to 256')
+    arg_parser.add_argument('--idle-tunnels', type=int, default=1000,
+        help='idle tunnels opened to measure RSS. Default to 1000')
+    arg_parser.add_argument('-o', '--output', default='bench_results.json',
+        help='JSON file results are written to')
+    arg_parser.add_argument('server_args', nargs='*',
+        help='extra arguments for the server, given after --')
+    args = arg_parser.parse_args()
+
+    raise_fd_limit()
+    proxy_port = free_port()
+    # Admit every tunnel a phase holds open at once, server_args given
+    # later may still override it.
+    concurrency = max(args.concurrency, args.bulk_streams, args.idle_tunnels)
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'server', '-p', str(proxy_port), '--local',
+         '-c', str(concurrency), '--log-level', 'WARNING'] +
+        args.server_args,
+        cwd=REPO_ROOT)
+
+    loop = asyncio.get_event_loop()
+    try:
+        wait_for_port(proxy_port)
+        echo = loop.run_until_complete(
+            asyncio.start_server(echo_upstream, '127.0.0.1', 0))
+        source = loop.run_until_complete(
+            asyncio.start_server(source_upstream, '127.0.0.1', 0))
+        echo_port = echo.sockets[0].getsockname()[1]
+        source_port = source.sockets[0].getsockname()[1]
+
+        results = {
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'server_args': args.server_args,
+            'connections': loop.run_until_complete(bench_connections(
+                proxy_port, echo_port, args.concurrency, args.duration)),
+            'bulk': loop.run_until_complete(bench_bulk(
+                proxy_port, source_port, args.bulk_streams,
+                args.bulk_megabytes)),
+            'idle': loop.run_until_complete(bench_idle_rss(
+                proxy_port, echo_port, server.pid, args.idle_tunnels)),
+        }
+        echo.close()
+        source.close()
+    finally:
+        server.terminate()
+        server.wait()
+        loop.close()
+
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=2, sort_keys=True)
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+if __name__ == '__main__':
+    main()
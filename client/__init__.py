@@ -0,0 +1,3 @@
+from client.client import (Connector, open_connection, create_connection,
+                           DEFAULT_POOL_IDLE_TIMEOUT)
+from exception import ProtocolError, ProxyAuthError, RequestNotSucceed
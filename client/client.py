@@ -1,206 +1,192 @@
 #! /usr/bin/env python3
 # -*- coding: utf-8 -*-
+"""Tunnels through a SOCKS5 proxy for asyncio and blocking code.
 
+  reader, writer = yield from open_connection(('proxy', 1080),
+                                              ('example.com', 80))
+
+A Connector keeps idle proxy connections past method negotiation and
+authentication, so opening a tunnel costs a single round trip for the
+CONNECT request. create_connection() is the blocking counterpart,
+returning a connected socket.
+"""
 import socket
-import struct
-import email
-from io import StringIO
+import asyncio
 import logging
+from collections import deque
 
-from socketserver import ForkingMixIn, TCPServer, StreamRequestHandler
-
-
-from exception import ProtocolError, ProxyAuthError, RequestNotSucceed
-from logger import console_handler
-from proxy_config import PROXY_LOCAL_PORT
-
-STATUS_INIT = 0
-STATUS_NEGO = 1
-STATUS_AUTHENTICATED = 2
-STATUS_CONN_ESTABLISHED = 3
+from exception import ProtocolError
+from client.client_protocol import (ClientProtocol, build_greeting,
+                                    build_auth_request, build_connect_request,
+                                    check_selection, check_auth_reply,
+                                    reply_length, check_reply)
 
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
-logger.addHandler(console_handler)
-
-class ClientState:
-    INIT = 1
-    NEGOTIATED = 2 
-    AUTHENTICATED = 3
-    CONNECTED_TO_REMOTE = 4
- 
-BUFF_SIZE = 1024*1024
-
-class Client:
-
-    def __init__(self, proxy_host, proxy_port, username=None, password=None):
-        self._status = STATUS_INIT
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._proxy_addr = proxy_host, proxy_port
-        self._username = username
-        self._pasword = password
-        if username and password:
-            self._auth_data_chunk = b'\x05\x02\x00\x02'
-        else:
-            self._auth_data_chunk = b'\x05\x01\x00'
 
-    def _negotiate(self):
-        try:
-            self._socket.connect(self._proxy_addr)
-            print('connected to server')
-        except socket.error as e:
-            self._socket.close()
-            print("Error connecting to proxy {0}:{1}".format(*self._proxy_addr))
+DEFAULT_POOL_SIZE = 0
+# asocks closes connections that do not send a request within its
+# handshake timeout, 30 seconds by default.
+DEFAULT_POOL_IDLE_TIMEOUT = 20.0
+DEFAULT_STREAM_LIMIT = 64 * 1024
+
+class Connector:
+    """Opens tunnels through one SOCKS5 proxy.
+
+    Up to pool_size negotiated proxy connections are kept idle for at
+    most idle_timeout seconds and replaced in the background once taken.
+    Without an idle connection, greeting, credentials and CONNECT request
+    are pipelined in one flight unless pipeline is False.
+    """
+
+    def __init__(self, proxy, username=None, password=None,
+                 pool_size=DEFAULT_POOL_SIZE,
+                 idle_timeout=DEFAULT_POOL_IDLE_TIMEOUT,
+                 pipeline=True, loop=None):
+        self.proxy = proxy
+        self.username = username
+        self.password = password
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.pipeline = pipeline
+        self._loop = loop or asyncio.get_event_loop()
+        self._idle = deque() # (protocol, negotiated at)
+        self._filling = None
+        self._closed = False
+
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'idle': len(self._idle)}
+
+    def close(self):
+        self._closed = True
+        if self._filling is not None:
+            self._filling.cancel()
+        while self._idle:
+            self._idle.popleft()[0].transport.close()
+
+    @asyncio.coroutine
+    def open_connection(self, dest, limit=DEFAULT_STREAM_LIMIT):
+        """Open a tunnel to dest, a (host, port) tuple, through the proxy.
+
+        Returns a (reader, writer) pair like asyncio.open_connection().
+        Raises OSError when the proxy cannot be reached, ProxyAuthError
+        when it refuses the credentials, RequestNotSucceed carrying the
+        reply status when it refuses the request and ProtocolError on
+        invalid replies.
+        """
+        protocol = self._acquire()
+        if protocol is not None:
+            self.hits += 1
+            connected = protocol.connect(dest)
         else:
-            try:
-                self._socket.send(self._auth_data_chunk)
-                print("auth request sent out")
-                method_selected = self._socket.recv(2)
-            except socket.error as e:
-                print("Error send auth data", e)
-                pass    
-            else:
-                if method_selected[0:1] != b'\x05':
-                    raise ProtocolError()   
-                
-                # http://tools.ietf.org/html/rfc1929
-                if method_selected[1:2] == b'\x02':
-                    self._socket.send(b'\x01' + hex(len(self._username).encode())
-                                      + self._username.encode()
-                                      + hex(len(self._password).encode())
-                                      + self._password.encode())
-                    res = self._socket.recv(4)
-                    if res[0:1] != b'\x01':
-                        raise ProtocolError()
-
-                    if res[1:] != b'\x00':
-                        self._socket.close()    
-                        raise ProxyAuthError()
-                elif method_selected[1:2] != b'\x00':
-                    raise ProtocolError()               
-                self._status = STATUS_AUTHENTICATED
-
-
-    def connect(self, dest):
-        if self._status == STATUS_INIT:
-            self._negotiate()
-        
-        assert self._status == STATUS_AUTHENTICATED,\
-               "need authenticated before connect"
-        self._send_conn_request(dest)
-        print("connect request sent out")
+            if self.pool_size:
+                self.misses += 1
+            transport, protocol = yield from self._loop.create_connection(
+                lambda: ClientProtocol(self.username, self.password, dest,
+                                       self.pipeline),
+                *self.proxy)
+            connected = protocol.connected
+        self._refill()
+
         try:
-            bnd_addr, bnd_port = self._recv_conn_reponse()          
-            self._status = STATUS_CONN_ESTABLISHED
-        except:
-            pass
-        
-    def sendall(self, _bytes):
-        data_length = self._socket.sendall(_bytes)
-        
-    def recvall(self):
-        data = b''
-        size = self._recvexactly(4)
-        size = struct.unpack('>I', size)[0]
-        data = self._recvexactly(size)
-        return data
-
-    def _recvexactly(self, size):
-        data = b''
-        while size:
-            res = self._socket.recv(size)
-            data += res
-            size -= len(res)
-        return data
-
-    def _send_conn_request(self, dest):
-        host, port = dest
-        request_content = b'\x05' + b'\x01' + b'\x00'
+            yield from connected
+        except BaseException:
+            protocol.transport.close()
+            raise
+
+        # Same plumbing as asyncio.open_connection().
+        transport = protocol.transport
+        reader = asyncio.StreamReader(limit=limit, loop=self._loop)
+        stream_protocol = asyncio.StreamReaderProtocol(reader,
+                                                       loop=self._loop)
+        protocol.hand_over(stream_protocol)
+        writer = asyncio.StreamWriter(transport, stream_protocol, reader,
+                                      self._loop)
+        return reader, writer
+
+    def _acquire(self):
+        now = self._loop.time()
+        while self._idle:
+            protocol, since = self._idle.popleft()
+            if (now - since < self.idle_timeout and
+                    not protocol.transport.is_closing()):
+                return protocol
+            protocol.transport.close()
+        return None
+
+    def _refill(self):
+        if (self.pool_size and not self._closed and self._filling is None and
+                len(self._idle) < self.pool_size):
+            self._filling = self._loop.create_task(self._fill())
+
+    @asyncio.coroutine
+    def _fill(self):
         try:
-            request_content += b'\x01' + socket.inet_aton(host)
-        except socket.error:
-            host_bytes = host.encode('idna')
-            request_content += b'\x03' + chr(len(host_bytes)).encode() + host_bytes
-        request_content += struct.pack('>H', port)
-        self._socket.send(request_content)
-
-    def _recv_conn_reponse(self):   
-        res = self._socket.recv(255) # to be verified
-        # check version
-        ver, res = res[:1], res[1:]
-        if ver != b'\x05':
-            raise ProtocolError()
-        # check reply
-        rep, res = res[:1], res[1:] 
-        if rep != b'\x00':
-            raise RequestNotSucceed()
-        
-        # address type
-        addr_type, res = res[1:2], res[2:]
-        if addr_type == b'\x01': # ipv4 
-            addr, res = res[:4], res[4:]
-            addr = socket.inet_ntoa(addr)   
-        elif addr_type == b'\x03': # dns
-            _len = ord(res[:1])
-            addr, res = res[1:1+_len], res[1+_len:] 
-        
-        port = struct.unpack('>H', res[:2])[0]
-        return addr, port
-    
-class ProxyServerHandler(StreamRequestHandler):
-
-    def handle(self):
-        self.data = b''
-        self.request_body = None 
-        body_length_left = None
-
-        while True:
-            chunk = self.request.recv(body_length_left or 1024)
-            self.data += chunk
-
-            if body_length_left is not None:
-                body_length_left -= len(chunk)
-                if body_length_left <= 0:
-                    break
-                else:
-                    continue
-
-            end_of_header = self.data.index(b'\r\n\r\n')
-            if end_of_header == -1:
-                continue
-            
-            http_request, headers = self.data[:end_of_header].split(b'\r\n', 1)
-            self.request_body = self.data[end_of_header+4:]
-            headers = email.message_from_file(StringIO(str(headers)))
-            headers = dict(headers.items())
-
-            if 'Content-Length' not in headers or headers['Content-Length'] == 0:
-                break
-
-            # logging when Cotent-Length showing for testing
-            logger.info(str(self.data))
-            body_length_left = headers['Content-Length'] - len(self.request_body)
-            if body_length_left <= 0:
-                break
-       
-        print(self.data)
-
-class Socks5ProxyServer(ForkingMixIn, TCPServer):
-    pass
-
-
-if __name__ == '__main__':
-    server = Socks5ProxyServer(('localhost', PROXY_LOCAL_PORT), ProxyServerHandler)    
+            while len(self._idle) < self.pool_size:
+                _, protocol = yield from self._loop.create_connection(
+                    lambda: ClientProtocol(self.username, self.password,
+                                           pipeline=self.pipeline),
+                    *self.proxy)
+                try:
+                    yield from protocol.negotiated
+                except BaseException:
+                    protocol.transport.close()
+                    raise
+                self._idle.append((protocol, self._loop.time()))
+        except (OSError, ProtocolError) as exc:
+            # Retried when the next tunnel is opened.
+            logger.warning('Filling pool of proxy {}:{} failed: {}'.format(
+                self.proxy[0], self.proxy[1], exc))
+        finally:
+            self._filling = None
+
+@asyncio.coroutine
+def open_connection(proxy, dest, username=None, password=None,
+                    connector=None, limit=DEFAULT_STREAM_LIMIT):
+    """Open a tunnel to dest through proxy, both (host, port) tuples.
+
+    Returns (reader, writer). Pass a Connector to reuse its pool.
+    """
+    if connector is None:
+        connector = Connector(proxy, username, password)
+    return (yield from connector.open_connection(dest, limit=limit))
+
+def _recv_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ProtocolError('proxy closed connection during handshake')
+        data += chunk
+    return data
+
+def create_connection(proxy, dest, username=None, password=None,
+                      timeout=None, source_address=None):
+    """Blocking open of a tunnel to dest through proxy.
+
+    Returns a socket connected to dest, like socket.create_connection().
+    The handshake is pipelined and replies are read exactly, so nothing
+    the remote sends is consumed.
+    """
+    sock = socket.create_connection(proxy, timeout, source_address)
     try:
-        server.serve_forever()
-    except KeyboardInterrupt:
-        pass
-    except Exception:
-        pass
-    finally:
-        server.shutdown()
-        server.server_close()
-
-
-
-
+        messages = [build_greeting(username)]
+        if username is not None:
+            messages.append(build_auth_request(username, password))
+        messages.append(build_connect_request(dest))
+        sock.sendall(b''.join(messages))
+
+        check_selection(_recv_exactly(sock, 2), username)
+        if username is not None:
+            check_auth_reply(_recv_exactly(sock, 2))
+        reply = _recv_exactly(sock, 5)
+        reply += _recv_exactly(sock, reply_length(reply) - 5)
+        check_reply(reply)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
@@ -1,87 +1,221 @@
-import asyncio
+"""Client side of the SOCKS5 handshake, see RFC 1928 and RFC 1929."""
+import socket
 import struct
+import asyncio
 
-from networking import *
-from auth import *
-from config import *
+import auth
+from networking import SOCK_PROTOCOL_VERSION, AddressType, Command
+from exception import ProtocolError, ProxyAuthError, RequestNotSucceed
 
 class ClientState:
     INIT = 1
-    NEGOTIATED = 2 
+    NEGOTIATED = 2
     AUTHENTICATED = 3
     CONNECTED_TO_REMOTE = 4
-    
 
-class ClientServerProtocol(asyncio.protocol):
-    pass
+def build_greeting(username=None):
+    if username is not None:
+        method = auth.UsernamePassword.method_code
+    else:
+        method = auth.NoAuthRequired.method_code
+    return struct.pack('>BBB', SOCK_PROTOCOL_VERSION, 1, method)
+
+def build_auth_request(username, password):
+    username = username.encode('utf-8')
+    password = password.encode('utf-8')
+    return (struct.pack('>BB', auth.UsernamePassword.version, len(username)) +
+            username + struct.pack('>B', len(password)) + password)
+
+def build_connect_request(dest):
+    host, port = dest
+    for family, atype in ((socket.AF_INET, AddressType.IPv4),
+                          (socket.AF_INET6, AddressType.IPv6)):
+        try:
+            address = struct.pack('>B', atype) + socket.inet_pton(family, host)
+            break
+        except (OSError, ValueError):
+            continue
+    else:
+        name = host.encode('idna')
+        address = struct.pack('>BB', AddressType.DomainName, len(name)) + name
+    return (struct.pack('>BBB', SOCK_PROTOCOL_VERSION, Command.CONNECT, 0) +
+            address + struct.pack('>H', port))
+
+def check_selection(reply, username=None):
+    """Check the method selection reply, 2 bytes."""
+    if reply[0] != SOCK_PROTOCOL_VERSION:
+        raise ProtocolError('not a SOCKS5 server')
+    expected = (auth.UsernamePassword.method_code if username is not None
+                else auth.NoAuthRequired.method_code)
+    if reply[1] != expected:
+        raise ProxyAuthError('proxy refused method {}'.format(expected))
+
+def check_auth_reply(reply):
+    """Check the username/password reply, 2 bytes."""
+    if reply[0] != auth.UsernamePassword.version:
+        raise ProtocolError('invalid authentication reply')
+    if reply[1] != auth.UsernamePassword.SUCCEEDED:
+        raise ProxyAuthError('proxy refused credentials')
 
-class ClientProtocol(asyncio.protocol):
-    
-    def __init__(self, remote_domain_name, remote_port=80, waiter):
+def reply_length(head):
+    """Length of a CONNECT reply from its first 5 bytes."""
+    if head[0] != SOCK_PROTOCOL_VERSION:
+        raise ProtocolError('invalid reply version {}'.format(head[0]))
+    atype = head[3]
+    if atype == AddressType.IPv4:
+        return 4 + 4 + 2
+    if atype == AddressType.IPv6:
+        return 4 + 16 + 2
+    if atype == AddressType.DomainName:
+        return 5 + head[4] + 2
+    raise ProtocolError('invalid reply address type {}'.format(atype))
+
+def check_reply(reply):
+    """Check a complete CONNECT reply."""
+    if reply[1] != 0:
+        raise RequestNotSucceed(reply[1])
+
+class ClientProtocol(asyncio.Protocol):
+    """Runs the client side of a SOCKS5 handshake on a proxy connection.
+
+    negotiated resolves once method selection and authentication are
+    done; connect() then sends a CONNECT request. With pipeline, the
+    greeting, credentials and, when dest is given, the CONNECT request
+    go out in one flight without waiting for the proxy's replies. Bytes
+    past the CONNECT reply, and those arriving until hand_over() passes
+    the transport on, are kept for the protocol taking over.
+    """
+
+    def __init__(self, username=None, password=None, dest=None,
+                 pipeline=True):
+        self.username = username
+        self.password = password
+        self.pipeline = pipeline
         self.transport = None
-        self._loop = None
         self.state = ClientState.INIT
-        self.remote_domain_name = remote_domain_name
-        self.remote_port = remote_port
-        self.waiter = waiter
-
-    def _next_state(self, skip=0):
-        self.state += 1 + skip
+        self.negotiated = asyncio.Future()
+        self.connected = None
+        self._dest = dest
+        self._request_sent = False
+        self._buffer = bytearray()
+        self._eof = False
+        # (exc,) once the connection is lost after the reply.
+        self._lost = None
 
-    def connection_made(self, transport);
+    def connection_made(self, transport):
         self.transport = transport
-        self._loop = self.transport._loop
-        auth_method_selection_msg = SOCK_PROTOCOL_VERSION
-        auth_method_selection_msg += struct.pack(
-            '>B', 
-            len(acceptable_auth_methods))
-        auth_method_selection_msg += ''.join(acceptable_auth_method_codes)
-        print auth_method_selection_msg
-        self.transport.write(auth_method_selection_msg)
+        messages = [build_greeting(self.username)]
+        if self.pipeline:
+            if self.username is not None:
+                messages.append(build_auth_request(self.username,
+                                                   self.password))
+            if self._dest is not None:
+                messages.append(build_connect_request(self._dest))
+                self._request_sent = True
+        if self._dest is not None:
+            self.connected = asyncio.Future()
+        transport.write(b''.join(messages))
+
+    def connect(self, dest):
+        """Send a CONNECT request to dest once negotiated, return a future
+        resolving once the proxy replied."""
+        if self.connected is None:
+            self.connected = asyncio.Future()
+            self._dest = dest
+            if self.state >= ClientState.AUTHENTICATED:
+                self._send_request()
+        return self.connected
+
+    def _send_request(self):
+        self._request_sent = True
+        self.transport.write(build_connect_request(self._dest))
 
     def data_received(self, data):
+        self._buffer.extend(data)
+        if self.state == ClientState.CONNECTED_TO_REMOTE:
+            return
+        try:
+            self._process()
+        except (ProtocolError, ProxyAuthError, RequestNotSucceed) as exc:
+            self._fail(exc)
+
+    def _process(self):
         if self.state == ClientState.INIT:
-            self._process_selected_auth_method(data) 
-        elif self.state == ClientState.AUTHENTICATED:
-            self._process_connect_reply(data)
-        elif self.state == 
-        
-    def _process_selected_auth_method(self, data):
-        assert len(data) == 2
-        assert data[0] == SOCK_PROTOCOL_VERSION 
-        assert data[1] == NoAuthRequired.code
-        if data[1] == NoAuthRequired.code:
-            self._next_state(1)
-            self._send_connect_request() 
-
-    def _send_connect_request(self):
-        connect_msg = SOCK_PROTOCOL_VERSION
-        connect_msg += b'\x01'   
-        connect_msg += b'\x00'
-        connect_msg += struct.pack('>B', AddressType.DomainName)
-        connect_msg += self.remote_domain_name.encode('idna') 
-        connect_msg += struct.pack('>B', self.remote_port)
-        self.transport.write(connect_msg)
-        self._next_state()
-
-    def _process_connect_reply(self, data):
-        assert data[0] == SOCK_PROTOCOL_VERSION
-        connect_status = struct.unpack('>B', data[1:2])
-        if connect_status == SUCCEEDED:
-            self.waiter.set_result(None)
-        else:
-
-
-if __name__ == '__main__':
-    loop = asyncio.get_event_loop()
-    waiter = loop.create_future()
-    watier.add_done_callback()
-    conn_coro = create_connection(
-        functools.partial(
-            ClientProtocol, 
-            remote_domain_name='www.bloomberg.com', 
-            remote_port=8080, 
-            waiter=waiter ), 
-        localhost, 
-        socks5_server_port, 
-        local_addr=(localhost, 8080))
+            if len(self._buffer) < 2:
+                return
+            check_selection(self._buffer[:2], self.username)
+            del self._buffer[:2]
+            self.state = ClientState.NEGOTIATED
+            if self.username is None:
+                self._authenticated()
+            elif not self.pipeline:
+                self.transport.write(build_auth_request(self.username,
+                                                        self.password))
+
+        if self.state == ClientState.NEGOTIATED:
+            if len(self._buffer) < 2:
+                return
+            check_auth_reply(self._buffer[:2])
+            del self._buffer[:2]
+            self._authenticated()
+
+        if (self.state == ClientState.AUTHENTICATED and
+                self.connected is not None):
+            if len(self._buffer) < 5:
+                return
+            length = reply_length(self._buffer)
+            if len(self._buffer) < length:
+                return
+            check_reply(self._buffer)
+            self.state = ClientState.CONNECTED_TO_REMOTE
+            del self._buffer[:length]
+            self.connected.set_result(None)
+
+    def hand_over(self, protocol):
+        """Make protocol serve the transport, passing on the bytes, EOF
+        and loss received since the CONNECT reply."""
+        self.transport.set_protocol(protocol)
+        protocol.connection_made(self.transport)
+        if self._buffer:
+            data = bytes(self._buffer)
+            self._buffer.clear()
+            protocol.data_received(data)
+        if self._eof and not protocol.eof_received():
+            self.transport.close()
+        if self._lost is not None:
+            protocol.connection_lost(self._lost[0])
+
+    def _authenticated(self):
+        self.state = ClientState.AUTHENTICATED
+        if not self.negotiated.done():
+            self.negotiated.set_result(None)
+        if self._dest is not None and not self._request_sent:
+            self._send_request()
+
+    def _set_exception(self, exc):
+        # Whoever waits for the CONNECT reply is told, not both waiters.
+        if self.connected is not None:
+            if not self.connected.done():
+                self.connected.set_exception(exc)
+            if not self.negotiated.done():
+                self.negotiated.cancel()
+        elif not self.negotiated.done():
+            self.negotiated.set_exception(exc)
+
+    def _fail(self, exc):
+        self._set_exception(exc)
+        self.transport.close()
+
+    def eof_received(self):
+        if self.state == ClientState.CONNECTED_TO_REMOTE:
+            # The protocol taking over decides whether to close.
+            self._eof = True
+            return True
+        self._fail(ProtocolError('proxy closed connection during handshake'))
+
+    def connection_lost(self, exc):
+        if self.state == ClientState.CONNECTED_TO_REMOTE:
+            self._lost = (exc,)
+            return
+        self._set_exception(exc or ProtocolError(
+            'proxy closed connection during handshake'))
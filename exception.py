@@ -20,3 +20,6 @@ class InvalidRequest(Exception):
 
 class WrongProtocol(InvalidRequest):
     pass
+
+class InvalidRuleset(Exception):
+    pass
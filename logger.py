@@ -1,4 +1,6 @@
 import logging
+import logging.handlers
+import queue
 import sys
 
 
@@ -8,6 +10,54 @@ console_formatter = logging.Formatter(
 			"%Y-%m-%d %H:%M:%S")
 console_handler.setFormatter(console_formatter)
 
+# Knuth's multiplicative hash spreads sequential connection ids evenly.
+_HASH_MULTIPLIER = 2654435761
+_HASH_RANGE = 2 ** 32
 
-__all__ = ('console_handler')
+class ConnectionSampler(logging.Filter):
+    """Keep records of a sample_rate share of connections.
 
+    Records carrying a conn_id attribute (passed through extra=) are kept
+    for either all or none of the records of that connection. Warnings
+    and records without conn_id always pass.
+    """
+
+    def __init__(self, sample_rate=1.0):
+        super().__init__()
+        self.threshold = int(sample_rate * _HASH_RANGE)
+
+    def filter(self, record):
+        conn_id = getattr(record, 'conn_id', None)
+        if conn_id is None or record.levelno >= logging.WARNING:
+            return True
+        return (conn_id * _HASH_MULTIPLIER) % _HASH_RANGE < self.threshold
+
+def setup_logging(level=logging.INFO, sample_rate=1.0, use_queue=True):
+    """Route all records through one handler on the root logger.
+
+    With use_queue, records are put on a queue by a QueueHandler and
+    written to console by a QueueListener thread, so logging never blocks
+    the event loop on stdout. The started listener is returned and must
+    be stopped on shutdown to flush pending records. Without use_queue,
+    records are written synchronously and None is returned.
+    """
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.setLevel(level)
+
+    if not use_queue:
+        root.addHandler(console_handler)
+        return None
+
+    log_queue = queue.Queue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(ConnectionSampler(sample_rate))
+    root.addHandler(queue_handler)
+
+    listener = logging.handlers.QueueListener(log_queue, console_handler)
+    listener.start()
+    return listener
+
+
+__all__ = ('console_handler', 'ConnectionSampler', 'setup_logging')
@@ -1,6 +1,13 @@
 
 SOCK_PROTOCOL_VERSION = 5
 
+NO_ACCEPTABLE_METHODS = 0xff
+
+class Command:
+    CONNECT = 1
+    BIND = 2
+    UDP_ASSOCIATE = 3
+
 class AddressType:
     IPv4 = 1
     IPv6 = 4
@@ -17,3 +24,16 @@ class ConnectionStatus:
     COMM_NOT_SUPP = 7 
     ATYP_NOT_SUPP = 8 
 
+    StatusMapping = None
+
+    @classmethod
+    def status_name(cls, status):
+        if cls.StatusMapping is None:
+            cls.StatusMapping = {
+                getattr(cls, attr): attr
+                for attr in dir(cls)
+                if not callable(getattr(cls, attr))
+                and not attr.startswith('__') and attr != 'StatusMapping'}
+
+        return cls.StatusMapping.get(status)
+
@@ -1,60 +1,615 @@
+import os
 import socket
+import signal
 import struct
 import asyncio 
 import argparse
 import logging
+import functools
 from errno import ENETUNREACH, EHOSTUNREACH, ECONNREFUSED
 
-from server.server_protocol import ServerClientProtocol
-from logger import console_handler
+from server.server_protocol import (ServerClientProtocol,
+                                    DEFAULT_WRITE_BUFFER_HIGH,
+                                    DEFAULT_WRITE_BUFFER_LOW,
+                                    DEFAULT_HANDSHAKE_TIMEOUT,
+                                    DEFAULT_IDLE_TIMEOUT,
+                                    RELAY_ENGINES)
+from server.timers import TimerWheel
+from server.udp_relay import DEFAULT_MAPPING_TIMEOUT
+from server.upstream import Upstream, parse_upstream
+from server.shaping import Shaper, parse_rate_limit, SCOPES
+from server.scheduling import RelayScheduler, LoopLagMonitor, DEFAULT_QUANTUM
+from server.sockopts import build_profiles, parse_socket_option
+from server.listeners import Listener, parse_listen, is_tcp
+from server.credentials import CREDENTIAL_STORES, DEFAULT_CACHE_TTL
+from server.acl import AccessList, Ruleset
+from exception import InvalidRuleset
+from server.workers import WorkerSupervisor
+from server.lifecycle import (ConnectionTracker, HandoffListener,
+                              inherited_sockets, request_sockets,
+                              notify_ready, spawn_successor, wait_ready,
+                              DEFAULT_DRAIN_TIMEOUT)
+from server.admission import (AdmissionController, ADMISSION_POLICIES,
+                              DEFAULT_QUEUE_TIMEOUT)
+from server.connector import DEFAULT_ATTEMPT_DELAY, DEFAULT_CONNECT_TIMEOUT
+from server.metrics import Metrics, MetricsHttpProtocol
+from server.pool import (ConnectionPool, parse_destination, DEFAULT_POOL_SIZE,
+                         DEFAULT_POOL_IDLE_TIMEOUT)
+from logger import setup_logging
+from server.resolver import (Resolver, DEFAULT_POSITIVE_TTL,
+                             DEFAULT_NEGATIVE_TTL,
+                             DEFAULT_MAX_CONCURRENT_LOOKUPS)
 
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
-logger.addHandler(console_handler)
+
+LOG_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR')
+EVENT_LOOPS = ('asyncio', 'uvloop')
+# Listen backlog when --concurrency does not set one.
+DEFAULT_BACKLOG = 256
+
+def install_event_loop(name):
+    """Install event loop policy of name, return name of the active loop."""
+    if name == 'uvloop':
+        try:
+            import uvloop
+        except ImportError:
+            logger.warning('uvloop is not installed, falling back to asyncio '
+                           'event loop.')
+        else:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            return 'uvloop'
+    asyncio.set_event_loop_policy(None)
+    return 'asyncio'
 
 def start_serve(*args, **kwargs):
+    log_listener = setup_logging(kwargs['log_level'],
+                                 kwargs['log_sample_rate'])
+    loop_name = install_event_loop(kwargs['event_loop'])
     loop = asyncio.get_event_loop()
-    coro = loop.create_server(
-        protocol_factory=ServerClientProtocol, 
-        host=kwargs['addr'],
-        port=kwargs['port'], 
-        backlog=kwargs['concurrency'])
+    logger.info('Using {} event loop {}.'.format(loop_name, type(loop).__name__))
+    resolver = Resolver(loop,
+                        positive_ttl=kwargs['dns_ttl'],
+                        negative_ttl=kwargs['dns_negative_ttl'],
+                        max_concurrent=kwargs['dns_concurrency'])
+    pool = None
+    if kwargs['pool_destinations']:
+        pool = ConnectionPool(loop, kwargs['pool_destinations'], resolver,
+                              size=kwargs['pool_size'],
+                              idle_timeout=kwargs['pool_idle_timeout'],
+                              attempt_delay=kwargs['connect_attempt_delay'],
+                              connect_timeout=kwargs['connect_timeout'])
+        pool.start()
+    admission = AdmissionController(
+        loop, kwargs['concurrency'],
+        max_per_ip=kwargs['max_per_ip'],
+        policy=kwargs['admission_policy'],
+        queue_timeout=kwargs['admission_queue_timeout'])
+    credentials = None
+    if kwargs['auth_file']:
+        credentials = CREDENTIAL_STORES[kwargs['auth_format']](
+            loop, kwargs['auth_file'], cache_ttl=kwargs['auth_cache_ttl'])
+        credentials.start()
+    acl = None
+    if kwargs['acl_file']:
+        acl = AccessList(loop, kwargs['acl_file'])
+        acl.start()
+    upstream = None
+    if kwargs['upstream']:
+        host, port, username, password = kwargs['upstream']
+        upstream = Upstream(loop, host, port, resolver,
+                            username=username, password=password,
+                            mux_connections=kwargs['upstream_mux'],
+                            attempt_delay=kwargs['connect_attempt_delay'],
+                            connect_timeout=kwargs['connect_timeout'])
+        upstream.start()
+    # One wheel drives handshake, idle and lifetime timeouts of all tunnels.
+    timers = TimerWheel(loop)
+    connections = ConnectionTracker(loop)
+    shaper = None
+    if kwargs['rate_limits']:
+        shaper = Shaper(loop, kwargs['rate_limits'])
+    scheduler = None
+    if kwargs['relay_engine'] == 'fair':
+        scheduler = RelayScheduler(loop, quantum=kwargs['relay_quantum'])
+
+    metrics = None
+    metrics_server = None
+    if kwargs['metrics_port']:
+        # Each worker serves its own metrics on consecutive ports.
+        metrics_port = kwargs['metrics_port'] + kwargs.get('worker_index', 0)
+        metrics = Metrics()
+        metrics.add_stats_source('asocks_dns', resolver.stats)
+        if pool is not None:
+            metrics.add_stats_source('asocks_pool', pool.stats)
+        metrics.add_stats_source('asocks_admission', admission.stats)
+        if credentials is not None:
+            metrics.add_stats_source('asocks_auth', credentials.stats)
+        if acl is not None:
+            metrics.add_stats_source('asocks_acl', acl.stats)
+        if upstream is not None:
+            metrics.add_stats_source('asocks_upstream', upstream.stats)
+        if shaper is not None:
+            metrics.add_stats_source('asocks_shaping', shaper.stats)
+        if scheduler is not None:
+            metrics.add_stats_source('asocks_scheduler', scheduler.stats)
+        metrics_server = loop.run_until_complete(loop.create_server(
+            functools.partial(MetricsHttpProtocol, metrics),
+            host=kwargs['metrics_addr'], port=metrics_port))
+        logger.info('Serving metrics at http://{}:{}/metrics'.format(
+            kwargs['metrics_addr'], metrics_port))
+    lag_monitor = None
+    if scheduler is not None or metrics is not None:
+        lag_monitor = LoopLagMonitor(
+            loop, metrics.loop_lag_seconds if metrics is not None else None)
+        if metrics is not None:
+            metrics.add_stats_source('asocks_loop', lag_monitor.stats)
+        lag_monitor.start()
+    protocol_factory = functools.partial(
+        ServerClientProtocol,
+        write_buffer_high=kwargs['write_buffer_high'],
+        write_buffer_low=kwargs['write_buffer_low'],
+        relay_engine=kwargs['relay_engine'],
+        resolver=resolver,
+        connect_attempt_delay=kwargs['connect_attempt_delay'],
+        connect_timeout=kwargs['connect_timeout'],
+        optimistic_data=kwargs['optimistic_data'],
+        pool=pool,
+        metrics=metrics,
+        admission=admission,
+        timers=timers,
+        handshake_timeout=kwargs['handshake_timeout'],
+        idle_timeout=kwargs['idle_timeout'],
+        max_lifetime=kwargs['max_lifetime'],
+        credentials=credentials,
+        acl=acl,
+        udp_associate=kwargs['udp_associate'],
+        udp_mapping_timeout=kwargs['udp_mapping_timeout'],
+        upstream=upstream,
+        connections=connections,
+        shaper=shaper,
+        scheduler=scheduler,
+        socket_profile=kwargs['socket_profiles'][kwargs['socket_profile']],
+        socket_profiles=kwargs['socket_profiles'])
+    handed_over = inherited_sockets()
+    if handed_over is None and kwargs['handoff_socket']:
+        handed_over = request_sockets(kwargs['handoff_socket'])
+    inherited = handed_over[0] if handed_over is not None else {}
+
+    servers = []
+    listen_sockets = [] # (listener index, socket)
+    for index, listener in enumerate(kwargs['listeners']):
+        factory = protocol_factory
+        if listener.profile is not None:
+            factory = functools.partial(
+                factory,
+                socket_profile=kwargs['socket_profiles'][listener.profile])
+        if not listener.auth:
+            factory = functools.partial(factory, credentials=None)
+        if listener.unix:
+            # Clients of a Unix socket have no address to send from.
+            factory = functools.partial(factory, udp_associate=False)
+        if kwargs['accept_mux']:
+            # Streams are served like client connections, without nesting.
+            factory = functools.partial(factory, mux_stream_factory=factory)
+        sockets = inherited.pop(index, None)
+        started = loop.run_until_complete(listener.serve(
+            loop, factory, kwargs['backlog'],
+            reuse_port=kwargs['workers'] > 1, sockets=sockets))
+        servers.extend(started)
+        listen_sockets.extend((index, sock) for server in started
+                              for sock in server.sockets)
+        logger.info('Asocks server {} at {} (pid {})'.format(
+            'took over listening' if sockets else 'starts listening',
+            listener, os.getpid()))
+    for sockets in inherited.values():
+        # Listeners the new configuration dropped.
+        for sock in sockets:
+            sock.close()
+    if kwargs['optimistic_data'] and hasattr(socket, 'TCP_FASTOPEN'):
+        # Let optimistic clients put their handshake into the SYN as well.
+        for _, sock in listen_sockets:
+            if not is_tcp(sock):
+                continue
+            try:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_FASTOPEN,
+                                kwargs['backlog'])
+            except OSError as exc:
+                logger.warning('TCP Fast Open unavailable: {}'.format(exc))
+    if handed_over is not None:
+        notify_ready(handed_over[1])
+
+    handoff_listener = None
+    # Set once the server stops accepting, the shutdown task draining.
+    draining = None
+    # Set once a new process serves on the listening sockets.
+    handed_off = False
+
+    @asyncio.coroutine
+    def drain():
+        for server in servers:
+            server.close()
+        if handoff_listener is not None:
+            handoff_listener.close()
+        logger.info('Draining {} connections for up to {} seconds.'.format(
+            len(connections), kwargs['drain_timeout']))
+        remaining = yield from connections.drain(kwargs['drain_timeout'])
+        if remaining:
+            logger.warning('Closed {} connections still open after '
+                           'draining.'.format(remaining))
+        loop.stop()
+
+    def start_draining():
+        nonlocal draining
+        if draining is None:
+            draining = loop.create_task(drain())
+        else:
+            logger.info('Stopping without waiting for connections.')
+            loop.stop()
+
+    @asyncio.coroutine
+    def hand_over(channel, process=None):
+        nonlocal handed_off
+        if (yield from wait_ready(loop, channel)):
+            handed_off = True
+            logger.info('New server process serves, draining.')
+            start_draining()
+            return
+        logger.error('New server process did not start serving, '
+                     'keeping on serving.')
+        if process is not None and process.poll() is None:
+            process.kill()
+        if handoff_listener is not None and draining is None:
+            handoff_listener.start()
+
+    def restart():
+        if draining is not None:
+            return
+        try:
+            process, channel = spawn_successor(listen_sockets)
+        except OSError as exc:
+            logger.error('Starting new server process failed: {}'.format(exc))
+            return
+        logger.info('Started new server process {}.'.format(process.pid))
+        if handoff_listener is not None:
+            # Nobody else may take the sockets over meanwhile.
+            handoff_listener.close()
+        loop.create_task(hand_over(channel, process))
 
-    server = loop.run_until_complete(coro)
-    logger.info(
-        'Asocks server starts listening at {}:{}'.format(
-            kwargs['addr'], kwargs['port']))
+    if kwargs['handoff_socket']:
+        handoff_listener = HandoffListener(
+            loop, kwargs['handoff_socket'], listen_sockets,
+            lambda channel: loop.create_task(hand_over(channel)))
+        handoff_listener.start()
+    loop.add_signal_handler(signal.SIGTERM, start_draining)
+    if kwargs['workers'] == 1:
+        # Workers bind their own sockets, they are not handed over.
+        loop.add_signal_handler(signal.SIGHUP, restart)
 
     try:
         loop.run_forever()
     except KeyboardInterrupt:
         pass
 
-    server.close()
-    loop.run_until_complete(server.wait_closed())
+    if handoff_listener is not None:
+        handoff_listener.close()
+    connections.abort()
+    for server in servers:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+    if not handed_off:
+        for listener in kwargs['listeners']:
+            listener.unlink()
+    if metrics_server is not None:
+        metrics_server.close()
+        loop.run_until_complete(metrics_server.wait_closed())
 
+    logger.info('DNS cache stats: {}'.format(resolver.stats()))
+    logger.info('Admission stats: {}'.format(admission.stats()))
+    if pool is not None:
+        logger.info('Connection pool stats: {}'.format(pool.stats()))
+        pool.close()
+    timers.close()
+    if credentials is not None:
+        logger.info('Authentication stats: {}'.format(credentials.stats()))
+        credentials.close()
+    if acl is not None:
+        logger.info('Access control stats: {}'.format(acl.stats()))
+        acl.close()
+    if upstream is not None:
+        logger.info('Upstream stats: {}'.format(upstream.stats()))
+        upstream.close()
+    if shaper is not None:
+        logger.info('Shaping stats: {}'.format(shaper.stats()))
+        shaper.close()
+    if scheduler is not None:
+        logger.info('Relay scheduler stats: {}'.format(scheduler.stats()))
+        scheduler.close()
+    if lag_monitor is not None:
+        logger.info('Event loop lag stats: {}'.format(lag_monitor.stats()))
+        lag_monitor.close()
     logger.info('Shutting down eventloop.')
     loop.close()
     logger.info('Shutting down Asocks proxy service.')
+    log_listener.stop()
 
 def main():
     arg_parser = argparse.ArgumentParser()
     arg_parser.add_argument('-p', '--port', type=int, 
         help='specify the port proxy server listens on')
+    arg_parser.add_argument('--listen', action='append', default=[],
+        type=parse_listen, metavar='ADDRESS[,OPTION=VALUE...]',
+        help='accept clients on HOST:PORT, [IPV6]:PORT or unix:PATH '
+             'instead of --port and --local, with options profile=NAME, '
+             'backlog=N, mode=OCTAL for Unix sockets and auth=off; may be '
+             'given multiple times')
     arg_parser.add_argument('-c', '--concurrency', type=int,
-        help='max concurrent connections server will accept')
+        help='max concurrent connections server will accept, per worker '
+             'process, and listen backlog. Unlimited by default, with a '
+             'backlog of {}'.format(DEFAULT_BACKLOG))
+    arg_parser.add_argument('--max-per-ip', type=int,
+        help='max concurrent connections accepted from one client '
+             'IP address. Unlimited by default')
+    arg_parser.add_argument('--admission-policy', choices=ADMISSION_POLICIES,
+        default='reset',
+        help='how connections over the limits are handled: reset them, '
+             'queue them until a slot frees up or reply X\'02\' to their '
+             'CONNECT request. Default to reset')
+    arg_parser.add_argument('--admission-queue-timeout', type=float,
+        default=DEFAULT_QUEUE_TIMEOUT,
+        help='seconds a queued connection waits for a slot before it is '
+             'reset. Default to {}'.format(DEFAULT_QUEUE_TIMEOUT))
     arg_parser.add_argument('-l', '--local', action='store_true',
         help='running server on localhost')
+    arg_parser.add_argument('--write-buffer-high', type=int,
+        help='bytes buffered per connection leg before reading from '
+             'its peer is paused. Default to {}'.format(
+                 DEFAULT_WRITE_BUFFER_HIGH))
+    arg_parser.add_argument('--write-buffer-low', type=int,
+        help='bytes buffered per connection leg below which reading from '
+             'its peer is resumed. Default to {}'.format(
+                 DEFAULT_WRITE_BUFFER_LOW))
+    arg_parser.add_argument('--relay', choices=RELAY_ENGINES,
+        default='protocol',
+        help='engine relaying data of established tunnels. "splice" moves '
+             'data kernel-to-kernel where os.splice is available, "fair" '
+             'relays large reads round-robin in quanta. Default to protocol')
+    arg_parser.add_argument('--relay-quantum', type=int,
+        default=DEFAULT_QUANTUM,
+        help='bytes a tunnel relays per callback with --relay fair. '
+             'Default to {}'.format(DEFAULT_QUANTUM))
+    arg_parser.add_argument('-w', '--workers', type=int, default=1,
+        help='number of worker processes sharing the listening port '
+             'through SO_REUSEPORT. Default to 1')
+    arg_parser.add_argument('--dns-ttl', type=int,
+        default=DEFAULT_POSITIVE_TTL,
+        help='seconds a resolved domain name is cached. Default to {}'.format(
+            DEFAULT_POSITIVE_TTL))
+    arg_parser.add_argument('--dns-negative-ttl', type=int,
+        default=DEFAULT_NEGATIVE_TTL,
+        help='seconds a failed domain name lookup is cached. '
+             'Default to {}'.format(DEFAULT_NEGATIVE_TTL))
+    arg_parser.add_argument('--dns-concurrency', type=int,
+        default=DEFAULT_MAX_CONCURRENT_LOOKUPS,
+        help='max domain name lookups in flight. Default to {}'.format(
+            DEFAULT_MAX_CONCURRENT_LOOKUPS))
+    arg_parser.add_argument('--connect-attempt-delay', type=float,
+        default=DEFAULT_ATTEMPT_DELAY,
+        help='seconds between parallel connection attempts to addresses '
+             'of a remote host. Default to {}'.format(DEFAULT_ATTEMPT_DELAY))
+    arg_parser.add_argument('--connect-timeout', type=float,
+        default=DEFAULT_CONNECT_TIMEOUT,
+        help='seconds allowed for resolving and connecting to a remote '
+             'host. Default to {}'.format(DEFAULT_CONNECT_TIMEOUT))
+    arg_parser.add_argument('--auth-file',
+        help='require RFC 1929 username/password authentication against '
+             'users in this file, reloaded when it changes')
+    arg_parser.add_argument('--auth-format', choices=sorted(CREDENTIAL_STORES),
+        default='htpasswd',
+        help='format of --auth-file: htpasswd hashes or plain '
+             'username:password lines. Default to htpasswd')
+    arg_parser.add_argument('--auth-cache-ttl', type=float,
+        default=DEFAULT_CACHE_TTL,
+        help='seconds a verified password is accepted without checking '
+             'its hash again. Default to {}'.format(DEFAULT_CACHE_TTL))
+    arg_parser.add_argument('--acl-file',
+        help='allow or deny destinations by the rules in this file, '
+             'reloaded when it changes')
+    arg_parser.add_argument('--handshake-timeout', type=float,
+        default=DEFAULT_HANDSHAKE_TIMEOUT,
+        help='seconds from client connect to the CONNECT reply before the '
+             'connection is closed, 0 to disable. Default to {}'.format(
+                 DEFAULT_HANDSHAKE_TIMEOUT))
+    arg_parser.add_argument('--idle-timeout', type=float,
+        default=DEFAULT_IDLE_TIMEOUT,
+        help='seconds a tunnel may relay nothing in either direction before '
+             'it is closed, 0 to disable. Default to {}'.format(
+                 DEFAULT_IDLE_TIMEOUT))
+    arg_parser.add_argument('--max-lifetime', type=float, default=0,
+        help='seconds after which a tunnel is closed regardless of '
+             'activity. Disabled by default')
+    arg_parser.add_argument('--upstream', type=parse_upstream,
+        metavar='[USER:PASSWORD@]HOST:PORT',
+        help='forward CONNECT requests to this upstream SOCKS5 server '
+             'instead of connecting to remote hosts')
+    arg_parser.add_argument('--upstream-mux', type=int, default=0,
+        metavar='CONNECTIONS',
+        help='multiplex tunnels over this many long-lived connections to '
+             'an --upstream asocks node run with --accept-mux. Disabled '
+             'by default')
+    arg_parser.add_argument('--accept-mux', action='store_true',
+        help='let clients open sessions of multiplexed tunnels with '
+             'method X\'81\'')
+    arg_parser.add_argument('--no-udp-associate', dest='udp_associate',
+        action='store_false',
+        help='answer UDP ASSOCIATE requests with X\'07\' instead of '
+             'relaying datagrams')
+    arg_parser.add_argument('--udp-mapping-timeout', type=float,
+        default=DEFAULT_MAPPING_TIMEOUT,
+        help='seconds datagrams from a remote address are relayed to a UDP '
+             'client after it last sent to that address. Default to {}'.format(
+                 DEFAULT_MAPPING_TIMEOUT))
+    arg_parser.add_argument('--socket-profile', default='default',
+        metavar='NAME',
+        help='socket option profile applied to client connections: '
+             'default, interactive, bulk or one defined with '
+             '--socket-option. Default to default')
+    arg_parser.add_argument('--socket-option', action='append', default=[],
+        type=parse_socket_option, metavar='PROFILE.OPTION=VALUE',
+        help='set an option of a socket profile, defining the profile '
+             'when new. OPTION is one of nodelay, rcvbuf, sndbuf, '
+             'keepalive_idle, keepalive_interval, keepalive_count, '
+             'notsent_lowat, congestion; may be given multiple times')
+    arg_parser.add_argument('--rate-limit', action='append', default=[],
+        type=parse_rate_limit, metavar='SCOPE=RATE',
+        help='limit bytes per second relayed in each direction by every '
+             'connection, client IP address, user or the whole server, '
+             'SCOPE being one of {}. RATE takes a K, M or G suffix; may '
+             'be given multiple times'.format(', '.join(SCOPES)))
+    arg_parser.add_argument('--drain-timeout', type=float,
+        default=DEFAULT_DRAIN_TIMEOUT,
+        help='seconds open tunnels are given to finish on SIGTERM before '
+             'they are closed. Default to {}'.format(DEFAULT_DRAIN_TIMEOUT))
+    arg_parser.add_argument('--handoff-socket', metavar='PATH',
+        help='hand the listening sockets over to a server started with '
+             'the same PATH through this Unix socket, taking them over from '
+             'a server listening on it at startup')
+    arg_parser.add_argument('--optimistic-data', action='store_true',
+        help='accept greeting, CONNECT request and first payload in one '
+             'flight from clients offering method X\'80\'')
+    arg_parser.add_argument('--pool-dest', action='append', default=[],
+        type=parse_destination, metavar='HOST:PORT',
+        help='keep pre-established connections to this destination; '
+             'may be given multiple times')
+    arg_parser.add_argument('--pool-size', type=int, default=DEFAULT_POOL_SIZE,
+        help='idle connections kept per pooled destination. '
+             'Default to {}'.format(DEFAULT_POOL_SIZE))
+    arg_parser.add_argument('--pool-idle-timeout', type=float,
+        default=DEFAULT_POOL_IDLE_TIMEOUT,
+        help='seconds an idle pooled connection is kept. '
+             'Default to {}'.format(DEFAULT_POOL_IDLE_TIMEOUT))
+    arg_parser.add_argument('--metrics-port', type=int,
+        help='serve Prometheus metrics over HTTP on this port')
+    arg_parser.add_argument('--metrics-addr', default='127.0.0.1',
+        help='address metrics are served on. Default to 127.0.0.1')
+    arg_parser.add_argument('--log-level', choices=LOG_LEVELS, default='INFO',
+        help='minimum level of logged messages. Default to INFO')
+    arg_parser.add_argument('--log-sample-rate', type=float, default=1.0,
+        help='share of client connections whose INFO and DEBUG messages '
+             'are logged. Default to 1.0')
+    arg_parser.add_argument('--loop', choices=EVENT_LOOPS, default='asyncio',
+        help='event loop implementation; uvloop falls back to asyncio when '
+             'not installed. Default to asyncio')
     args = arg_parser.parse_args()
     
     proxy_port = args.port or 1080
-    concurrency = args.concurrency or 256
+    if args.listen and (args.port or args.local):
+        arg_parser.error('--listen replaces --port and --local')
     addr = '127.0.0.1' if args.local else '0.0.0.0'
+    write_buffer_high = args.write_buffer_high or DEFAULT_WRITE_BUFFER_HIGH
+    write_buffer_low = args.write_buffer_low or min(
+        DEFAULT_WRITE_BUFFER_LOW, write_buffer_high)
+    if write_buffer_low > write_buffer_high:
+        arg_parser.error('--write-buffer-low must not exceed '
+                         '--write-buffer-high')
+    if args.concurrency is not None and args.concurrency < 1:
+        arg_parser.error('--concurrency must be at least 1')
+    if args.max_per_ip is not None and args.max_per_ip < 1:
+        arg_parser.error('--max-per-ip must be at least 1')
+    if args.auth_file and not os.path.isfile(args.auth_file):
+        arg_parser.error('--auth-file {} does not exist'.format(
+            args.auth_file))
+    socket_profiles = build_profiles(args.socket_option)
+    if args.socket_profile not in socket_profiles:
+        arg_parser.error('unknown --socket-profile {}'.format(
+            args.socket_profile))
+    listeners = args.listen or [Listener(addr, proxy_port)]
+    for listener in listeners:
+        if (listener.profile is not None and
+                listener.profile not in socket_profiles):
+            arg_parser.error('unknown socket profile {} of listener '
+                             '{}'.format(listener.profile, listener))
+        if listener.unix and args.workers > 1:
+            arg_parser.error('Unix socket listener {} requires a single '
+                             'worker'.format(listener))
+    if args.acl_file:
+        try:
+            ruleset = Ruleset.from_file(args.acl_file)
+        except (OSError, InvalidRuleset) as exc:
+            arg_parser.error('--acl-file: {}'.format(exc))
+        unknown = ruleset.profiles.difference(socket_profiles)
+        if unknown:
+            arg_parser.error('--acl-file: unknown socket profile {}'.format(
+                ', '.join(sorted(unknown))))
+    if args.upstream_mux < 0:
+        arg_parser.error('--upstream-mux must not be negative')
+    if args.upstream_mux and not args.upstream:
+        arg_parser.error('--upstream-mux requires --upstream')
+    if args.udp_mapping_timeout <= 0:
+        arg_parser.error('--udp-mapping-timeout must be positive')
+    if args.relay_quantum < 1:
+        arg_parser.error('--relay-quantum must be at least 1')
+    if args.rate_limit and args.relay == 'splice':
+        arg_parser.error('--rate-limit requires --relay protocol or fair')
+    if args.drain_timeout < 0:
+        arg_parser.error('--drain-timeout must not be negative')
+    if args.handoff_socket and args.workers > 1:
+        arg_parser.error('--handoff-socket requires a single worker')
+    if args.workers < 1:
+        arg_parser.error('--workers must be at least 1')
+    if args.workers > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+        arg_parser.error('--workers requires SO_REUSEPORT support')
     
-    kwargs = {'addr': addr,
-              'port': proxy_port,
-              'concurrency': concurrency}
-    start_serve(**kwargs)
+    kwargs = {'listeners': listeners,
+              'concurrency': args.concurrency,
+              'backlog': args.concurrency or DEFAULT_BACKLOG,
+              'max_per_ip': args.max_per_ip,
+              'admission_policy': args.admission_policy,
+              'admission_queue_timeout': args.admission_queue_timeout,
+              'write_buffer_high': write_buffer_high,
+              'write_buffer_low': write_buffer_low,
+              'relay_engine': args.relay,
+              'relay_quantum': args.relay_quantum,
+              'workers': args.workers,
+              'dns_ttl': args.dns_ttl,
+              'dns_negative_ttl': args.dns_negative_ttl,
+              'dns_concurrency': args.dns_concurrency,
+              'connect_attempt_delay': args.connect_attempt_delay,
+              'connect_timeout': args.connect_timeout,
+              'auth_file': args.auth_file,
+              'auth_format': args.auth_format,
+              'auth_cache_ttl': args.auth_cache_ttl,
+              'acl_file': args.acl_file,
+              'handshake_timeout': args.handshake_timeout,
+              'idle_timeout': args.idle_timeout,
+              'max_lifetime': args.max_lifetime,
+              'upstream': args.upstream,
+              'upstream_mux': args.upstream_mux,
+              'accept_mux': args.accept_mux,
+              'udp_associate': args.udp_associate,
+              'udp_mapping_timeout': args.udp_mapping_timeout,
+              'socket_profile': args.socket_profile,
+              'socket_profiles': socket_profiles,
+              'rate_limits': dict(args.rate_limit),
+              'drain_timeout': args.drain_timeout,
+              'handoff_socket': args.handoff_socket,
+              'optimistic_data': args.optimistic_data,
+              'pool_destinations': args.pool_dest,
+              'pool_size': args.pool_size,
+              'pool_idle_timeout': args.pool_idle_timeout,
+              'metrics_port': args.metrics_port,
+              'metrics_addr': args.metrics_addr,
+              'log_level': args.log_level,
+              'log_sample_rate': args.log_sample_rate,
+              'event_loop': args.loop}
+    if not 0 <= args.log_sample_rate <= 1:
+        arg_parser.error('--log-sample-rate must be between 0 and 1')
+    if args.workers > 1:
+        # Supervisor is not running an event loop, workers set up their
+        # own logging pipeline after fork.
+        setup_logging(args.log_level, use_queue=False)
+        WorkerSupervisor(args.workers, start_serve, **kwargs).run()
+    else:
+        start_serve(**kwargs)
 
 if __name__ == '__main__':
     main()
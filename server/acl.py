@@ -0,0 +1,414 @@
+"""Destination access control list.
+
+Rules are read from a file, one per line, '#' starting a comment:
+
+  ACTION DESTINATION [PORTS] [profile=NAME]
+
+ACTION is allow or deny. DESTINATION is an IPv4 or IPv6 address or CIDR
+network, a domain name matching itself and all its subdomains, or '*'
+matching any destination. PORTS is a comma separated list of ports and
+port ranges like 80,443,8000-8100, any port when omitted. profile names
+the socket option profile, see server.sockopts, applied to both legs of
+tunnels an allow rule lets through.
+
+The most specific destination wins: the longest matching network or
+domain suffix, then '*'. Among rules for the same destination the first
+one in the file whose ports match wins. Destinations no rule matches are
+denied. Domain names no domain rule matches are checked by the addresses
+they resolve to.
+"""
+import os
+import socket
+import asyncio
+import logging
+
+from exception import InvalidRuleset
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RELOAD_INTERVAL = 5.0
+
+class Rule:
+
+    __slots__ = ('allow', 'destination', 'ports', 'lineno', 'profile')
+
+    def __init__(self, allow, destination, ports=None, lineno=None,
+                 profile=None):
+        self.allow = allow
+        self.destination = destination
+        # (first, last) port ranges, None for any port.
+        self.ports = ports
+        self.lineno = lineno
+        # Name of the socket option profile of tunnels allowed.
+        self.profile = profile
+
+    def matches_port(self, port):
+        if self.ports is None:
+            return True
+        for first, last in self.ports:
+            if first <= port <= last:
+                return True
+        return False
+
+    def __repr__(self):
+        return '<Rule {} {} line {}>'.format(
+            'allow' if self.allow else 'deny', self.destination, self.lineno)
+
+# Decision when no rule matches.
+DEFAULT_DENY = Rule(False, 'default')
+
+def _first_for_port(rules, port):
+    for rule in rules:
+        if rule.matches_port(port):
+            return rule
+    return None
+
+class _PrefixNode:
+
+    __slots__ = ('key', 'length', 'children', 'rules')
+
+    def __init__(self, key, length, rules=None):
+        self.key = key
+        self.length = length
+        self.children = [None, None]
+        self.rules = rules
+
+class PrefixTree:
+    """Path-compressed binary radix tree of network prefixes.
+
+    Nodes only exist for prefixes holding rules and for branch points,
+    so a lookup visits at most width nodes whatever the number of rules.
+    """
+
+    def __init__(self, width):
+        self.width = width
+        self._root = _PrefixNode(0, 0)
+
+    def _bit(self, key, index):
+        return (key >> (self.width - 1 - index)) & 1
+
+    def insert(self, key, length, rule):
+        node = self._root
+        while True:
+            if length == node.length:
+                if node.rules is None:
+                    node.rules = []
+                node.rules.append(rule)
+                return
+
+            bit = self._bit(key, node.length)
+            child = node.children[bit]
+            if child is None:
+                node.children[bit] = _PrefixNode(key, length, [rule])
+                return
+
+            common = min(length, child.length,
+                         self.width - (key ^ child.key).bit_length())
+            if common == child.length:
+                node = child
+                continue
+
+            # Key and child diverge below child: insert a branch node.
+            mask = ((1 << common) - 1) << (self.width - common)
+            branch = _PrefixNode(key & mask, common)
+            node.children[bit] = branch
+            branch.children[self._bit(child.key, common)] = child
+            if common == length:
+                branch.rules = [rule]
+            else:
+                branch.children[self._bit(key, common)] = _PrefixNode(
+                    key, length, [rule])
+            return
+
+    def lookup(self, key):
+        """Return rule lists of prefixes containing key, longest last."""
+        matches = []
+        node = self._root
+        while node is not None:
+            if node.length and (key ^ node.key) >> (self.width - node.length):
+                break
+            if node.rules:
+                matches.append(node.rules)
+            if node.length == self.width:
+                break
+            node = node.children[self._bit(key, node.length)]
+        return matches
+
+class _DomainNode:
+
+    __slots__ = ('children', 'rules')
+
+    def __init__(self):
+        self.children = {}
+        self.rules = None
+
+class DomainTree:
+    """Trie of domain names keyed by labels from the top-level domain."""
+
+    def __init__(self):
+        self._root = _DomainNode()
+
+    def insert(self, domain, rule):
+        node = self._root
+        for label in reversed(domain.split('.')):
+            child = node.children.get(label)
+            if child is None:
+                child = node.children[label] = _DomainNode()
+            node = child
+        if node.rules is None:
+            node.rules = []
+        node.rules.append(rule)
+
+    def lookup(self, domain):
+        """Return rule lists of suffixes of domain, longest last."""
+        matches = []
+        node = self._root
+        for label in reversed(domain.split('.')):
+            node = node.children.get(label)
+            if node is None:
+                break
+            if node.rules:
+                matches.append(node.rules)
+        return matches
+
+def _parse_ports(value):
+    ports = []
+    for part in value.split(','):
+        first, sep, last = part.partition('-')
+        if not first.isdigit() or (sep and not last.isdigit()):
+            raise ValueError('invalid port {!r}'.format(part))
+        first = int(first)
+        last = int(last) if sep else first
+        if not 0 < first <= last <= 65535:
+            raise ValueError('invalid port range {!r}'.format(part))
+        ports.append((first, last))
+    return tuple(ports)
+
+def _parse_network(value):
+    """Return (family, key, prefix length) of an address or CIDR network,
+    or None when value is not one."""
+    address, sep, length = value.partition('/')
+    for family, width in ((socket.AF_INET, 32), (socket.AF_INET6, 128)):
+        try:
+            packed = socket.inet_pton(family, address)
+        except (OSError, ValueError):
+            continue
+        if not sep:
+            length = width
+        elif length.isdigit() and int(length) <= width:
+            length = int(length)
+        else:
+            raise ValueError('invalid prefix length {!r}'.format(value))
+        key = int.from_bytes(packed, 'big')
+        if key & ((1 << (width - length)) - 1):
+            raise ValueError('host bits set in {!r}'.format(value))
+        return family, key, length
+    return None
+
+class Ruleset:
+    """Rules compiled into prefix trees and a domain tree."""
+
+    def __init__(self, rules=()):
+        self._networks = {socket.AF_INET: PrefixTree(32),
+                          socket.AF_INET6: PrefixTree(128)}
+        self._domains = DomainTree()
+        self._any = []
+        self.count = 0
+        # Socket option profiles named by rules.
+        self.profiles = set()
+        for rule in rules:
+            self.add(rule)
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path) as lines:
+            return cls.parse(lines, path)
+
+    @classmethod
+    def parse(cls, lines, source='<rules>'):
+        ruleset = cls()
+        for lineno, line in enumerate(lines, 1):
+            fields = line.split('#', 1)[0].split()
+            if not fields:
+                continue
+            try:
+                options = {}
+                while len(fields) > 2 and '=' in fields[-1]:
+                    key, _, value = fields.pop().partition('=')
+                    if key != 'profile' or not value:
+                        raise ValueError('invalid option {!r}'.format(
+                            key + '=' + value))
+                    options[key] = value
+                if len(fields) not in (2, 3):
+                    raise ValueError('expected ACTION DESTINATION [PORTS] '
+                                     '[profile=NAME]')
+                action = fields[0].lower()
+                if action not in ('allow', 'deny'):
+                    raise ValueError('unknown action {!r}'.format(fields[0]))
+                ports = _parse_ports(fields[2]) if len(fields) == 3 else None
+                ruleset.add(Rule(action == 'allow', fields[1], ports, lineno,
+                                 options.get('profile')))
+            except ValueError as exc:
+                raise InvalidRuleset('{}:{}: {}'.format(source, lineno, exc))
+        return ruleset
+
+    def add(self, rule):
+        destination = rule.destination
+        if destination == '*':
+            self._any.append(rule)
+        else:
+            network = _parse_network(destination)
+            if network is not None:
+                family, key, length = network
+                self._networks[family].insert(key, length, rule)
+            else:
+                domain = destination.strip('.').lower()
+                if not domain or '/' in domain:
+                    raise ValueError('invalid destination {!r}'.format(
+                        destination))
+                self._domains.insert(domain, rule)
+        self.count += 1
+        if rule.profile is not None:
+            self.profiles.add(rule.profile)
+
+    def _most_specific(self, matches, port):
+        for rules in reversed(matches):
+            rule = _first_for_port(rules, port)
+            if rule is not None:
+                return rule
+        return _first_for_port(self._any, port) or DEFAULT_DENY
+
+    def match_address(self, address, port):
+        """Return the rule deciding connections to IP address:port."""
+        for family in (socket.AF_INET, socket.AF_INET6):
+            try:
+                packed = socket.inet_pton(family, address)
+            except (OSError, ValueError):
+                continue
+            matches = self._networks[family].lookup(
+                int.from_bytes(packed, 'big'))
+            return self._most_specific(matches, port)
+        raise ValueError('not an IP address: {!r}'.format(address))
+
+    def match_domain(self, domain, port):
+        """Return the rule of the longest suffix of domain for port, None
+        when no domain rule matches."""
+        matches = self._domains.lookup(domain.rstrip('.').lower())
+        for rules in reversed(matches):
+            rule = _first_for_port(rules, port)
+            if rule is not None:
+                return rule
+        return None
+
+class AccessList:
+    """Ruleset of a file, recompiled and swapped in when the file changes.
+
+    Files are recompiled in the default executor so large rulesets do not
+    stall the event loop; connections see either the old or the new
+    ruleset as a whole.
+    """
+
+    def __init__(self, loop, path, reload_interval=DEFAULT_RELOAD_INTERVAL):
+        self._loop = loop
+        self.path = path
+        self.reload_interval = reload_interval
+        self.ruleset = None
+        self._file_stamp = None
+        self._reload_handle = None
+        self._reloading = None
+
+        self.allowed = 0
+        self.denied = 0
+        self.reloads = 0
+
+    def start(self):
+        """Compile the file, raising OSError or InvalidRuleset."""
+        self._file_stamp = self._stamp()
+        self.ruleset = Ruleset.from_file(self.path)
+        logger.info('Loaded {} access rules from {}.'.format(
+            self.ruleset.count, self.path))
+        self._schedule_reload()
+
+    def close(self):
+        if self._reload_handle is not None:
+            self._reload_handle.cancel()
+            self._reload_handle = None
+        if self._reloading is not None:
+            self._reloading.cancel()
+
+    def stats(self):
+        return {'rules': self.ruleset.count if self.ruleset else 0,
+                'allowed': self.allowed,
+                'denied': self.denied,
+                'reloads': self.reloads}
+
+    def _stamp(self):
+        stat = os.stat(self.path)
+        return stat.st_mtime, stat.st_size, stat.st_ino
+
+    def _schedule_reload(self):
+        self._reload_handle = self._loop.call_later(
+            self.reload_interval, self._reload_if_changed)
+
+    def _reload_if_changed(self):
+        self._reload_handle = None
+        try:
+            stamp = self._stamp()
+        except OSError as exc:
+            logger.error('Checking access rules failed: {}'.format(exc))
+            self._schedule_reload()
+            return
+        if stamp == self._file_stamp:
+            self._schedule_reload()
+            return
+        self._reloading = self._loop.create_task(self._reload(stamp))
+
+    @asyncio.coroutine
+    def _reload(self, stamp):
+        try:
+            ruleset = yield from self._loop.run_in_executor(
+                None, Ruleset.from_file, self.path)
+        except (OSError, InvalidRuleset) as exc:
+            logger.error('Reloading access rules failed, keeping rules '
+                         'loaded before: {}'.format(exc))
+        else:
+            self.ruleset = ruleset
+            self.reloads += 1
+            logger.info('Reloaded {} access rules from {}.'.format(
+                ruleset.count, self.path))
+        # A broken file is not retried until it changes again.
+        self._file_stamp = stamp
+        self._reloading = None
+        self._schedule_reload()
+
+    def _decided(self, rule):
+        if rule.allow:
+            self.allowed += 1
+        else:
+            self.denied += 1
+        return rule
+
+    def match(self, host, port):
+        """Return the rule deciding connections to host:port, None when
+        host is a domain name decided by its addresses, see filter()."""
+        ruleset = self.ruleset
+        try:
+            return self._decided(ruleset.match_address(host, port))
+        except ValueError:
+            pass
+        rule = ruleset.match_domain(host, port)
+        return self._decided(rule) if rule is not None else None
+
+    def filter(self, addr_infos, port):
+        """Return getaddrinfo() results allowed to be connected to, along
+        with the rule allowing the first of them."""
+        ruleset = self.ruleset
+        allowed = []
+        allowing_rule = None
+        for info in addr_infos:
+            rule = ruleset.match_address(info[4][0], port)
+            if rule.allow:
+                allowed.append(info)
+                allowing_rule = allowing_rule or rule
+        self._decided(allowing_rule or DEFAULT_DENY)
+        return allowed, allowing_rule
@@ -0,0 +1,116 @@
+import asyncio
+from collections import deque
+
+# What happens to a connection over the limits:
+#   reset - closed at once with a TCP RST
+#   queue - held unread until a slot frees up, reset after queue_timeout
+#   reply - handshake proceeds and CONNECT is answered with X'02'
+ADMISSION_POLICIES = ('reset', 'queue', 'reply')
+DEFAULT_QUEUE_TIMEOUT = 5.0
+
+class AdmissionController:
+    """Limits active tunnels globally and per client IP address.
+
+    Either limit may be None for no limit.
+    """
+
+    def __init__(self, loop, max_connections, max_per_ip=None,
+                 policy='reset', queue_timeout=DEFAULT_QUEUE_TIMEOUT):
+        self._loop = loop
+        self.max_connections = max_connections
+        self.max_per_ip = max_per_ip
+        self.policy = policy
+        self.queue_timeout = queue_timeout
+
+        self.active = 0
+        self._per_ip = {}
+        self._waiters = deque() # (future, client ip)
+
+        self.shed_global = 0
+        self.shed_per_ip = 0
+        self.shed_queue_timeout = 0
+
+    def stats(self):
+        return {'active': self.active,
+                'queued': len(self._waiters),
+                'shed_global': self.shed_global,
+                'shed_per_ip': self.shed_per_ip,
+                'shed_queue_timeout': self.shed_queue_timeout}
+
+    def _full(self):
+        return (self.max_connections is not None and
+                self.active >= self.max_connections)
+
+    def _fits(self, ip):
+        if self._full():
+            return False
+        if self.max_per_ip and self._per_ip.get(ip, 0) >= self.max_per_ip:
+            return False
+        return True
+
+    def _take(self, ip):
+        self.active += 1
+        self._per_ip[ip] = self._per_ip.get(ip, 0) + 1
+
+    def try_admit(self, ip):
+        """Take a slot for a connection from ip if limits allow.
+
+        Refusals are counted as shed; with the queue policy the caller is
+        expected to wait_admit() next and the count is deferred.
+        """
+        if self._fits(ip):
+            self._take(ip)
+            return True
+        if self.policy != 'queue':
+            self._count_shed(ip)
+        return False
+
+    def _count_shed(self, ip):
+        if self._full():
+            self.shed_global += 1
+        else:
+            self.shed_per_ip += 1
+
+    @asyncio.coroutine
+    def wait_admit(self, ip):
+        """Wait up to queue_timeout for a slot; return whether one was taken."""
+        waiter = asyncio.Future()
+        entry = (waiter, ip)
+        self._waiters.append(entry)
+        try:
+            yield from asyncio.wait_for(asyncio.shield(waiter),
+                                        self.queue_timeout)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            if waiter.done():
+                self.release(ip)
+            else:
+                self._waiters.remove(entry)
+            raise
+
+        if waiter.done():
+            return True
+        self._waiters.remove(entry)
+        self.shed_queue_timeout += 1
+        return False
+
+    def release(self, ip):
+        self.active -= 1
+        count = self._per_ip[ip] - 1
+        if count:
+            self._per_ip[ip] = count
+        else:
+            del self._per_ip[ip]
+        self._wake_waiters()
+
+    def _wake_waiters(self):
+        for entry in list(self._waiters):
+            waiter, ip = entry
+            if self._full():
+                break
+            if waiter.done() or not self._fits(ip):
+                continue
+            self._waiters.remove(entry)
+            self._take(ip)
+            waiter.set_result(True)
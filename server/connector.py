@@ -0,0 +1,118 @@
+import sys
+import errno
+import socket
+import asyncio
+import itertools
+
+# RFC 8305 recommends 250ms between connection attempts.
+DEFAULT_ATTEMPT_DELAY = 0.25
+DEFAULT_CONNECT_TIMEOUT = 10.0
+
+# Linux 4.11+: connect() returns at once and the SYN is sent along with
+# the first write, carrying its data once a TFO cookie is cached. The
+# socket module does not define it, and 30 is its value on Linux only;
+# elsewhere fast open is left off.
+TCP_FASTOPEN_CONNECT = getattr(
+    socket, 'TCP_FASTOPEN_CONNECT',
+    30 if sys.platform.startswith('linux') else None)
+
+def interleave_addr_infos(addr_infos):
+    """Alternate address families, starting with the first one returned.
+
+    See RFC 8305 section 4.
+    """
+    by_family = {}
+    families = []
+    for addr_info in addr_infos:
+        family = addr_info[0]
+        if family not in by_family:
+            by_family[family] = []
+            families.append(family)
+        by_family[family].append(addr_info)
+
+    interleaved = []
+    for group in itertools.zip_longest(*[by_family[f] for f in families]):
+        interleaved.extend(addr_info for addr_info in group if addr_info)
+    return interleaved
+
+@asyncio.coroutine
+def _attempt(loop, addr_info, fast_open=False):
+    family, type_, proto, canonname, sockaddr = addr_info
+    sock = socket.socket(family, type_, proto)
+    try:
+        sock.setblocking(False)
+        if fast_open and TCP_FASTOPEN_CONNECT is not None:
+            try:
+                sock.setsockopt(socket.IPPROTO_TCP, TCP_FASTOPEN_CONNECT, 1)
+            except OSError:
+                pass # kernel without client side TFO
+        yield from loop.sock_connect(sock, sockaddr)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+@asyncio.coroutine
+def _first_connected(loop, attempts, timeout, errors):
+    """Wait up to timeout for one of attempts to succeed.
+
+    Returns the connected socket, or None when timeout elapsed or every
+    attempt failed. Failed attempts are removed from attempts and their
+    exceptions appended to errors.
+    """
+    deadline = None if timeout is None else loop.time() + timeout
+    while attempts:
+        remaining = None if deadline is None else deadline - loop.time()
+        if remaining is not None and remaining <= 0:
+            return None
+
+        done, _ = yield from asyncio.wait(
+            attempts, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+        winner = None
+        for attempt in done:
+            attempts.discard(attempt)
+            if attempt.exception() is not None:
+                errors.append(attempt.exception())
+            elif winner is None:
+                winner = attempt.result()
+            else:
+                attempt.result().close()
+        if winner is not None:
+            return winner
+    return None
+
+@asyncio.coroutine
+def staggered_connect(loop, addr_infos, attempt_delay=DEFAULT_ATTEMPT_DELAY,
+                      fast_open=False):
+    """Connect to the first reachable of addr_infos, Happy Eyeballs style.
+
+    A new attempt is started every attempt_delay seconds, or as soon as
+    all running attempts have failed, while earlier attempts keep going.
+    Returns a connected non-blocking socket; raises the last connect error
+    when no address is reachable. With fast_open, TCP Fast Open is
+    requested where supported; connecting then completes before the
+    handshake and errors only surface once data is written.
+    """
+    attempts = set()
+    errors = []
+    try:
+        for addr_info in interleave_addr_infos(addr_infos):
+            attempts.add(loop.create_task(_attempt(loop, addr_info, fast_open)))
+            sock = yield from _first_connected(
+                loop, attempts, attempt_delay, errors)
+            if sock is not None:
+                return sock
+
+        sock = yield from _first_connected(loop, attempts, None, errors)
+        if sock is not None:
+            return sock
+    finally:
+        for attempt in attempts:
+            if not attempt.done():
+                attempt.cancel()
+            elif not attempt.cancelled() and attempt.exception() is None:
+                attempt.result().close()
+
+    if errors:
+        raise errors[-1]
+    raise OSError(errno.EHOSTUNREACH, 'No address to connect to')
@@ -0,0 +1,357 @@
+"""Credential stores verifying RFC 1929 username/password logins.
+
+Stores are loaded from a file of 'username:secret' lines, where '#'
+starts a comment line. The file is polled and reloaded when it changes,
+so users can be added or removed without restarting the server.
+"""
+import os
+import hmac
+import base64
+import asyncio
+import hashlib
+import logging
+
+try:
+    import bcrypt
+except ImportError:
+    bcrypt = None
+
+try:
+    # Deprecated since Python 3.11 and removed in 3.13.
+    import crypt
+except ImportError:
+    crypt = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_TTL = 300.0
+DEFAULT_RELOAD_INTERVAL = 5.0
+
+class CredentialStore:
+    """Users loaded from a file, reloaded when the file changes.
+
+    A successful verification is cached for cache_ttl seconds as a keyed
+    digest of the password, so a slow password hash is checked once per
+    user rather than once per connection. Slow hashes are checked in the
+    default executor, and concurrent logins of the same user with the
+    same password share one check. Unknown users are checked against a
+    dummy secret of the scheme the file uses, so a refusal takes as long
+    whether the user exists or not.
+    """
+
+    def __init__(self, loop, path, cache_ttl=DEFAULT_CACHE_TTL,
+                 reload_interval=DEFAULT_RELOAD_INTERVAL):
+        self._loop = loop
+        self.path = path
+        self.cache_ttl = cache_ttl
+        self.reload_interval = reload_interval
+        self._users = {} # username -> verifier, keyed by bytes
+        # Verifier of a random password unknown users are checked against.
+        self._dummy = None
+        self._file_stamp = None
+        self._reload_handle = None
+        self._reloading = None
+        # Digests are keyed per process, the cache holds no password.
+        self._cache_key = os.urandom(32)
+        self._cache = {} # username -> (expires_at, digest)
+        self._inflight = {} # (username, digest) -> check task
+
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+        self.reloads = 0
+
+    def start(self):
+        """Load the file, raising OSError when it cannot be read."""
+        self.load()
+        self._schedule_reload()
+
+    def close(self):
+        if self._reload_handle is not None:
+            self._reload_handle.cancel()
+            self._reload_handle = None
+        if self._reloading is not None:
+            self._reloading.cancel()
+
+    def stats(self):
+        return {'users': len(self._users),
+                'cache_hits': self.hits,
+                'cache_misses': self.misses,
+                'failures': self.failures,
+                'reloads': self.reloads}
+
+    def load(self):
+        """Load the file, blocking until the dummy secret is hashed."""
+        self._loaded(*self._read())
+
+    def _read(self):
+        """Parse the file and hash the dummy secret, return (users, dummy,
+        file stamp). Touches no state of the store, so it may run in an
+        executor."""
+        stat = os.stat(self.path)
+        users = {}
+        with open(self.path) as lines:
+            for lineno, line in enumerate(lines, 1):
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                username, sep, secret = line.partition(':')
+                if not sep or not username:
+                    logger.warning('{}:{}: expected username:secret, '
+                                   'skipped.'.format(self.path, lineno))
+                    continue
+                verifier = self._parse_secret(secret)
+                if verifier is None:
+                    logger.warning('{}:{}: unsupported secret of user {}, '
+                                   'skipped.'.format(self.path, lineno,
+                                                     username))
+                    continue
+                users[username.encode('utf-8')] = verifier
+
+        dummy = (self._dummy_verifier(next(iter(users.values())))
+                 if users else None)
+        return users, dummy, (stat.st_mtime, stat.st_size, stat.st_ino)
+
+    def _loaded(self, users, dummy, stamp):
+        self._users = users
+        self._dummy = dummy
+        self._file_stamp = stamp
+        # Changed passwords must not be accepted from the cache.
+        self._cache.clear()
+        logger.info('Loaded {} users from {}.'.format(len(users), self.path))
+
+    def _schedule_reload(self):
+        self._reload_handle = self._loop.call_later(
+            self.reload_interval, self._reload_if_changed)
+
+    def _reload_if_changed(self):
+        self._reload_handle = None
+        try:
+            stat = os.stat(self.path)
+        except OSError as exc:
+            logger.error('Reloading credentials failed, keeping {} users '
+                         'loaded before: {}'.format(len(self._users), exc))
+            self._schedule_reload()
+            return
+        if (stat.st_mtime, stat.st_size, stat.st_ino) == self._file_stamp:
+            self._schedule_reload()
+            return
+        # Hashing the dummy secret may take as long as a login, which
+        # must not stall the loop.
+        self._reloading = self._loop.create_task(self._reload())
+
+    @asyncio.coroutine
+    def _reload(self):
+        try:
+            loaded = yield from self._loop.run_in_executor(None, self._read)
+        except OSError as exc:
+            logger.error('Reloading credentials failed, keeping {} users '
+                         'loaded before: {}'.format(len(self._users), exc))
+        else:
+            self._loaded(*loaded)
+            self.reloads += 1
+        self._reloading = None
+        self._schedule_reload()
+
+    def _digest(self, password):
+        return hmac.new(self._cache_key, password, hashlib.sha256).digest()
+
+    def check(self, username, password):
+        """Verify username and password, both bytes, without blocking.
+
+        Returns True or False, or None when a slow hash has to be
+        checked by verify().
+        """
+        verifier = self._users.get(username)
+        if verifier is None:
+            if self._dummy is None:
+                self.failures += 1
+                return False
+            if self._is_slow(self._dummy):
+                return None
+            self.misses += 1
+            self._verify(self._dummy, password)
+            self.failures += 1
+            return False
+
+        cached = self._cache.get(username)
+        if cached is not None:
+            expires_at, digest = cached
+            if (expires_at > self._loop.time() and
+                    hmac.compare_digest(digest, self._digest(password))):
+                self.hits += 1
+                return True
+
+        if self._is_slow(verifier):
+            return None
+        self.misses += 1
+        return self._record(username, password,
+                            self._verify(verifier, password))
+
+    @asyncio.coroutine
+    def verify(self, username, password):
+        """Verify username and password, both bytes, return a bool."""
+        verified = self.check(username, password)
+        if verified is not None:
+            return verified
+
+        key = (username, self._digest(password))
+        check = self._inflight.get(key)
+        if check is None:
+            self.misses += 1
+            # The user may be gone since check(), the file reloaded.
+            known = username in self._users
+            verifier = self._users.get(username, self._dummy)
+            if verifier is None:
+                self.failures += 1
+                return False
+            check = self._loop.run_in_executor(
+                None, self._verify, verifier, password)
+            self._inflight[key] = check
+            try:
+                verified = yield from asyncio.shield(check)
+            finally:
+                del self._inflight[key]
+            return self._record(username, password, verified and known)
+        return (yield from asyncio.shield(check))
+
+    def _record(self, username, password, verified):
+        if not verified:
+            self.failures += 1
+        elif self.cache_ttl > 0:
+            self._cache[username] = (self._loop.time() + self.cache_ttl,
+                                     self._digest(password))
+        return verified
+
+    def _parse_secret(self, secret):
+        """Return what _verify() checks passwords against, None if the
+        secret is not supported."""
+        raise NotImplementedError
+
+    def _dummy_verifier(self, verifier):
+        """Return a verifier of a random password with the scheme and cost
+        of verifier."""
+        raise NotImplementedError
+
+    def _is_slow(self, verifier):
+        raise NotImplementedError
+
+    def _verify(self, verifier, password):
+        raise NotImplementedError
+
+class PlainCredentialStore(CredentialStore):
+    """File of 'username:password' lines with passwords in clear text."""
+
+    def _parse_secret(self, secret):
+        return secret.encode('utf-8')
+
+    def _dummy_verifier(self, verifier):
+        return os.urandom(len(verifier))
+
+    def _is_slow(self, verifier):
+        return False
+
+    def _verify(self, verifier, password):
+        return hmac.compare_digest(verifier, password)
+
+_ITOA64 = './0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+
+def _to64(value, length):
+    chars = []
+    for _ in range(length):
+        chars.append(_ITOA64[value & 0x3f])
+        value >>= 6
+    return ''.join(chars)
+
+def md5_crypt(password, salt, magic):
+    """MD5-based crypt of Apache ('$apr1$') and FreeBSD ('$1$')."""
+    magic_bytes = magic.encode('ascii')
+    salt_bytes = salt.encode('ascii')
+    context = hashlib.md5(password + magic_bytes + salt_bytes)
+    final = hashlib.md5(password + salt_bytes + password).digest()
+    for remaining in range(len(password), 0, -16):
+        context.update(final[:min(16, remaining)])
+    length = len(password)
+    while length:
+        context.update(b'\x00' if length & 1 else password[:1])
+        length >>= 1
+    final = context.digest()
+
+    for round_ in range(1000):
+        context = hashlib.md5(password if round_ & 1 else final)
+        if round_ % 3:
+            context.update(salt_bytes)
+        if round_ % 7:
+            context.update(password)
+        context.update(final if round_ & 1 else password)
+        final = context.digest()
+
+    encoded = ''.join(
+        _to64((final[a] << 16) | (final[b] << 8) | final[c], 4)
+        for a, b, c in ((0, 6, 12), (1, 7, 13), (2, 8, 14), (3, 9, 15),
+                        (4, 10, 5)))
+    encoded += _to64(final[11], 2)
+    return '{}{}${}'.format(magic, salt, encoded)
+
+class HtpasswdCredentialStore(CredentialStore):
+    """File of 'username:hash' lines as written by Apache htpasswd.
+
+    Supported hashes are {SHA}, MD5 ($apr1$, $1$), bcrypt ($2y$ and
+    friends) when the bcrypt package is installed, and SHA-256/512 crypt
+    ($5$, $6$) where the crypt module is available.
+    """
+
+    def _parse_secret(self, secret):
+        if secret.startswith('{SHA}'):
+            return secret
+        if secret.startswith(('$apr1$', '$1$')):
+            return secret if secret.count('$') == 3 else None
+        if secret.startswith(('$2a$', '$2b$', '$2y$')):
+            return secret if bcrypt is not None else None
+        if secret.startswith(('$5$', '$6$')):
+            return secret if crypt is not None else None
+        return None
+
+    def _dummy_verifier(self, verifier):
+        password = base64.b64encode(os.urandom(18))
+        if verifier.startswith('{SHA}'):
+            return '{SHA}' + base64.b64encode(
+                hashlib.sha1(password).digest()).decode('ascii')
+        if verifier.startswith('$2'):
+            # Salt and cost of verifier, the cost is what matters.
+            return bcrypt.hashpw(password,
+                                 verifier[:29].encode('ascii')).decode('ascii')
+        if verifier.startswith(('$5$', '$6$')):
+            # Rounds and salt of verifier. Where the platform crypt rejects
+            # them, checking against verifier itself costs the same, and
+            # unknown users are refused whatever the check returns.
+            return crypt.crypt(password.decode('ascii'), verifier) or verifier
+        _, magic, salt, _ = verifier.split('$')
+        return md5_crypt(password, salt, '${}$'.format(magic))
+
+    def _is_slow(self, verifier):
+        return not verifier.startswith('{SHA}')
+
+    def _verify(self, verifier, password):
+        if verifier.startswith('{SHA}'):
+            hashed = '{SHA}' + base64.b64encode(
+                hashlib.sha1(password).digest()).decode('ascii')
+        elif verifier.startswith('$2'):
+            return bcrypt.checkpw(password, verifier.encode('ascii'))
+        elif verifier.startswith(('$5$', '$6$')):
+            try:
+                hashed = crypt.crypt(password.decode('utf-8'), verifier)
+            except UnicodeDecodeError:
+                return False
+            if not hashed:
+                return False
+        else:
+            _, magic, salt, _ = verifier.split('$')
+            hashed = md5_crypt(password, salt, '${}$'.format(magic))
+        return hmac.compare_digest(hashed.encode('ascii'),
+                                   verifier.encode('ascii'))
+
+CREDENTIAL_STORES = {
+    'htpasswd': HtpasswdCredentialStore,
+    'plain': PlainCredentialStore,
+}
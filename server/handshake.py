@@ -0,0 +1,121 @@
+"""Incremental parsers for SOCKS5 handshake messages sent by clients.
+
+Each parser takes the bytes buffered so far and returns None while the
+message is incomplete, or the parsed fields along with the count of
+bytes the message occupies in the buffer.
+"""
+import socket
+import struct
+
+import auth
+from networking import SOCK_PROTOCOL_VERSION, AddressType
+from exception import InvalidRequest, WrongProtocol
+
+def parse_greeting(buffer):
+    """Parse VER | NMETHODS | METHODS.
+
+    Returns (method_codes, consumed) or None.
+    """
+    if len(buffer) < 2:
+        return None
+    if buffer[0] != SOCK_PROTOCOL_VERSION:
+        raise WrongProtocol
+    method_count = buffer[1]
+    if method_count == 0:
+        raise InvalidRequest
+    end = 2 + method_count
+    if len(buffer) < end:
+        return None
+    return bytes(buffer[2:end]), end
+
+def parse_auth_request(buffer):
+    """Parse VER | ULEN | UNAME | PLEN | PASSWD of RFC 1929.
+
+    Returns (username, password, consumed) or None.
+    """
+    if len(buffer) < 2:
+        return None
+    if buffer[0] != auth.UsernamePassword.version:
+        raise InvalidRequest
+    password_at = 2 + buffer[1]
+    if len(buffer) < password_at + 1:
+        return None
+    end = password_at + 1 + buffer[password_at]
+    if len(buffer) < end:
+        return None
+    return (bytes(buffer[2:password_at]), bytes(buffer[password_at + 1:end]),
+            end)
+
+def _parse_address(buffer):
+    """Parse ATYP | ADDR | PORT starting at offset 3 of buffer.
+
+    Returns (atype, host, port, end) or None, see parse_request().
+    """
+    atype = buffer[3]
+    if atype == AddressType.IPv4:
+        end = 4 + 4
+        if len(buffer) < end + 2:
+            return None
+        host = socket.inet_ntoa(bytes(buffer[4:end]))
+    elif atype == AddressType.IPv6:
+        end = 4 + 16
+        if len(buffer) < end + 2:
+            return None
+        host = socket.inet_ntop(socket.AF_INET6, bytes(buffer[4:end]))
+    elif atype == AddressType.DomainName:
+        end = 5 + buffer[4]
+        if len(buffer) < end + 2:
+            return None
+        try:
+            host = bytes(buffer[5:end]).decode('ascii')
+        except UnicodeDecodeError:
+            raise InvalidRequest
+    else:
+        return atype, None, None, 4
+
+    port = struct.unpack('>H', buffer[end:end+2])[0]
+    return atype, host, port, end + 2
+
+def parse_request(buffer):
+    """Parse VER | CMD | RSV | ATYP | DST.ADDR | DST.PORT.
+
+    Returns (cmd, atype, host, port, consumed) or None. host is None
+    when atype is not supported; consumed then covers the fixed header
+    only since the address length is unknown.
+    """
+    if len(buffer) < 5:
+        return None
+    if buffer[0] != SOCK_PROTOCOL_VERSION:
+        raise WrongProtocol
+
+    parsed = _parse_address(buffer)
+    if parsed is None:
+        return None
+    return (buffer[1],) + parsed
+
+def parse_udp_header(datagram):
+    """Parse RSV | FRAG | ATYP | DST.ADDR | DST.PORT heading a datagram
+    relayed through a UDP association.
+
+    Datagrams are never incomplete: returns (frag, host, port, consumed),
+    raising InvalidRequest when the header is truncated or its address
+    type is not supported.
+    """
+    if len(datagram) < 5:
+        raise InvalidRequest
+    parsed = _parse_address(datagram)
+    if parsed is None or parsed[1] is None:
+        raise InvalidRequest
+    _, host, port, consumed = parsed
+    return datagram[2], host, port, consumed
+
+def pack_address(host, port):
+    """Pack IP address host and port as ATYP | ADDR | PORT."""
+    host = host.split('%', 1)[0] # IPv6 scope id
+    try:
+        packed = socket.inet_pton(socket.AF_INET, host)
+        atype = AddressType.IPv4
+    except OSError:
+        packed = socket.inet_pton(socket.AF_INET6, host)
+        atype = AddressType.IPv6
+    return struct.pack('>B', atype) + packed + struct.pack('>H', port)
@@ -0,0 +1,221 @@
+"""Graceful shutdown and handing listening sockets to a new process.
+
+On SIGTERM the server stops accepting and drains: tunnels open are given
+up to a deadline to finish before the rest are closed. On SIGHUP it
+starts a copy of itself inheriting the listening sockets, their
+descriptors named by ASOCKS_LISTEN_FDS. A server started by other means,
+like a deploy tool, may instead ask the running one for the sockets over
+the Unix socket given by --handoff-socket and receive the descriptors as
+SCM_RIGHTS ancillary data. Sockets are tagged with the index of their
+listener, so the new process serves each with the settings of the
+listener configured in the same place. Either way the new process
+reports back once it serves and only then the old one drains, so the
+listening sockets never close and no connection attempt is refused.
+"""
+import os
+import sys
+import array
+import socket
+import asyncio
+import logging
+import subprocess
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DRAIN_TIMEOUT = 30.0
+# Seconds a new process has to start serving before the old one gives
+# up handing over and keeps serving itself.
+DEFAULT_READY_TIMEOUT = 30.0
+
+LISTEN_FDS_ENV = 'ASOCKS_LISTEN_FDS'
+READY_FD_ENV = 'ASOCKS_READY_FD'
+_READY = b'R'
+# Descriptors received over a handoff socket at most.
+_MAX_HANDOFF_FDS = 16
+
+class ConnectionTracker:
+    """Client connections open, waited for when draining."""
+
+    def __init__(self, loop):
+        self._loop = loop
+        self.connections = set()
+        self.draining = False
+        self._drained = None
+
+    def __len__(self):
+        return len(self.connections)
+
+    def add(self, protocol):
+        self.connections.add(protocol)
+
+    def discard(self, protocol):
+        self.connections.discard(protocol)
+        if (not self.connections and self._drained is not None and
+                not self._drained.done()):
+            self._drained.set_result(None)
+
+    @asyncio.coroutine
+    def drain(self, timeout):
+        """Wait up to timeout seconds for connections to close, then
+        abort the rest. Return how many were aborted."""
+        self.draining = True
+        if self.connections:
+            self._drained = asyncio.Future()
+            try:
+                yield from asyncio.wait_for(self._drained, timeout)
+            except asyncio.TimeoutError:
+                pass
+        remaining = len(self.connections)
+        self.abort()
+        return remaining
+
+    def abort(self):
+        for protocol in list(self.connections):
+            protocol.abort()
+
+def _send_fds(sock, data, fds):
+    """socket.send_fds(), added in Python 3.9."""
+    sock.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                           array.array('i', fds))])
+
+def _recv_fds(sock, bufsize, maxfds):
+    """socket.recv_fds() without flags, added in Python 3.9."""
+    fds = array.array('i')
+    data, ancdata, _, _ = sock.recvmsg(
+        bufsize, socket.CMSG_LEN(maxfds * fds.itemsize))
+    for level, kind, cmsg_data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(cmsg_data[:len(cmsg_data) -
+                                    len(cmsg_data) % fds.itemsize])
+    return data, list(fds)
+
+def _by_listener(indexes, fds):
+    sockets = {}
+    for index, fd in zip(indexes, fds):
+        sockets.setdefault(index, []).append(socket.socket(fileno=fd))
+    return sockets
+
+def inherited_sockets():
+    """Return (listener index -> listening sockets, ready channel) a
+    parent process handed over, or None."""
+    pairs = os.environ.pop(LISTEN_FDS_ENV, None)
+    if pairs is None:
+        return None
+    ready = socket.socket(fileno=int(os.environ.pop(READY_FD_ENV)))
+    indexes, fds = zip(*(map(int, pair.split(':'))
+                         for pair in pairs.split(',')))
+    return _by_listener(indexes, fds), ready
+
+def request_sockets(path):
+    """Ask the server listening for handoffs on path for its listening
+    sockets. Return (listener index -> listening sockets, ready channel),
+    or None when no server is listening on path."""
+    channel = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        channel.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        channel.close()
+        return None
+    # Listener indexes come as data along with the descriptors.
+    data, fds = _recv_fds(channel, _MAX_HANDOFF_FDS, _MAX_HANDOFF_FDS)
+    if not fds or len(data) != len(fds):
+        channel.close()
+        raise OSError('no listening socket received over {}'.format(path))
+    return _by_listener(data, fds), channel
+
+def notify_ready(channel):
+    """Tell the old process the new one serves, it may drain now."""
+    try:
+        channel.sendall(_READY)
+    except OSError as exc:
+        logger.warning('Notifying old server process failed: {}'.format(exc))
+    channel.close()
+
+@asyncio.coroutine
+def wait_ready(loop, channel, timeout=DEFAULT_READY_TIMEOUT):
+    """Return whether the new process reported serving within timeout."""
+    channel.setblocking(False)
+    try:
+        data = yield from asyncio.wait_for(loop.sock_recv(channel, 1),
+                                           timeout)
+    except (OSError, asyncio.TimeoutError):
+        data = b''
+    finally:
+        channel.close()
+    return data == _READY
+
+def spawn_successor(sockets):
+    """Start a copy of this server inheriting sockets, (listener index,
+    socket) pairs. Return (process, ready channel).
+    """
+    fds = [sock.fileno() for _, sock in sockets]
+    channel, child_channel = socket.socketpair()
+    env = dict(os.environ)
+    env[LISTEN_FDS_ENV] = ','.join('{}:{}'.format(index, sock.fileno())
+                                   for index, sock in sockets)
+    env[READY_FD_ENV] = str(child_channel.fileno())
+    try:
+        process = subprocess.Popen(
+            [sys.executable, '-m', 'server'] + sys.argv[1:], env=env,
+            pass_fds=fds + [child_channel.fileno()])
+    except BaseException:
+        channel.close()
+        raise
+    finally:
+        child_channel.close()
+    return process, channel
+
+class HandoffListener:
+    """Unix socket new server processes ask for the listening sockets,
+    (listener index, socket) pairs, on.
+
+    The first process asking gets them, the listener is closed and its
+    path removed before they are sent, so the new process can take the
+    path over. on_handoff is called with the channel the new process
+    reports back on.
+    """
+
+    def __init__(self, loop, path, sockets, on_handoff):
+        self._loop = loop
+        self.path = path
+        self.sockets = sockets
+        self.on_handoff = on_handoff
+        self._sock = None
+
+    def start(self):
+        if os.path.exists(self.path):
+            # Left behind by a process that died, nobody answered on it.
+            os.unlink(self.path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(self.path)
+        self._sock.listen(1)
+        self._sock.setblocking(False)
+        self._loop.add_reader(self._sock.fileno(), self._accept)
+
+    def close(self):
+        if self._sock is None:
+            return
+        self._loop.remove_reader(self._sock.fileno())
+        self._sock.close()
+        self._sock = None
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def _accept(self):
+        try:
+            channel, _ = self._sock.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        self.close()
+        try:
+            _send_fds(channel, bytes(index for index, _ in self.sockets),
+                      [sock.fileno() for _, sock in self.sockets])
+        except OSError as exc:
+            logger.error('Handing over listening sockets failed: '
+                         '{}'.format(exc))
+            channel.close()
+            self.start()
+            return
+        self.on_handoff(channel)
@@ -0,0 +1,139 @@
+"""Addresses client connections are accepted on, given with --listen:
+
+  HOST:PORT[,OPTION=VALUE...]
+  [IPV6]:PORT[,OPTION=VALUE...]
+  unix:PATH[,OPTION=VALUE...]
+
+Options set per listener:
+
+  profile=NAME   socket option profile of client connections
+  backlog=N      listen backlog, --concurrency by default
+  mode=OCTAL     permissions of a Unix socket
+  auth=off       accept clients without authentication, like co-located
+                 ones reaching the proxy over a Unix socket
+
+All listeners of a process share its event loop, caches, pools and
+limits.
+"""
+import os
+import stat
+import socket
+import asyncio
+
+from server.pool import parse_destination
+
+class Listener:
+
+    __slots__ = ('host', 'port', 'path', 'profile', 'backlog', 'mode',
+                 'auth')
+
+    def __init__(self, host=None, port=None, path=None, profile=None,
+                 backlog=None, mode=None, auth=True):
+        self.host = host
+        self.port = port
+        # Path of a Unix socket, host and port are None then.
+        self.path = path
+        self.profile = profile
+        self.backlog = backlog
+        self.mode = mode
+        self.auth = auth
+
+    @property
+    def unix(self):
+        return self.path is not None
+
+    def __str__(self):
+        if self.unix:
+            return 'unix:{}'.format(self.path)
+        if ':' in self.host:
+            return '[{}]:{}'.format(self.host, self.port)
+        return '{}:{}'.format(self.host, self.port)
+
+    @asyncio.coroutine
+    def serve(self, loop, protocol_factory, backlog, reuse_port=False,
+              sockets=None):
+        """Serve on the address, or on listening sockets taken over from
+        another process when given. Return the servers started."""
+        backlog = self.backlog or backlog
+        if sockets:
+            servers = []
+            for sock in sockets:
+                if self.unix:
+                    server = yield from loop.create_unix_server(
+                        protocol_factory, sock=sock, backlog=backlog)
+                else:
+                    server = yield from loop.create_server(
+                        protocol_factory, sock=sock, backlog=backlog)
+                servers.append(server)
+            return servers
+        if self.unix:
+            server = yield from loop.create_unix_server(
+                protocol_factory, sock=self._bind_unix(), backlog=backlog)
+        else:
+            server = yield from loop.create_server(
+                protocol_factory, host=self.host, port=self.port,
+                backlog=backlog, reuse_port=reuse_port)
+        return [server]
+
+    def _bind_unix(self):
+        """Bind a Unix socket, with mode set before it listens."""
+        # A stale socket file left behind is replaced.
+        try:
+            if stat.S_ISSOCK(os.stat(self.path).st_mode):
+                os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            if self.mode is None:
+                sock.bind(self.path)
+            else:
+                # Nobody but the owner may connect until mode is applied.
+                umask = os.umask(0o177)
+                try:
+                    sock.bind(self.path)
+                finally:
+                    os.umask(umask)
+                os.chmod(self.path, self.mode)
+        except BaseException:
+            sock.close()
+            raise
+        return sock
+
+    def unlink(self):
+        """Remove the socket file of a Unix listener."""
+        if self.unix:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+
+def parse_listen(value):
+    """Parse an address and options into a Listener."""
+    address, *options = value.split(',')
+    if address.startswith('unix:'):
+        listener = Listener(path=address[len('unix:'):])
+        if not listener.path:
+            raise ValueError('unix listener needs a path')
+    else:
+        host, port = parse_destination(address)
+        listener = Listener(host=host, port=port)
+    for option in options:
+        key, sep, option_value = option.partition('=')
+        if not sep or not option_value:
+            raise ValueError('listener option must be KEY=VALUE, got '
+                             '{!r}'.format(option))
+        if key == 'profile':
+            listener.profile = option_value
+        elif key == 'backlog' and option_value.isdigit():
+            listener.backlog = int(option_value)
+        elif key == 'mode' and listener.unix:
+            listener.mode = int(option_value, 8)
+        elif key == 'auth' and option_value in ('on', 'off'):
+            listener.auth = option_value == 'on'
+        else:
+            raise ValueError('invalid listener option {!r}'.format(option))
+    return listener
+
+def is_tcp(sock):
+    return sock.family in (socket.AF_INET, socket.AF_INET6)
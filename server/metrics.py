@@ -0,0 +1,155 @@
+import asyncio
+
+# Upper bounds in seconds, from loopback round trips to slow connects.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ['{}="{}"'.format(name, str(value).replace('"', '\\"'))
+             for name, value in zip(names, values)]
+    return '{' + ','.join(pairs) + '}'
+
+class Counter:
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        for label_values, value in sorted(self.values.items()):
+            yield '{}{} {}'.format(
+                self.name, _format_labels(self.labels, label_values), value)
+
+class Gauge(Counter):
+
+    kind = 'gauge'
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+class Histogram:
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for idx, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[idx] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def render(self):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield '{}_bucket{{le="{}"}} {}'.format(self.name, bound, cumulative)
+        yield '{}_bucket{{le="+Inf"}} {}'.format(self.name, self.count)
+        yield '{}_sum {}'.format(self.name, self.sum)
+        yield '{}_count {}'.format(self.name, self.count)
+
+class Metrics:
+    """Server-wide instrumentation rendered in Prometheus text format."""
+
+    def __init__(self):
+        self.connections = Gauge(
+            'asocks_connections', 'Client connections by protocol state.',
+            ('state',))
+        self.handshake_seconds = Histogram(
+            'asocks_handshake_seconds',
+            'Time from client connect to CONNECT reply.')
+        self.dns_seconds = Histogram(
+            'asocks_dns_seconds', 'Time spent resolving remote hosts.')
+        self.connect_seconds = Histogram(
+            'asocks_connect_seconds', 'Time spent connecting to remote hosts.')
+        self.bytes_relayed = Counter(
+            'asocks_relayed_bytes_total', 'Bytes relayed through tunnels.',
+            ('direction',))
+        self.replies = Counter(
+            'asocks_replies_total', 'CONNECT replies sent by status.',
+            ('status',))
+        self.udp_datagrams = Counter(
+            'asocks_udp_datagrams_total',
+            'Datagrams relayed or dropped by UDP associations.',
+            ('direction',))
+        self.loop_lag_seconds = Histogram(
+            'asocks_loop_lag_seconds',
+            'Delay of the event loop running timers due.')
+        self._metrics = [self.connections, self.handshake_seconds,
+                         self.dns_seconds, self.connect_seconds,
+                         self.bytes_relayed, self.replies,
+                         self.udp_datagrams, self.loop_lag_seconds]
+        self._stats_sources = []
+
+    def add_metric(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def add_stats_source(self, prefix, stats):
+        """Publish every key of the dict returned by stats() as a gauge."""
+        self._stats_sources.append((prefix, stats))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            lines.extend(metric.render())
+        for prefix, stats in self._stats_sources:
+            for key, value in sorted(stats().items()):
+                name = '{}_{}'.format(prefix, key)
+                lines.append('# TYPE {} gauge'.format(name))
+                lines.append('{} {}'.format(name, value))
+        return '\n'.join(lines) + '\n'
+
+class MetricsHttpProtocol(asyncio.Protocol):
+    """Minimal HTTP/1.0 responder serving GET /metrics."""
+
+    MAX_REQUEST_SIZE = 8192
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.transport = None
+        self._buffer = bytearray()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self._buffer.extend(data)
+        if b'\r\n\r\n' not in self._buffer:
+            if len(self._buffer) > self.MAX_REQUEST_SIZE:
+                self.transport.close()
+            return
+
+        request_line = bytes(self._buffer.split(b'\r\n', 1)[0]).split()
+        if request_line[:2] == [b'GET', b'/metrics']:
+            status = '200 OK'
+            body = self.metrics.render().encode()
+        else:
+            status = '404 Not Found'
+            body = b'Not Found\n'
+
+        head = ('HTTP/1.0 {}\r\n'
+                'Content-Type: text/plain; version=0.0.4\r\n'
+                'Content-Length: {}\r\n'
+                'Connection: close\r\n\r\n').format(status, len(body))
+        self.transport.write(head.encode() + body)
+        self.transport.close()
@@ -0,0 +1,371 @@
+"""Multiplexing of tunnels over long-lived connections between nodes.
+
+A session carries any number of streams over one connection, each stream
+standing in for a TCP connection. Frames start with a 7 byte header:
+
+  TYPE (1) | STREAM ID (4) | LENGTH (2) | PAYLOAD (LENGTH)
+
+OPEN opens a stream, DATA carries its bytes, EOF half-closes it and
+CLOSE ends it. Per stream, a sender has at most a window of bytes in
+flight the receiver has not handed to its consumer yet; WINDOW frames
+carrying a 4 byte increment return credit as the consumer takes data.
+So a stream whose consumer stalls never holds up others sharing the
+connection.
+"""
+import struct
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+FRAME_HEADER = struct.Struct('>BIH')
+WINDOW_INCREMENT = struct.Struct('>I')
+
+OPEN = 0
+DATA = 1
+WINDOW = 2
+EOF = 3
+CLOSE = 4
+
+# DATA frames are cut at this size so streams interleave finely.
+MAX_FRAME_PAYLOAD = 16 * 1024
+DEFAULT_WINDOW = 256 * 1024
+# Streams a session carries at once, more the peer opens are refused.
+DEFAULT_MAX_STREAMS = 1024
+
+class MuxStream(asyncio.Transport):
+    """Transport of one stream of a MuxSession.
+
+    Behaves like a TCP transport towards its protocol: writes beyond the
+    peer's window are buffered and signalled with pause_writing(), and
+    data arriving while reading is paused is held until resumed.
+    """
+
+    __slots__ = ('session', 'stream_id', '_protocol', '_send_window',
+                 '_recv_window', '_unacked', '_pending', '_inbound',
+                 '_high', '_low', '_paused', '_reading_paused',
+                 '_eof_written', '_eof_received', '_peer_closed',
+                 '_closing', '_closed')
+
+    def __init__(self, session, stream_id, protocol=None):
+        super().__init__()
+        self.session = session
+        self.stream_id = stream_id
+        self._protocol = protocol
+        self._send_window = session.window
+        self._recv_window = session.window
+        # Bytes handed to the consumer not yet credited back to the peer.
+        self._unacked = 0
+        self._pending = bytearray()
+        # Frames received while reading is paused: bytes, or EOF/CLOSE.
+        self._inbound = []
+        self._high = session.window
+        self._low = session.window // 4
+        self._paused = False
+        self._reading_paused = False
+        self._eof_written = False
+        self._eof_received = False
+        self._peer_closed = False
+        self._closing = False
+        self._closed = False
+
+    def get_extra_info(self, name, default=None):
+        # Streams have no socket of their own.
+        if name == 'socket':
+            return default
+        return self.session.transport.get_extra_info(name, default)
+
+    def set_protocol(self, protocol):
+        self._protocol = protocol
+
+    def get_protocol(self):
+        return self._protocol
+
+    def is_closing(self):
+        return self._closing or self._closed
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        if high is None:
+            high = self.session.window if low is None else 4 * low
+        if low is None:
+            low = high // 4
+        self._high = high
+        self._low = low
+        self._update_writing()
+
+    def get_write_buffer_size(self):
+        return len(self._pending)
+
+    def can_write_eof(self):
+        return True
+
+    def write(self, data):
+        if self._closing or self._closed or self._eof_written or not data:
+            return
+        if self._pending:
+            self._pending.extend(data)
+        else:
+            sent = self._send_data(memoryview(data))
+            if sent < len(data):
+                self._pending.extend(memoryview(data)[sent:])
+        self._update_writing()
+
+    def write_eof(self):
+        if self._eof_written or self._closed:
+            return
+        self._eof_written = True
+        if not self._pending:
+            self.session.send_frame(EOF, self.stream_id)
+
+    def pause_reading(self):
+        self._reading_paused = True
+
+    def resume_reading(self):
+        if not self._reading_paused:
+            return
+        self._reading_paused = False
+        while self._inbound and not self._reading_paused and not self._closed:
+            item = self._inbound.pop(0)
+            if item is EOF:
+                self._deliver_eof()
+            elif item is CLOSE:
+                self._deliver_close()
+            else:
+                self._deliver(item)
+
+    def close(self):
+        """Close once buffered data reached the peer."""
+        if self._closing or self._closed:
+            return
+        self._closing = True
+        self._inbound.clear()
+        if not self._pending:
+            self._finish()
+
+    def abort(self):
+        if self._closed:
+            return
+        self._closing = True
+        self._pending.clear()
+        self._inbound.clear()
+        self._finish()
+
+    def _finish(self, exc=None):
+        self._closed = True
+        if not self._peer_closed:
+            self.session.send_frame(CLOSE, self.stream_id)
+        self.session.forget(self.stream_id)
+        self.session.loop.call_soon(self._protocol.connection_lost, exc)
+
+    def _send_data(self, view):
+        """Send as much of view as the window allows, return bytes sent."""
+        count = min(len(view), self._send_window)
+        for start in range(0, count, MAX_FRAME_PAYLOAD):
+            self.session.send_frame(
+                DATA, self.stream_id,
+                view[start:min(start + MAX_FRAME_PAYLOAD, count)])
+        self._send_window -= count
+        return count
+
+    def _update_writing(self):
+        """Pause or resume the protocol as the buffer or session fill up."""
+        paused = (len(self._pending) > self._high or
+                  (self._paused and len(self._pending) > self._low) or
+                  self.session.writing_paused)
+        if paused != self._paused:
+            self._paused = paused
+            if paused:
+                self._protocol.pause_writing()
+            else:
+                self._protocol.resume_writing()
+
+    def _deliver(self, data):
+        self._protocol.data_received(data)
+        self._unacked += len(data)
+        if self._unacked >= self.session.window // 2 and not self._closing:
+            self.session.send_frame(WINDOW, self.stream_id,
+                                    WINDOW_INCREMENT.pack(self._unacked))
+            self._recv_window += self._unacked
+            self._unacked = 0
+
+    def _deliver_eof(self):
+        self._eof_received = True
+        if not self._protocol.eof_received():
+            self.close()
+
+    def _deliver_close(self):
+        if not self._eof_received:
+            self._eof_received = True
+            self._protocol.eof_received()
+        if not self._closed:
+            self._pending.clear()
+            self._finish()
+
+    def frame_received(self, frame_type, payload):
+        if self._closed:
+            return
+        if frame_type == DATA:
+            if len(payload) > self._recv_window:
+                logger.warning('Stream {} overran its window, '
+                               'resetting.'.format(self.stream_id))
+                self.abort()
+                return
+            self._recv_window -= len(payload)
+            if self._closing:
+                return
+            if self._reading_paused or self._inbound:
+                self._inbound.append(payload)
+            else:
+                self._deliver(payload)
+        elif frame_type == WINDOW:
+            self._send_window += WINDOW_INCREMENT.unpack(payload)[0]
+            self._flush()
+        elif frame_type == EOF:
+            if self._reading_paused or self._inbound:
+                self._inbound.append(EOF)
+            elif not self._closing:
+                self._deliver_eof()
+        elif frame_type == CLOSE:
+            self._peer_closed = True
+            if self._reading_paused and self._inbound:
+                # Data received before CLOSE is delivered first.
+                self._inbound.append(CLOSE)
+            else:
+                self._deliver_close()
+
+    def _flush(self):
+        if self._pending:
+            sent = self._send_data(memoryview(self._pending))
+            del self._pending[:sent]
+        if not self._pending:
+            if self._closing and not self._closed:
+                self._finish()
+                return
+            if self._eof_written:
+                self.session.send_frame(EOF, self.stream_id)
+        self._update_writing()
+
+    def session_lost(self, exc):
+        self._closed = True
+        self._protocol.connection_lost(exc)
+
+class MuxSession(asyncio.Protocol):
+    """Streams multiplexed over one connection.
+
+    Either side may open streams, the side that connected numbering them
+    odd and the accepting side even; a peer opening a stream numbered
+    like this side's breaks the protocol and the session is aborted.
+    Streams opened by the peer get their protocol from stream_factory; a
+    session without one, or carrying max_streams already, refuses them.
+    """
+
+    def __init__(self, loop, stream_factory=None, window=DEFAULT_WINDOW,
+                 on_closed=None, initiator=True,
+                 max_streams=DEFAULT_MAX_STREAMS):
+        self.loop = loop
+        self.stream_factory = stream_factory
+        self.window = window
+        self.max_streams = max_streams
+        self.on_closed = on_closed
+        self.transport = None
+        self.streams = {} # stream id -> MuxStream
+        self.writing_paused = False
+        self.closed = False
+        self._buffer = bytearray()
+        self._next_stream_id = 1 if initiator else 2
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def open_stream(self, protocol):
+        """Open a stream to the peer, served by protocol."""
+        stream_id = self._next_stream_id
+        self._next_stream_id += 2
+        stream = self.streams[stream_id] = MuxStream(self, stream_id,
+                                                     protocol)
+        self.send_frame(OPEN, stream_id)
+        protocol.connection_made(stream)
+        return stream
+
+    def forget(self, stream_id):
+        self.streams.pop(stream_id, None)
+
+    def send_frame(self, frame_type, stream_id, payload=b''):
+        if self.closed:
+            return
+        self.transport.writelines(
+            (FRAME_HEADER.pack(frame_type, stream_id, len(payload)), payload))
+
+    def data_received(self, data):
+        buffer = self._buffer
+        buffer.extend(data)
+        offset = 0
+        while len(buffer) - offset >= FRAME_HEADER.size:
+            frame_type, stream_id, length = FRAME_HEADER.unpack_from(
+                buffer, offset)
+            end = offset + FRAME_HEADER.size + length
+            if len(buffer) < end:
+                break
+            payload = bytes(buffer[offset + FRAME_HEADER.size:end])
+            offset = end
+            if frame_type > CLOSE:
+                logger.error('Unknown mux frame type {}, closing '
+                             'session.'.format(frame_type))
+                self.transport.abort()
+                return
+            self._frame_received(frame_type, stream_id, payload)
+            if self.closed:
+                return
+        del buffer[:offset]
+
+    def _frame_received(self, frame_type, stream_id, payload):
+        stream = self.streams.get(stream_id)
+        if frame_type == OPEN:
+            if stream_id % 2 == self._next_stream_id % 2:
+                logger.error('Peer opened stream {} numbered like streams '
+                             'of this side, closing session.'.format(
+                                 stream_id))
+                self.transport.abort()
+                self.closed = True
+                return
+            if stream is not None or self.stream_factory is None:
+                self.send_frame(CLOSE, stream_id)
+                return
+            if len(self.streams) >= self.max_streams:
+                logger.warning('Refused stream {}, session carries {} '
+                               'streams already.'.format(
+                                   stream_id, len(self.streams)))
+                self.send_frame(CLOSE, stream_id)
+                return
+            protocol = self.stream_factory()
+            stream = self.streams[stream_id] = MuxStream(self, stream_id,
+                                                         protocol)
+            protocol.connection_made(stream)
+        elif stream is not None:
+            stream.frame_received(frame_type, payload)
+
+    def eof_received(self):
+        return False
+
+    def pause_writing(self):
+        self.writing_paused = True
+        for stream in list(self.streams.values()):
+            stream._update_writing()
+
+    def resume_writing(self):
+        self.writing_paused = False
+        for stream in list(self.streams.values()):
+            stream._update_writing()
+
+    def connection_lost(self, exc):
+        self.closed = True
+        streams = list(self.streams.values())
+        self.streams.clear()
+        for stream in streams:
+            stream.session_lost(exc)
+        if self.on_closed is not None:
+            self.on_closed(self)
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
@@ -0,0 +1,153 @@
+import socket
+import asyncio
+import logging
+from collections import deque
+
+from server.connector import (staggered_connect, DEFAULT_ATTEMPT_DELAY,
+                              DEFAULT_CONNECT_TIMEOUT)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POOL_SIZE = 8
+DEFAULT_POOL_IDLE_TIMEOUT = 30.0
+
+def parse_destination(value):
+    """Parse 'host:port' or '[ipv6]:port' into (host, port)."""
+    host, sep, port = value.rpartition(':')
+    if not sep or not host or not port.isdigit():
+        raise ValueError('destination must be host:port, got {!r}'.format(
+            value))
+    if host.startswith('[') and host.endswith(']'):
+        host = host[1:-1]
+    return host, int(port)
+
+def _is_healthy(sock):
+    """Check an idle socket was not closed or reset by its remote."""
+    try:
+        data = sock.recv(1, socket.MSG_PEEK)
+    except (BlockingIOError, InterruptedError):
+        return True
+    except OSError:
+        return False
+    # Data sent by remote stays queued for whoever takes the socket.
+    return data != b''
+
+class ConnectionPool:
+    """Pre-established connections to a fixed set of hot destinations.
+
+    Up to size idle connected sockets are kept per destination. A socket
+    handed out is replaced in the background; idle sockets older than
+    idle_timeout or closed by their remote are dropped. Dropped sockets
+    are only replaced for destinations asked for since the last sweep,
+    so the pool of an unused destination shrinks to nothing instead of
+    reconnecting every idle_timeout.
+    """
+
+    def __init__(self, loop, destinations, resolver,
+                 size=DEFAULT_POOL_SIZE,
+                 idle_timeout=DEFAULT_POOL_IDLE_TIMEOUT,
+                 attempt_delay=DEFAULT_ATTEMPT_DELAY,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT):
+        self._loop = loop
+        self.resolver = resolver
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.attempt_delay = attempt_delay
+        self.connect_timeout = connect_timeout
+        self._idle = {dest: deque() for dest in destinations}
+        self._refilling = set()
+        # Destinations asked for since the last sweep.
+        self._wanted = set()
+        self._sweep_handle = None
+        self._closed = False
+
+        self.hits = 0
+        self.misses = 0
+
+    def start(self):
+        for dest in self._idle:
+            self._refill(dest)
+        self._schedule_sweep()
+
+    def close(self):
+        self._closed = True
+        if self._sweep_handle is not None:
+            self._sweep_handle.cancel()
+            self._sweep_handle = None
+        for idle in self._idle.values():
+            while idle:
+                idle.popleft()[0].close()
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'idle': sum(len(idle) for idle in self._idle.values())}
+
+    def acquire(self, host, port):
+        """Take a connected socket to host:port, or None if none is idle."""
+        idle = self._idle.get((host, port))
+        if idle is None:
+            return None
+        self._wanted.add((host, port))
+
+        now = self._loop.time()
+        sock = None
+        while idle:
+            candidate, since = idle.pop()
+            if now - since < self.idle_timeout and _is_healthy(candidate):
+                sock = candidate
+                break
+            candidate.close()
+
+        if sock is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        self._refill((host, port))
+        return sock
+
+    def _refill(self, dest):
+        if dest in self._refilling or self._closed:
+            return
+        self._refilling.add(dest)
+        self._loop.create_task(self._fill(dest))
+
+    @asyncio.coroutine
+    def _fill(self, dest):
+        host, port = dest
+        idle = self._idle[dest]
+        try:
+            while len(idle) < self.size:
+                addr_infos = yield from self.resolver.resolve(host, port)
+                sock = yield from asyncio.wait_for(
+                    staggered_connect(self._loop, addr_infos,
+                                      self.attempt_delay),
+                    self.connect_timeout)
+                if self._closed:
+                    sock.close()
+                    return
+                idle.append((sock, self._loop.time()))
+        except (OSError, asyncio.TimeoutError) as exc:
+            # Retried on next sweep if the destination is still used.
+            logger.warning('Filling pool for {}:{} failed: {}'.format(
+                host, port, exc))
+        finally:
+            self._refilling.discard(dest)
+
+    def _schedule_sweep(self):
+        self._sweep_handle = self._loop.call_later(
+            self.idle_timeout / 2, self._sweep)
+
+    def _sweep(self):
+        now = self._loop.time()
+        for dest, idle in self._idle.items():
+            for _ in range(len(idle)):
+                sock, since = idle.popleft()
+                if now - since < self.idle_timeout and _is_healthy(sock):
+                    idle.append((sock, since))
+                else:
+                    sock.close()
+            if dest in self._wanted:
+                self._refill(dest)
+        self._wanted.clear()
+        self._schedule_sweep()
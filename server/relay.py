@@ -0,0 +1,168 @@
+import os
+import socket
+import logging
+
+logger = logging.getLogger(__name__)
+
+RELAY_CHUNK_SIZE = 64 * 1024
+
+# os.splice() was added in Python 3.10 and only exists on Linux.
+HAS_SPLICE = hasattr(os, 'splice')
+
+class _Direction:
+    """Moves bytes from one socket to another for one direction of a tunnel.
+
+    With splice available, bytes go socket -> pipe -> socket without ever
+    entering user space. Otherwise a recv_into() loop over a reusable
+    buffer is used so no new bytes object is allocated per read.
+    """
+
+    __slots__ = ('relay', 'src', 'dst', 'use_splice', 'pending',
+                 'transferred', 'eof', 'reading', '_pipe_r', '_pipe_w',
+                 '_flags', '_buffer', '_view', '_pending_view')
+
+    def __init__(self, relay, src, dst, use_splice):
+        self.relay = relay
+        self.src = src
+        self.dst = dst
+        self.use_splice = use_splice
+        self.pending = 0
+        self.transferred = 0
+        self.eof = False
+        self.reading = False
+
+        if use_splice:
+            self._pipe_r, self._pipe_w = os.pipe()
+            self._flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+        else:
+            self._buffer = bytearray(RELAY_CHUNK_SIZE)
+            self._view = memoryview(self._buffer)
+            self._pending_view = None
+
+    def start_reading(self):
+        if not self.reading and not self.eof:
+            self.reading = True
+            self.relay._loop.add_reader(self.src.fileno(), self._on_readable)
+
+    def stop_reading(self):
+        if self.reading:
+            self.reading = False
+            self.relay._loop.remove_reader(self.src.fileno())
+
+    def _on_readable(self):
+        try:
+            if self.use_splice:
+                count = os.splice(self.src.fileno(), self._pipe_w,
+                                  RELAY_CHUNK_SIZE, flags=self._flags)
+            else:
+                count = self.src.recv_into(self._buffer)
+                self._pending_view = self._view[:count]
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as exc:
+            self.relay.close(exc)
+            return
+
+        self.relay.last_active = self.relay._loop.time()
+        if count == 0:
+            self.eof = True
+            self.stop_reading()
+        self.pending += count
+        self._flush()
+
+    def _on_writable(self):
+        self.relay._loop.remove_writer(self.dst.fileno())
+        self._flush()
+
+    def _flush(self):
+        while self.pending:
+            try:
+                if self.use_splice:
+                    sent = os.splice(self._pipe_r, self.dst.fileno(),
+                                     self.pending, flags=self._flags)
+                else:
+                    sent = self.dst.send(self._pending_view)
+                    self._pending_view = self._pending_view[sent:]
+            except (BlockingIOError, InterruptedError):
+                # Peer is not draining: stop reading until it is writable.
+                self.stop_reading()
+                self.relay._loop.add_writer(self.dst.fileno(),
+                                            self._on_writable)
+                return
+            except OSError as exc:
+                self.relay.close(exc)
+                return
+            self.pending -= sent
+            self.transferred += sent
+
+        if self.eof:
+            try:
+                self.dst.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+            self.relay._direction_done()
+        else:
+            self.start_reading()
+
+    def close(self):
+        self.stop_reading()
+        if self.use_splice:
+            os.close(self._pipe_r)
+            os.close(self._pipe_w)
+        else:
+            self._pending_view = None
+            self._view.release()
+
+class SpliceRelay:
+    """Relay engine for tunnels in CONNECTED state.
+
+    Takes ownership of the client and remote sockets, which must be
+    connected and non-blocking, and shuffles bytes between them from
+    event loop reader/writer callbacks instead of asyncio transports.
+    """
+
+    __slots__ = ('_loop', 'client_sock', 'remote_sock', 'on_closed',
+                 'closed', 'last_active', 'to_remote', 'to_client')
+
+    def __init__(self, loop, client_sock, remote_sock, on_closed=None):
+        self._loop = loop
+        self.client_sock = client_sock
+        self.remote_sock = remote_sock
+        self.on_closed = on_closed
+        self.closed = False
+        self.last_active = loop.time()
+
+        self.to_remote = _Direction(self, client_sock, remote_sock, HAS_SPLICE)
+        self.to_client = _Direction(self, remote_sock, client_sock, HAS_SPLICE)
+
+    def start(self):
+        self.to_remote.start_reading()
+        self.to_client.start_reading()
+
+    def _direction_done(self):
+        if (self.to_remote.eof and not self.to_remote.pending and
+                self.to_client.eof and not self.to_client.pending):
+            self.close()
+
+    def close(self, exc=None):
+        if self.closed:
+            return
+        self.closed = True
+
+        for direction in (self.to_remote, self.to_client):
+            self._loop.remove_writer(direction.dst.fileno())
+            direction.close()
+        self.client_sock.close()
+        self.remote_sock.close()
+
+        if exc is not None:
+            logger.info(str(exc))
+        if self.on_closed is not None:
+            self.on_closed(self)
+
+def detach_socket(transport):
+    """Duplicate the socket of transport so it outlives the transport."""
+    sock = transport.get_extra_info('socket')
+    detached = socket.fromfd(sock.fileno(), sock.family, sock.type)
+    detached.setblocking(False)
+    return detached
@@ -0,0 +1,113 @@
+import socket
+import asyncio
+from collections import OrderedDict
+
+DEFAULT_POSITIVE_TTL = 300
+DEFAULT_NEGATIVE_TTL = 30
+DEFAULT_MAX_CONCURRENT_LOOKUPS = 32
+DEFAULT_MAX_CACHE_ENTRIES = 10000
+
+def is_ip_address(host):
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, host)
+        except (OSError, ValueError):
+            continue
+        return family
+    return None
+
+def _with_port(infos, port):
+    """Fill port into sockaddrs of cached getaddrinfo() results."""
+    return [(family, type_, proto, canonname, (sockaddr[0], port) + sockaddr[2:])
+            for family, type_, proto, canonname, sockaddr in infos]
+
+class Resolver:
+    """Caching resolver for domain names of CONNECT requests.
+
+    getaddrinfo() does not report record TTLs, so successful and failed
+    lookups are cached for fixed positive and negative TTLs, up to
+    max_entries names, evicting the least recently used. Concurrent
+    lookups of the same name share one in-flight query and no more than
+    max_concurrent queries are handed to the executor at a time.
+    """
+
+    def __init__(self, loop=None,
+                 positive_ttl=DEFAULT_POSITIVE_TTL,
+                 negative_ttl=DEFAULT_NEGATIVE_TTL,
+                 max_concurrent=DEFAULT_MAX_CONCURRENT_LOOKUPS,
+                 max_entries=DEFAULT_MAX_CACHE_ENTRIES):
+        self._loop = loop or asyncio.get_event_loop()
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._cache = OrderedDict() # host -> (expires_at, infos, error)
+        self._inflight = {} # host -> lookup task
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'inflight': len(self._inflight),
+                'cached': len(self._cache)}
+
+    @asyncio.coroutine
+    def resolve(self, host, port):
+        """Return getaddrinfo()-style results for a TCP connect to host:port.
+
+        Raises socket.gaierror when host cannot be resolved.
+        """
+        family = is_ip_address(host)
+        if family is not None:
+            return [(family, socket.SOCK_STREAM, socket.IPPROTO_TCP, '',
+                     (host, port))]
+
+        entry = self._cache.get(host)
+        if entry is not None:
+            expires_at, infos, error = entry
+            if expires_at > self._loop.time():
+                self.hits += 1
+                self._cache.move_to_end(host)
+                if error is not None:
+                    raise socket.gaierror(*error.args)
+                return _with_port(infos, port)
+            del self._cache[host]
+
+        lookup = self._inflight.get(host)
+        if lookup is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            lookup = self._loop.create_task(self._lookup(host))
+            self._inflight[host] = lookup
+
+        # A client giving up must not cancel the lookup other clients wait on.
+        infos = yield from asyncio.shield(lookup)
+        return _with_port(infos, port)
+
+    @asyncio.coroutine
+    def _lookup(self, host):
+        yield from self._semaphore.acquire()
+        try:
+            infos = yield from self._loop.getaddrinfo(
+                host, None, type=socket.SOCK_STREAM)
+        except socket.gaierror as exc:
+            self._store(host, None, exc, self.negative_ttl)
+            raise
+        else:
+            self._store(host, infos, None, self.positive_ttl)
+            return infos
+        finally:
+            self._semaphore.release()
+            del self._inflight[host]
+
+    def _store(self, host, infos, error, ttl):
+        if ttl <= 0:
+            return
+        while len(self._cache) >= self.max_entries:
+            self._cache.popitem(last=False)
+        self._cache[host] = (self._loop.time() + ttl, infos, error)
@@ -0,0 +1,93 @@
+"""Round-robin scheduling of relay work and event loop lag measurement.
+
+asyncio transports read up to 256 KiB at once, and relaying a read runs
+to completion in one callback. With the 'fair' relay engine a tunnel
+relays at most a quantum of bytes per callback; the rest is relayed by
+steps a RelayScheduler runs round-robin, one per waiting tunnel per loop
+iteration, with I/O of all other connections served in between.
+"""
+from collections import deque
+
+DEFAULT_QUANTUM = 64 * 1024
+# Seconds between measurements of event loop lag.
+DEFAULT_LAG_INTERVAL = 0.25
+
+class RelayScheduler:
+    """Runs relay steps round-robin across tunnels.
+
+    A step relays one quantum and returns whether data is left, it is
+    run again next round then.
+    """
+
+    def __init__(self, loop, quantum=DEFAULT_QUANTUM):
+        self._loop = loop
+        self.quantum = quantum
+        self._ready = deque()
+        self._handle = None
+
+        self.deferred = 0
+        self.rounds = 0
+
+    def stats(self):
+        return {'waiting': len(self._ready),
+                'deferred': self.deferred,
+                'rounds': self.rounds}
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        self._ready.clear()
+
+    def schedule(self, step):
+        self.deferred += 1
+        self._ready.append(step)
+        if self._handle is None:
+            self._handle = self._loop.call_soon(self._run)
+
+    def _run(self):
+        self._handle = None
+        self.rounds += 1
+        # Steps scheduled during this round wait for the next one.
+        for _ in range(len(self._ready)):
+            step = self._ready.popleft()
+            if step():
+                self._ready.append(step)
+        if self._ready:
+            self._handle = self._loop.call_soon(self._run)
+
+class LoopLagMonitor:
+    """Measures how late the event loop runs a timer due every interval,
+    which is how long callbacks keep it from serving I/O."""
+
+    def __init__(self, loop, histogram=None, interval=DEFAULT_LAG_INTERVAL):
+        self._loop = loop
+        self.histogram = histogram
+        self.interval = interval
+        self._handle = None
+        self._due = None
+
+        self.lag = 0.0
+        self.max_lag = 0.0
+
+    def stats(self):
+        return {'lag_seconds': self.lag,
+                'max_lag_seconds': self.max_lag}
+
+    def start(self):
+        self._due = self._loop.time() + self.interval
+        self._handle = self._loop.call_at(self._due, self._measure)
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _measure(self):
+        now = self._loop.time()
+        self.lag = max(0.0, now - self._due)
+        self.max_lag = max(self.max_lag, self.lag)
+        if self.histogram is not None:
+            self.histogram.observe(self.lag)
+        self._due = now + self.interval
+        self._handle = self._loop.call_at(self._due, self._measure)
@@ -6,20 +6,51 @@ import struct
 import logging
 import socket
 import functools
+import itertools
 
 import auth
-from networking import (SOCK_PROTOCOL_VERSION, AddressType, 
-                        ConnectionStatus as Status)
+from networking import (SOCK_PROTOCOL_VERSION, NO_ACCEPTABLE_METHODS,
+                        AddressType, Command, ConnectionStatus as Status)
 from exception import InvalidRequest, WrongProtocol, ConnectToRemoteError
-from logger import console_handler
+from server.relay import SpliceRelay, detach_socket
+from server.resolver import Resolver, is_ip_address
+from server.handshake import (parse_greeting, parse_auth_request,
+                              parse_request, pack_address)
+from server.timers import TimerWheel
+from server.udp_relay import UdpAssociation, DEFAULT_MAPPING_TIMEOUT
+from server.mux import MuxSession
+from server.connector import (staggered_connect, DEFAULT_ATTEMPT_DELAY,
+                              DEFAULT_CONNECT_TIMEOUT)
 
+logger = logging.getLogger(__name__)
+
+# Ids tagging log records of a client connection, see logger.ConnectionSampler.
+_connection_ids = itertools.count()
+
+# Default write buffer watermarks of both legs of a tunnel. Once a
+# transport buffers more than HIGH bytes, reading from the peer transport
+# is paused until the buffer drains below LOW.
+DEFAULT_WRITE_BUFFER_HIGH = 256 * 1024
+DEFAULT_WRITE_BUFFER_LOW = 64 * 1024
+
+# Seconds a client may take from connecting to the CONNECT reply, and
+# seconds a tunnel may relay nothing in either direction.
+DEFAULT_HANDSHAKE_TIMEOUT = 30.0
+DEFAULT_IDLE_TIMEOUT = 300.0
+
+# Engines relaying bytes of CONNECTED tunnels. 'protocol' keeps using the
+# asyncio transports, 'splice' hands both sockets to server.relay and
+# 'fair' relays large reads in quanta, see server.scheduling.
+RELAY_ENGINES = ('protocol', 'splice', 'fair')
 
 class Socks5ProtocolState:
     
     INIT = 0
     NEGOTIATED = 1
     AUTHORIZED = 2
-    CONNECTED = 3
+    CONNECTING = 3
+    CONNECTED = 4
+    MULTIPLEXED = 5
 
     StateMapping = None
 
@@ -35,115 +66,506 @@ class Socks5ProtocolState:
         return cls.StateMapping.get(state)
      
 class ServerRemoteProtocol(asyncio.Protocol):
-    """Protocol for streaming to remote host"""
-    
-    def __init__(self, transport_to_client):
-        self.transport_to_remote = None
-        self.transport_to_client = transport_to_client
-        
-        self.logger = logging.getLogger(__name__)
-        self.logger.setLevel(logging.DEBUG)
-        self.logger.addHandler(console_handler)
+    """Protocol for streaming to remote host.
+
+    Holds no state of its own, events of the remote leg are handled by
+    the ServerClientProtocol owning the tunnel.
+    """
+
+    __slots__ = ('tunnel',)
+
+    def __init__(self, tunnel):
+        self.tunnel = tunnel
 
     def connection_made(self, transport):
-        self.transport_to_remote = transport
+        self.tunnel.remote_connection_made(transport)
 
     def data_received(self, data):
-        self.transport_to_client.write(data)
+        self.tunnel.remote_data_received(data)
+
+    def eof_received(self):
+        return self.tunnel.remote_eof_received()
+
+    def pause_writing(self):
+        self.tunnel.remote_pause_writing()
+
+    def resume_writing(self):
+        self.tunnel.remote_resume_writing()
+
+    def connection_lost(self, exc):
+        self.tunnel.remote_connection_lost(exc)
 
 class ServerClientProtocol(asyncio.Protocol):
-    
-    def __init__(self):
+    """Protocol of the client leg, owning the state of the whole tunnel.
+
+    Both legs of a tunnel share this one object, see ServerRemoteProtocol.
+    Attributes are slots to keep per-connection memory small.
+    """
+
+    __slots__ = (
+        # Server-wide settings and shared objects.
+        'write_buffer_high', 'write_buffer_low', 'relay_engine', 'resolver',
+        'connect_attempt_delay', 'connect_timeout', 'optimistic_data',
+        'pool', 'metrics', 'admission', 'timers', 'handshake_timeout',
+        'idle_timeout', 'max_lifetime', 'credentials', 'acl',
+        'udp_associate', 'udp_mapping_timeout', 'upstream',
+        'mux_stream_factory', 'connections', 'shaper', 'scheduler',
+        'socket_profile', 'socket_profiles',
+        # Client leg.
+        'transport_to_client', 'state', 'conn_id', '_loop', '_buffer',
+        'username', '_auth_task', 'rule',
+        '_selection_reply', '_client_writing_paused', 'client_eof',
+        '_connected_at', '_last_active', '_client_ip', '_admitted',
+        '_refused', '_admission_task', '_handshake_timer', '_idle_timer',
+        '_lifetime_timer',
+        # Remote leg.
+        'transport_to_remote', 'remote_relaying', 'remote_eof',
+        'remote_closed', '_remote_held', '_relay', '_remote_writing_paused',
+        # Rate limited flows to remote and to client.
+        '_upload', '_download',
+        # Data of large reads waiting for the scheduler, both directions.
+        '_upload_backlog', '_download_backlog',
+        # UDP association replacing the remote leg.
+        '_udp', '_udp_task',
+        # Session of streams multiplexed over the client connection.
+        '_mux')
+
+    def __init__(self, write_buffer_high=DEFAULT_WRITE_BUFFER_HIGH,
+                 write_buffer_low=DEFAULT_WRITE_BUFFER_LOW,
+                 relay_engine='protocol', resolver=None,
+                 connect_attempt_delay=DEFAULT_ATTEMPT_DELAY,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 optimistic_data=False, pool=None, metrics=None,
+                 admission=None, timers=None,
+                 handshake_timeout=DEFAULT_HANDSHAKE_TIMEOUT,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT, max_lifetime=None,
+                 credentials=None, acl=None, udp_associate=True,
+                 udp_mapping_timeout=DEFAULT_MAPPING_TIMEOUT, upstream=None,
+                 mux_stream_factory=None, connections=None, shaper=None,
+                 scheduler=None, socket_profile=None, socket_profiles=None):
+        self.write_buffer_high = write_buffer_high
+        self.write_buffer_low = write_buffer_low
+        self.relay_engine = relay_engine
+        self.resolver = resolver
+        self.connect_attempt_delay = connect_attempt_delay
+        self.connect_timeout = connect_timeout
+        self.optimistic_data = optimistic_data
+        self.pool = pool
+        self.metrics = metrics
+        self.admission = admission
+        self.timers = timers
+        self.handshake_timeout = handshake_timeout
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        # Credential store, username/password is required when given.
+        self.credentials = credentials
+        # server.acl.AccessList deciding which destinations are allowed.
+        self.acl = acl
+        self.udp_associate = udp_associate
+        self.udp_mapping_timeout = udp_mapping_timeout
+        # server.upstream.Upstream CONNECTs are forwarded through.
+        self.upstream = upstream
+        # Protocol factory of streams when clients may open multiplexed
+        # sessions, None to refuse them.
+        self.mux_stream_factory = mux_stream_factory
+        # server.lifecycle.ConnectionTracker waited for on shutdown.
+        self.connections = connections
+        # server.shaping.Shaper limiting the rates tunnels relay at.
+        self.shaper = shaper
+        # server.scheduling.RelayScheduler of the 'fair' relay engine.
+        self.scheduler = scheduler
+        # server.sockopts.SocketProfile of the listener, and profiles by
+        # name ACL rules may pick from.
+        self.socket_profile = socket_profile
+        self.socket_profiles = socket_profiles
+
         self.transport_to_client = None
-        self.transport_to_remote = None
-        self.remote_host_atype = None
+        self.state = Socks5ProtocolState.INIT
+        self.conn_id = next(_connection_ids)
         self._loop = None
+        # Handshake bytes not parsed yet, then early payload sent by
+        # client before remote is connected.
+        self._buffer = bytearray()
+        # Authenticated user, None without authentication.
+        self.username = None
+        self._auth_task = None
+        # ACL rule allowing the destination, None until decided.
+        self.rule = None
+        # Method selection reply held back in optimistic data mode.
+        self._selection_reply = None
+        self._client_writing_paused = False
+        # Client half-closed its side of the tunnel.
+        self.client_eof = False
+        self._connected_at = None
+        # Loop time either leg last received data.
+        self._last_active = None
+        self._client_ip = None
+        self._admitted = False
+        # Set when admission policy answers CONNECT with X'02'.
+        self._refused = False
+        self._admission_task = None
+        self._handshake_timer = None
+        self._idle_timer = None
+        self._lifetime_timer = None
 
-        self.state = Socks5ProtocolState.INIT
+        self.transport_to_remote = None
+        # Data from remote is held until the CONNECT reply reaches client.
+        self.remote_relaying = False
+        self._remote_held = None
+        # Remote half-closed its side of the tunnel.
+        self.remote_eof = False
+        self.remote_closed = False
+        self._relay = None
+        self._remote_writing_paused = False
+        self._upload = None
+        self._download = None
+        self._upload_backlog = None
+        self._download_backlog = None
+        self._udp = None
+        self._udp_task = None
+        self._mux = None
 
-        self.logger = logging.getLogger(__name__)
-        self.logger.setLevel(logging.DEBUG)
-        self.logger.addHandler(console_handler)
+    @property
+    def _log_extra(self):
+        # Built per log call rather than kept per connection.
+        return {'conn_id': self.conn_id}
 
     def _next_state(self, skips=0):
         """update protocol state by (1 + #skips)"""
+        if self.metrics is not None:
+            self.metrics.connections.dec(
+                Socks5ProtocolState.state_name(self.state))
+            self.metrics.connections.inc(
+                Socks5ProtocolState.state_name(self.state + 1 + skips))
         self.state += 1 + skips
 
     def connection_made(self, transport):
         peername = transport.get_extra_info('peername')
-        self.logger.info(
-            'Received connection from client {}.'.format(peername))
+        logger.info(
+            'Received connection from client {}.'.format(peername),
+            extra=self._log_extra)
 
         self.transport_to_client = transport
-        self._loop = self.transport_to_client._loop
+        self.transport_to_client.set_write_buffer_limits(
+            high=self.write_buffer_high, low=self.write_buffer_low)
+        if self.socket_profile is not None:
+            self._apply_socket_profile(self.socket_profile, transport)
+        # Transports of alternative loops (uvloop) have no _loop attribute.
+        self._loop = asyncio.get_event_loop()
+        if self.resolver is None:
+            self.resolver = Resolver(self._loop)
+
+        if self.timers is None:
+            self.timers = TimerWheel(self._loop)
+        if self.handshake_timeout:
+            self._handshake_timer = self.timers.call_later(
+                self.handshake_timeout, self._timed_out, 'Handshake')
+        if self.max_lifetime:
+            self._lifetime_timer = self.timers.call_later(
+                self.max_lifetime, self._timed_out, 'Lifetime')
+
+        self._connected_at = self._loop.time()
+        if self.metrics is not None:
+            self.metrics.connections.inc(
+                Socks5ProtocolState.state_name(self.state))
+        if self.connections is not None:
+            self.connections.add(self)
+
+        if self.admission is not None:
+            self._admit(peername)
+
+    def _admit(self, peername):
+        self._client_ip = peername[0] if peername else ''
+        if self.admission.try_admit(self._client_ip):
+            self._admitted = True
+        elif self.admission.policy == 'reply':
+            self._refused = True
+        elif self.admission.policy == 'queue':
+            # Client data stays in kernel buffers until admitted.
+            self.transport_to_client.pause_reading()
+            self._admission_task = self._loop.create_task(
+                self._wait_admission())
+        else:
+            self._reset_client()
+
+    @asyncio.coroutine
+    def _wait_admission(self):
+        self._admitted = yield from self.admission.wait_admit(self._client_ip)
+        if not self._admitted:
+            logger.info('Admission queue timed out.', extra=self._log_extra)
+            self._reset_client()
+        elif not self.transport_to_client.is_closing():
+            self.transport_to_client.resume_reading()
+
+    def _reset_client(self):
+        """Drop client connection with a TCP RST."""
+        sock = self.transport_to_client.get_extra_info('socket')
+        if sock is not None:
+            # Streams of a multiplexed session have no socket.
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                struct.pack('ii', 1, 0))
+            except OSError:
+                pass
+        self.transport_to_client.abort()
+
+    def _release_admission(self):
+        if self._admission_task is not None:
+            self._admission_task.cancel()
+            self._admission_task = None
+        if self._admitted:
+            self._admitted = False
+            self.admission.release(self._client_ip)
+
+    def _timed_out(self, timeout):
+        logger.info('{} timeout expired, closing connection.'.format(timeout),
+                    extra=self._log_extra)
+        self.abort()
+
+    def abort(self):
+        """Close both legs of the tunnel right away."""
+        if self._relay is not None:
+            self._relay.close()
+            return
+        self.transport_to_client.abort()
+        if self.transport_to_remote is not None:
+            self.transport_to_remote.abort()
+
+    def _check_idle(self):
+        last_active = self._last_active
+        if self._relay is not None:
+            last_active = max(last_active, self._relay.last_active)
+        if self._udp is not None:
+            last_active = max(last_active, self._udp.last_active)
+
+        idle = self._loop.time() - last_active
+        if idle < self.idle_timeout:
+            self._idle_timer = self.timers.call_later(
+                self.idle_timeout - idle, self._check_idle)
+        else:
+            self._timed_out('Idle')
+
+    def _cancel_timers(self):
+        for timer in (self._handshake_timer, self._idle_timer,
+                      self._lifetime_timer):
+            if timer is not None:
+                timer.cancel()
 
     def data_received(self, data):
+        if self._mux is not None:
+            self._mux.data_received(data)
+            return
+        if self.state == Socks5ProtocolState.CONNECTED:
+            self._last_active = self._loop.time()
+            if self._udp is None:
+                if (self.scheduler is not None and
+                        len(data) > self.scheduler.quantum):
+                    self._defer_upload(data)
+                else:
+                    self._tunneling(data)
+            # Nothing is relayed over the TCP connection of an association.
+            return
 
-        if self.state == Socks5ProtocolState.INIT:
-            self._negotiate_auth_method(data)
-        elif self.state == Socks5ProtocolState.NEGOTIATED:
-            raise NotImplementedError
-        elif self.state == Socks5ProtocolState.AUTHORIZED:
-            self._accept_connect(data)
-        elif self.state == Socks5ProtocolState.CONNECTED:
-            self._tunneling(data)
-            
-    def _negotiate_auth_method(self, data):
-        if len(data) <= 2:
-            raise InvalidRequest
-
-        if data[0] != 5:
-            raise WrongProtocol
-
-        auth_method_count = data[1] 
-        auth_method_codes = data[2:]
-        if len(auth_method_codes) < auth_method_count:
-            raise InvalidRequest
+        self._buffer.extend(data)
+        self._process_buffered()
 
+    def _process_buffered(self):
+        try:
+            self._process_handshake()
+        except InvalidRequest as exc:
+            logger.error('Invalid request from client {}: {}'.format(
+                self.transport_to_client.get_extra_info('peername'),
+                type(exc).__name__), extra=self._log_extra)
+            self.transport_to_client.close()
+
+    def _process_handshake(self):
+        """Consume complete handshake messages held in buffer."""
+        while self._buffer:
+            if self.state == Socks5ProtocolState.INIT:
+                parsed = parse_greeting(self._buffer)
+                if parsed is None:
+                    return
+                auth_method_codes, consumed = parsed
+                del self._buffer[:consumed]
+                self._negotiate_auth_method(auth_method_codes)
+            elif self.state == Socks5ProtocolState.NEGOTIATED:
+                if self._auth_task is not None:
+                    # Request pipelined behind credentials waits for them.
+                    return
+                parsed = parse_auth_request(self._buffer)
+                if parsed is None:
+                    return
+                username, password, consumed = parsed
+                del self._buffer[:consumed]
+                self._authenticate(username, password)
+            elif self.state == Socks5ProtocolState.AUTHORIZED:
+                parsed = parse_request(self._buffer)
+                if parsed is None:
+                    return
+                cmd, atype, host, port, consumed = parsed
+                del self._buffer[:consumed]
+                self._accept_connect(cmd, atype, host, port)
+            elif self.state == Socks5ProtocolState.CONNECTING:
+                # Early payload is held until remote is connected.
+                if len(self._buffer) > self.write_buffer_high:
+                    self.transport_to_client.pause_reading()
+                return
+            else:
+                return
+
+    def eof_received(self):
+        if self.client_eof:
+            return True
+        self.client_eof = True
+        if self._udp is not None or self._mux is not None:
+            # Association ends with the TCP connection it arrived on.
+            return False
+        if self.state == Socks5ProtocolState.CONNECTING:
+            # Forwarded once early payload reached remote.
+            return True
+        if self.state != Socks5ProtocolState.CONNECTED:
+            return False
+        return self._forward_client_eof()
+
+    def _forward_client_eof(self):
+        """Half-close remote side, return False once both sides are done."""
+        if (self.remote_eof or
+                not self.transport_to_remote.can_write_eof()):
+            return False
+        logger.debug('Client sent EOF, half-closing remote.',
+                     extra=self._log_extra)
+        self.transport_to_remote.write_eof()
+        return True
+
+    def _negotiate_auth_method(self, auth_method_codes):
         # When no client-proposed auth method is chosen,
         # client connection will be closed. 
-        accepted_code = b'\xff' 
+        accepted_code = NO_ACCEPTABLE_METHODS
+        if (self.mux_stream_factory is not None and
+                auth.Multiplex.method_code in auth_method_codes):
+            # Streams authenticate on their own, see _start_mux().
+            self.transport_to_client.write(struct.pack(
+                '>BB', SOCK_PROTOCOL_VERSION, auth.Multiplex.method_code))
+            self._start_mux()
+            return
+        if self.credentials is not None:
+            acceptable_codes = (auth.UsernamePassword.method_code,)
+        else:
+            acceptable_codes = auth.acceptable_auth_method_codes
 
         for auth_method_code in auth_method_codes:
-            if auth_method_code in auth.acceptable_auth_method_codes:
-                accepted_code = struct.pack(">B", auth_method_code)
+            if (auth_method_code == auth.OptimisticData.method_code and
+                    not self.optimistic_data):
+                continue
+            if auth_method_code in acceptable_codes:
+                accepted_code = auth_method_code
                 break
         
-        response = b'\x05' + accepted_code
-        self.transport_to_client.write(response)
-        if accepted_code == b'xff':
+        response = struct.pack('>BB', SOCK_PROTOCOL_VERSION, accepted_code)
+        if accepted_code == auth.OptimisticData.method_code:
+            # Sent together with the reply to the pipelined request.
+            self._selection_reply = response
+        else:
+            self.transport_to_client.write(response)
+
+        if accepted_code == NO_ACCEPTABLE_METHODS:
+            self._buffer.clear()
             self.transport_to_client.close()
         else: 
             # Skip auth phase if not required
-            accepted_code = struct.unpack('>B', accepted_code)[0]
-            self._next_state(accepted_code == auth.NoAuthRequired.method_code)
-
-    def _accept_connect(self, data):
-        version = data[0] 
-        assert version == SOCK_PROTOCOL_VERSION 
-
-        cmd = data[1]
-        assert cmd == 1
-
-        self.remote_host_atype = atype = data[3:4]
-        atype = struct.unpack('>B', atype)[0]
-        assert atype in (1, 3, 4) 
-        if atype == AddressType.IPv4:
-            host = '.'.join([str(byte) for byte in data[4:8]])
-            port = data[8:10]
-        elif atype == AddressType.DomainName:
-            addr_octets_count = data[4]
-            host = data[5:5+addr_octets_count]
-            port = data[5+addr_octets_count:7+addr_octets_count]
+            self._next_state(accepted_code in (
+                auth.NoAuthRequired.method_code,
+                auth.OptimisticData.method_code))
+
+    def _start_mux(self):
+        """Turn the connection into a session of multiplexed streams.
+
+        Every stream is served by a protocol of its own, running a whole
+        SOCKS5 handshake with authentication and access control, so the
+        connection itself is not timed out.
+        """
+        logger.info('Client opened a multiplexed session.',
+                    extra=self._log_extra)
+        self._cancel_timers()
+        self._next_state(Socks5ProtocolState.MULTIPLEXED - self.state - 1)
+        self._mux = MuxSession(self._loop, self.mux_stream_factory,
+                               initiator=False)
+        self._mux.connection_made(self.transport_to_client)
+        if self._buffer:
+            data = bytes(self._buffer)
+            self._buffer.clear()
+            self._mux.data_received(data)
+
+    def _authenticate(self, username, password):
+        verified = self.credentials.check(username, password)
+        if verified is None:
+            # Slow password hash, checked off the event loop.
+            self._auth_task = self._loop.create_task(
+                self._verify_credentials(username, password))
+        else:
+            self._authenticated(username, verified)
+
+    @asyncio.coroutine
+    def _verify_credentials(self, username, password):
+        try:
+            verified = yield from self.credentials.verify(username, password)
+        except Exception as exc:
+            logger.error('Verifying password of user {} failed: {}'.format(
+                username.decode('utf-8', 'replace'), exc),
+                extra=self._log_extra)
+            verified = False
+        self._auth_task = None
+        self._authenticated(username, verified)
+        if verified:
+            self._process_buffered()
+
+    def _authenticated(self, username, verified):
+        status = (auth.UsernamePassword.SUCCEEDED if verified
+                  else auth.UsernamePassword.FAILED)
+        self.transport_to_client.write(
+            struct.pack('>BB', auth.UsernamePassword.version, status))
+
+        username = username.decode('utf-8', 'replace')
+        if verified:
+            logger.info('User {} authenticated.'.format(username),
+                        extra=self._log_extra)
+            self.username = username
+            self._next_state()
         else:
-            host = ':'.join(
-                [str(struct.unpack('>H', data[idx:idx+2])[0]) 
-                 for idx in range(4, 20, 2)])
-            port = data[20:22]
+            logger.warning('Authentication of user {} from {} failed.'.format(
+                username, self.transport_to_client.get_extra_info('peername')),
+                extra=self._log_extra)
+            self._buffer.clear()
+            self.transport_to_client.close()
+
+    def _accept_connect(self, cmd, atype, host, port):
+        if not (cmd == Command.CONNECT or
+                cmd == Command.UDP_ASSOCIATE and self.udp_associate):
+            self._reply(Status.COMM_NOT_SUPP)
+            return
+        if host is None:
+            self._reply(Status.ATYP_NOT_SUPP)
+            return
+        if self._refused:
+            logger.info('Refusing request, server at connection limit.',
+                        extra=self._log_extra)
+            self._reply(Status.NOT_ALLOWED_BY_RULESET)
+            return
+        if cmd == Command.UDP_ASSOCIATE:
+            self._associate()
+            return
+        if self.acl is not None:
+            self.rule = self.acl.match(host, port)
+            if self.rule is not None and not self.rule.allow:
+                logger.info('Connection to {}:{} denied by {}.'.format(
+                    host, port, self.rule), extra=self._log_extra)
+                self._reply(Status.NOT_ALLOWED_BY_RULESET)
+                return
 
-        port = struct.unpack('>H', port)[0]
-        self.logger.info(
-	        'Connecting to remote server at {}:{}.'.format(host, port))
+        logger.info(
+	        'Connecting to remote server at {}:{}.'.format(host, port),
+            extra=self._log_extra)
+        self._next_state()
 
         waiter = asyncio.Future()
         waiter.add_done_callback(self._remote_connected)
@@ -152,17 +574,26 @@ class ServerClientProtocol(asyncio.Protocol):
             # create_task added to asyncio in Python 3.4.2
             task = self._loop.create_task(self._connect_to_remote(host, port, waiter)) 
         else:
-            task = asyncio.async(self._connect_to_remote(host, port, waiter))
+            # async became a keyword in Python 3.7
+            task = getattr(asyncio, 'async')(
+                self._connect_to_remote(host, port, waiter))
     
     @asyncio.coroutine
     def _connect_to_remote(self, host, port, waiter):
         exception = None
         try:
-            transport, protocol = yield from self._loop.create_connection(
-                functools.partial(ServerRemoteProtocol, 
-                                  transport_to_client=self.transport_to_client),
-                host, 
-                port)
+            transport, protocol = yield from asyncio.wait_for(
+                self._open_remote(host, port), self.connect_timeout)
+        except ConnectToRemoteError as exc:
+            waiter.set_exception(exc)
+        except asyncio.TimeoutError:
+            waiter.set_exception(ConnectToRemoteError(Status.TTL_EXPIRED))
+            logger.error('Connecting to {}:{} timed out.'.format(
+                host, port), extra=self._log_extra)
+        except socket.gaierror as err:
+            waiter.set_exception(ConnectToRemoteError(Status.HOST_UNREACHABLE))
+            logger.error('Resolving {} failed: {}'.format(host, err),
+                         extra=self._log_extra)
         except OSError as err:
             if err.errno == errno.ENETUNREACH:
                 reply = Status.NETWORK_UNREACHABLE
@@ -176,55 +607,487 @@ class ServerClientProtocol(asyncio.Protocol):
                 reply = Status.GENERAL_FAIL 
 
             waiter.set_exception(ConnectToRemoteError(reply))
-            self.logger.error('Connecting to {}:{} failed: '.format(
-		                  host, port, os.strerror(err.errno)))
+            logger.error('Connecting to {}:{} failed: {}'.format(
+		                  host, port, err), extra=self._log_extra)
         except Exception as e:
-            self.logger.error(str(e))
+            logger.error(str(e), extra=self._log_extra)
             reply = Status.GENERAL_FAIL
             waiter.set_exception(ConnectToRemoteError(reply))
-            self.logger.error('Connecting to {}:{} failed.'.format(host, port))
+            logger.error('Connecting to {}:{} failed.'.format(host, port),
+                         extra=self._log_extra)
         else:
-            self.logger.info('Connected to {}:{}.'.format(host, port))
+            logger.info('Connected to {}:{}.'.format(host, port),
+                        extra=self._log_extra)
             waiter.set_result((transport, protocol))
 
+    @asyncio.coroutine
+    def _open_remote(self, host, port):
+        """Take a pooled connection, or resolve host and race connections
+        to its addresses."""
+        if self.upstream is not None:
+            return (yield from self._open_upstream(host, port))
+        sock = self.pool.acquire(host, port) if self.pool else None
+        if sock is not None and self.acl is not None and self.rule is None:
+            self.rule = self.acl.match(sock.getpeername()[0], port)
+            if not self.rule.allow:
+                sock.close()
+                self._denied(host, port)
+        if sock is None:
+            started = self._loop.time()
+            addr_infos = yield from self.resolver.resolve(host, port)
+            resolved = self._loop.time()
+            if self.acl is not None and self.rule is None:
+                addr_infos, self.rule = self.acl.filter(addr_infos, port)
+                if not addr_infos:
+                    self._denied(host, port)
+            # Early payload rides on the SYN when fast open is possible.
+            fast_open = (self._selection_reply is not None and
+                         bool(self._buffer))
+            sock = yield from staggered_connect(
+                self._loop, addr_infos, self.connect_attempt_delay, fast_open)
+            if self.metrics is not None:
+                # IP literals skip resolving, they would only add zeros.
+                if is_ip_address(host) is None:
+                    self.metrics.dns_seconds.observe(resolved - started)
+                self.metrics.connect_seconds.observe(
+                    self._loop.time() - resolved)
+        try:
+            return (yield from self._loop.create_connection(
+                functools.partial(ServerRemoteProtocol, self), sock=sock))
+        except BaseException:
+            sock.close()
+            raise
+
+    @asyncio.coroutine
+    def _open_upstream(self, host, port):
+        """Open a tunnel through the upstream server, which resolves host."""
+        if self.acl is not None and self.rule is None:
+            # Names no domain rule decides are still checked by address.
+            addr_infos = yield from self.resolver.resolve(host, port)
+            allowed, self.rule = self.acl.filter(addr_infos, port)
+            if not allowed:
+                self._denied(host, port)
+        started = self._loop.time()
+        connection = yield from self.upstream.connect(
+            host, port, functools.partial(ServerRemoteProtocol, self))
+        if self.metrics is not None:
+            self.metrics.connect_seconds.observe(self._loop.time() - started)
+        return connection
+
+    def _denied(self, host, port):
+        logger.info('Connection to {}:{} denied, no address it resolves to '
+                    'is allowed.'.format(host, port), extra=self._log_extra)
+        raise ConnectToRemoteError(Status.NOT_ALLOWED_BY_RULESET)
+
+    def _associate(self):
+        # DST.ADDR and DST.PORT of the request are ignored: a client
+        # behind a NAT cannot know the address its datagrams come from.
+        peername = self.transport_to_client.get_extra_info('peername')
+        logger.info('Associating UDP relay for client {}.'.format(peername),
+                    extra=self._log_extra)
+        self._next_state()
+        self._udp = UdpAssociation(
+            self._loop, peername[0], self.resolver, self.timers,
+            acl=self.acl, metrics=self.metrics,
+            mapping_timeout=self.udp_mapping_timeout,
+            log_extra=self._log_extra)
+        self._udp_task = self._loop.create_task(self._start_association())
+
+    @asyncio.coroutine
+    def _start_association(self):
+        # Datagrams are received on the address the client connected to.
+        sockname = self.transport_to_client.get_extra_info('sockname')
+        try:
+            bound = yield from self._udp.start(sockname[0])
+        except OSError as exc:
+            logger.error('Opening UDP relay failed: {}'.format(exc),
+                         extra=self._log_extra)
+            self._udp_task = None
+            self._reply(Status.GENERAL_FAIL)
+            return
+        self._udp_task = None
+        logger.info('UDP relay bound to {}:{}.'.format(*bound),
+                    extra=self._log_extra)
+
+        self._reply(Status.SUCCEEDED, bound)
+        self._next_state()
+        self._buffer.clear()
+        self.transport_to_client.resume_reading()
+        self._last_active = self._loop.time()
+        if self.idle_timeout:
+            self._idle_timer = self.timers.call_later(
+                self.idle_timeout, self._check_idle)
+
     def _remote_connected(self, future):
         try:
-            self.transport_to_remote = future.result()[0]
+            future.result()
         except ConnectToRemoteError as exc:
-            reply = struct.pack('>B', exc.args[0])
+            self._reply(exc.args[0])
+            return
+
+        if self.transport_to_client.is_closing():
+            # Client went away while remote was being connected.
+            self.transport_to_remote.close()
+            return
+
+        self._reply(Status.SUCCEEDED)
+        self._next_state()
+        self._last_active = self._loop.time()
+        if self.idle_timeout:
+            self._idle_timer = self.timers.call_later(
+                self.idle_timeout, self._check_idle)
+
+        if self.shaper is not None:
+            # Early payload and held remote data count against the
+            # buckets too.
+            self._open_flows()
+        if self._buffer:
+            self._tunneling(bytes(self._buffer))
+            self._buffer.clear()
+        self._start_remote_relaying()
+        if self.client_eof and not self._forward_client_eof():
+            self.transport_to_client.close()
+            return
+
+        # Writing the early payload may have paused the remote leg.
+        self._resume_client_reading()
+        if self._client_writing_paused:
+            # Client stopped draining before remote was connected.
+            self.transport_to_remote.pause_reading()
         else:
-            reply = b'\x00'   
-        
+            self._resume_remote_reading()
+
+        if (self.relay_engine == 'splice' and not self.client_eof and
+                not self.remote_eof and
+                not self.transport_to_remote.is_closing()):
+            self._start_splice_relay()
+
+    def _open_flows(self):
+        peername = self.transport_to_client.get_extra_info('peername')
+        ip = peername[0] if peername else ''
+        self._upload = self.shaper.flow(
+            'to_remote', ip, self.username,
+            self.transport_to_client.pause_reading,
+            self._resume_client_reading)
+        self._download = self.shaper.flow(
+            'to_client', ip, self.username,
+            self.transport_to_remote.pause_reading,
+            self._resume_remote_reading)
+
+    def _resume_client_reading(self):
+        """Resume reading from client unless the tunnel holds it back."""
+        if (self._remote_writing_paused or
+                self._upload_backlog is not None or
+                (self._upload is not None and self._upload.throttled)):
+            return
+        self.transport_to_client.resume_reading()
+
+    def _resume_remote_reading(self):
+        """Resume reading from remote unless the tunnel holds it back."""
+        if (self._client_writing_paused or
+                self._download_backlog is not None or
+                (self._download is not None and self._download.throttled)):
+            return
+        self.transport_to_remote.resume_reading()
+
+    def _defer_upload(self, data):
+        self._upload_backlog = memoryview(data)
+        self.transport_to_client.pause_reading()
+        if self._upload_step():
+            self.scheduler.schedule(self._upload_step)
+
+    def _upload_step(self):
+        """Relay a quantum of the upload backlog, return whether more
+        is left."""
+        backlog = self._upload_backlog
+        if self.transport_to_remote.is_closing():
+            self._upload_backlog = None
+            return False
+        quantum = self.scheduler.quantum
+        self._tunneling(backlog[:quantum])
+        if len(backlog) > quantum:
+            self._upload_backlog = backlog[quantum:]
+            return True
+        self._upload_backlog = None
+        self._resume_client_reading()
+        return False
+
+    def _defer_download(self, data):
+        self._download_backlog = memoryview(data)
+        self.transport_to_remote.pause_reading()
+        if self._download_step():
+            self.scheduler.schedule(self._download_step)
 
+    def _download_step(self):
+        """Relay a quantum of the download backlog, return whether more
+        is left."""
+        backlog = self._download_backlog
+        if self.transport_to_client.is_closing():
+            self._download_backlog = None
+            return False
+        quantum = self.scheduler.quantum
+        self._relay_to_client(backlog[:quantum])
+        if len(backlog) > quantum:
+            self._download_backlog = backlog[quantum:]
+            return True
+        self._download_backlog = None
+        self._resume_remote_reading()
+        return False
+
+    def _close_flows(self):
+        for flow in (self._upload, self._download):
+            if flow is not None:
+                flow.close()
+        self._upload = self._download = None
+
+    def _reply(self, status, bound=None):
+        """Send reply to client request, closing connection on failure.
+
+        bound is the (host, port) replied as BND.ADDR and BND.PORT.
+        """
+        if bound is not None:
+            bound_address = pack_address(*bound)
+        else:
+            # Return empty bndaddr and bndport to client
+            bound_address = (struct.pack('B', AddressType.DomainName) +
+                             b'\x00\x00\x00')
         response_to_client = [
             b'\x05', # protocol version
-            reply,   
+            struct.pack('>B', status),
             b'\x00',  
-            # Return empty bndaddr and bndport to client
-            struct.pack('B', AddressType.DomainName),
-            b'\x00', 
-            b'\x00\x00'
+            bound_address
         ] 
 
         response_to_client = b''.join(response_to_client)
+        if self._selection_reply is not None:
+            response_to_client = self._selection_reply + response_to_client
+            self._selection_reply = None
         self.transport_to_client.write(response_to_client)
 
-        if reply != b'\x00':
+        if status == Status.SUCCEEDED and self._handshake_timer is not None:
+            self._handshake_timer.cancel()
+        if self.metrics is not None:
+            self.metrics.replies.inc(Status.status_name(status))
+            if status == Status.SUCCEEDED:
+                self.metrics.handshake_seconds.observe(
+                    self._loop.time() - self._connected_at)
+
+        if status != Status.SUCCEEDED:
+            self._buffer.clear()
             self.transport_to_client.close() # triggers connection_lost()
+
+    def _start_splice_relay(self):
+        """Move the tunnel off asyncio transports onto a SpliceRelay."""
+        if (self.transport_to_client.get_extra_info('socket') is None or
+                self.transport_to_remote.get_extra_info('socket') is None):
+            # Streams of multiplexed sessions keep relaying through them.
+            return
+        if self.buffered_bytes():
+            # Sockets can only be taken over once transports hold no data.
+            logger.debug('Write buffers not empty, keep relaying '
+                         'through transports.', extra=self._log_extra)
+            return
+
+        client_sock = detach_socket(self.transport_to_client)
+        remote_sock = detach_socket(self.transport_to_remote)
+        self._relay = SpliceRelay(self._loop, client_sock, remote_sock,
+                                  on_closed=self._relay_closed)
+
+        # Sockets are duplicated, so aborting transports does not
+        # terminate connections.
+        self.transport_to_remote.abort()
+        self.transport_to_client.abort()
+        self.transport_to_remote = self.transport_to_client = None
+        self._relay.start()
+
+    def _relay_closed(self, relay):
+        self._release_admission()
+        self._cancel_timers()
+        if self.connections is not None:
+            self.connections.discard(self)
+        if self.metrics is not None:
+            self.metrics.connections.dec(
+                Socks5ProtocolState.state_name(self.state))
+            self.metrics.bytes_relayed.inc(
+                'to_remote', amount=relay.to_remote.transferred)
+            self.metrics.bytes_relayed.inc(
+                'to_client', amount=relay.to_client.transferred)
+        logger.debug(
+            'Tunnel closed after relaying {} bytes to remote and {} bytes '
+            'to client.'.format(relay.to_remote.transferred,
+                                relay.to_client.transferred),
+            extra=self._log_extra)
+
+    def pause_writing(self):
+        """Stop reading from remote until buffer to client drains."""
+        if self._mux is not None:
+            self._mux.pause_writing()
+            return
+        self._client_writing_paused = True
+        logger.debug('Client write buffer full ({} bytes), '
+                     'pausing remote.'.format(
+                         self.transport_to_client.get_write_buffer_size()),
+                     extra=self._log_extra)
+        if self.transport_to_remote:
+            self.transport_to_remote.pause_reading()
+
+    def resume_writing(self):
+        if self._mux is not None:
+            self._mux.resume_writing()
+            return
+        self._client_writing_paused = False
+        if self.transport_to_remote:
+            self._resume_remote_reading()
+
+    def remote_connection_made(self, transport):
+        self.transport_to_remote = transport
+        self.transport_to_remote.set_write_buffer_limits(
+            high=self.write_buffer_high, low=self.write_buffer_low)
+        profile = self._rule_socket_profile()
+        if profile is not None:
+            # Destination's profile takes over the client leg as well.
+            self._apply_socket_profile(profile, self.transport_to_client)
         else:
-            self._next_state()
+            profile = self.socket_profile
+        if profile is not None:
+            self._apply_socket_profile(profile, transport)
+
+    def _rule_socket_profile(self):
+        if self.rule is None or self.rule.profile is None:
+            return None
+        profile = (self.socket_profiles or {}).get(self.rule.profile)
+        if profile is None:
+            logger.warning('Unknown socket profile {} of rule {}.'.format(
+                self.rule.profile, self.rule), extra=self._log_extra)
+        return profile
+
+    def _apply_socket_profile(self, profile, transport):
+        sock = transport.get_extra_info('socket')
+        # Streams of a multiplexed session have no socket.
+        if sock is not None:
+            profile.apply(sock, self._log_extra)
+
+    def remote_data_received(self, data):
+        self._last_active = self._loop.time()
+        if not self.remote_relaying:
+            if self._remote_held is None:
+                self._remote_held = bytearray()
+            self._remote_held.extend(data)
+            self.transport_to_remote.pause_reading()
+            return
+
+        if self.scheduler is not None and len(data) > self.scheduler.quantum:
+            self._defer_download(data)
+        else:
+            self._relay_to_client(data)
+
+    def _relay_to_client(self, data):
+        self.transport_to_client.write(data)
+        if self.metrics is not None:
+            self.metrics.bytes_relayed.inc('to_client', amount=len(data))
+        if self._download is not None:
+            self._download.consume(len(data))
+
+    def _start_remote_relaying(self):
+        """Forward data and half-close held back before CONNECT reply."""
+        self.remote_relaying = True
+        if self._remote_held:
+            self._relay_to_client(bytes(self._remote_held))
+        self._remote_held = None
+        if self.remote_closed:
+            self.transport_to_client.close()
+        elif self.remote_eof and not self._forward_remote_eof():
+            self.transport_to_remote.close()
+
+    def remote_eof_received(self):
+        self.remote_eof = True
+        if not self.remote_relaying:
+            return True
+        return self._forward_remote_eof()
+
+    def _forward_remote_eof(self):
+        """Half-close client side, return False once both sides are done."""
+        if self.client_eof or not self.transport_to_client.can_write_eof():
+            return False
+        logger.debug('Remote sent EOF, half-closing client.',
+                     extra=self._log_extra)
+        self.transport_to_client.write_eof()
+        return True
+
+    def remote_pause_writing(self):
+        """Stop reading from client until buffer to remote drains."""
+        logger.debug('Remote write buffer full ({} bytes), '
+                     'pausing client.'.format(
+                         self.transport_to_remote.get_write_buffer_size()),
+                     extra=self._log_extra)
+        self._remote_writing_paused = True
+        self.transport_to_client.pause_reading()
+
+    def remote_resume_writing(self):
+        self._remote_writing_paused = False
+        self._resume_client_reading()
+
+    def remote_connection_lost(self, exc):
+        """Close client connection when remote connection closed."""
+        self.remote_closed = True
+        if self._relay is not None:
+            return
+        if exc is not None:
+            logger.info(str(exc), extra=self._log_extra)
+        if self.remote_relaying:
+            self.transport_to_client.close()
+
+    def buffered_bytes(self):
+        """Bytes currently held in write buffers of both legs."""
+        buffered = 0
+        for transport in (self.transport_to_client, self.transport_to_remote):
+            if transport is not None:
+                buffered += transport.get_write_buffer_size()
+        return buffered
 
     def connection_lost(self, exc):
         """Close connection to remote when client connection closed."""
 
+        if self._relay is not None:
+            # Sockets were handed over to the relay engine.
+            return
+
+        self._release_admission()
+        self._cancel_timers()
+        self._close_flows()
+        if self.connections is not None:
+            self.connections.discard(self)
+        if self._auth_task is not None:
+            self._auth_task.cancel()
+        if self._udp_task is not None:
+            self._udp_task.cancel()
+        if self._udp is not None:
+            self._udp.close()
+            logger.debug('UDP association closed: {}'.format(
+                self._udp.stats()), extra=self._log_extra)
+        if self._mux is not None:
+            self._mux.connection_lost(exc)
+
+        if self.metrics is not None:
+            self.metrics.connections.dec(
+                Socks5ProtocolState.state_name(self.state))
+
         if exc is not None:
-            self.logger.info(str(exc))
+            logger.info(str(exc), extra=self._log_extra)
+
+        logger.debug(
+            'Client connection closed with {} bytes buffered.'.format(
+                self.buffered_bytes()), extra=self._log_extra)
 
         if self.transport_to_remote:
             self.transport_to_remote.close()
 
     def _tunneling(self, data):
         self.transport_to_remote.write(data)
+        if self.metrics is not None:
+            self.metrics.bytes_relayed.inc('to_remote', amount=len(data))
+        if self._upload is not None:
+            self._upload.consume(len(data))
         
           
 
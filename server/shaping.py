@@ -0,0 +1,173 @@
+"""Bandwidth shaping of tunnels with token buckets.
+
+Each direction of a tunnel draws from buckets of up to four scopes: its
+own, its client IP address, its authenticated user and the whole
+server. Bytes already read are always relayed and may leave a bucket in
+debt; reading on that leg is then paused until all its buckets are
+refilled out of debt. One timer of the Shaper refills buckets and
+resumes throttled flows, in the order they were throttled, however many
+tunnels are open.
+"""
+SCOPES = ('connection', 'ip', 'user', 'global')
+# Seconds of rate a bucket holds when full, how much a flow sends at
+# full speed after being quiet.
+DEFAULT_BURST = 1.0
+# Seconds between refills while any flow is throttled.
+DEFAULT_REFILL_INTERVAL = 0.05
+
+_RATE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+def parse_rate(value):
+    """Parse bytes per second with an optional K, M or G suffix."""
+    unit = value[-1:].upper() if value[-1:].isalpha() else ''
+    number = value[:-1] if unit else value
+    if unit not in _RATE_UNITS:
+        raise ValueError('unknown rate unit {!r}'.format(unit))
+    rate = float(number) * _RATE_UNITS[unit]
+    if rate <= 0:
+        raise ValueError('rate must be positive, got {!r}'.format(value))
+    return rate
+
+def parse_rate_limit(value):
+    """Parse 'scope=rate' into (scope, bytes per second)."""
+    scope, sep, rate = value.partition('=')
+    if not sep or scope not in SCOPES:
+        raise ValueError('rate limit must be SCOPE=RATE with SCOPE one of '
+                         '{}, got {!r}'.format(', '.join(SCOPES), value))
+    return scope, parse_rate(rate)
+
+class TokenBucket:
+
+    __slots__ = ('key', 'rate', 'capacity', 'tokens', 'updated', 'refs')
+
+    def __init__(self, rate, capacity, now, key=None):
+        # (scope, key, direction) of buckets shared between flows.
+        self.key = key
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+        # Flows drawing from the bucket, shared buckets go with the last.
+        self.refs = 0
+
+    def refill(self, now):
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+class Flow:
+    """Bytes relayed in one direction of a tunnel.
+
+    pause is called when a bucket went into debt, resume once all are
+    out of it again.
+    """
+
+    __slots__ = ('shaper', 'buckets', 'pause', 'resume', 'throttled')
+
+    def __init__(self, shaper, buckets, pause, resume):
+        self.shaper = shaper
+        self.buckets = buckets
+        self.pause = pause
+        self.resume = resume
+        self.throttled = False
+
+    def consume(self, amount):
+        now = self.shaper.loop.time()
+        in_debt = False
+        for bucket in self.buckets:
+            bucket.refill(now)
+            bucket.tokens -= amount
+            if bucket.tokens < 0:
+                in_debt = True
+        if in_debt and not self.throttled:
+            self.throttled = True
+            self.shaper.throttle(self)
+            self.pause()
+
+    def close(self):
+        self.shaper.release(self)
+
+class Shaper:
+    """Token buckets of the scopes in rates, scope -> bytes per second."""
+
+    def __init__(self, loop, rates, burst=DEFAULT_BURST,
+                 refill_interval=DEFAULT_REFILL_INTERVAL):
+        self.loop = loop
+        self.rates = dict(rates)
+        self.burst = burst
+        self.refill_interval = refill_interval
+        self._buckets = {} # (scope, key, direction) -> TokenBucket
+        self._throttled = {} # Flow -> None, in the order throttled
+        self._handle = None
+
+        self.throttles = 0
+
+    def stats(self):
+        return {'throttles': self.throttles,
+                'throttled': len(self._throttled),
+                'buckets': len(self._buckets)}
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        self._throttled.clear()
+
+    def flow(self, direction, ip, username, pause, resume):
+        """Open a flow in direction, 'to_remote' or 'to_client', of a
+        tunnel of a client at ip authenticated as username."""
+        now = self.loop.time()
+        buckets = []
+        for scope, key in (('connection', None), ('ip', ip),
+                           ('user', username), ('global', None)):
+            rate = self.rates.get(scope)
+            if rate is None or (scope == 'user' and key is None):
+                continue
+            if scope == 'connection':
+                bucket = TokenBucket(rate, rate * self.burst, now)
+            else:
+                bucket_key = (scope, key, direction)
+                bucket = self._buckets.get(bucket_key)
+                if bucket is None:
+                    bucket = self._buckets[bucket_key] = TokenBucket(
+                        rate, rate * self.burst, now, bucket_key)
+            bucket.refs += 1
+            buckets.append(bucket)
+        return Flow(self, buckets, pause, resume)
+
+    def release(self, flow):
+        self._throttled.pop(flow, None)
+        for bucket in flow.buckets:
+            bucket.refs -= 1
+            if not bucket.refs and bucket.key is not None:
+                # Dropped with the last flow of its client or user, any
+                # debt is forgiven.
+                del self._buckets[bucket.key]
+        flow.buckets = []
+
+    def throttle(self, flow):
+        self.throttles += 1
+        self._throttled[flow] = None
+        if self._handle is None:
+            self._handle = self.loop.call_later(self.refill_interval,
+                                                self._refill)
+
+    def _refill(self):
+        self._handle = None
+        now = self.loop.time()
+        for flow in list(self._throttled):
+            if flow not in self._throttled:
+                # Released by a flow resumed before it.
+                continue
+            in_debt = False
+            for bucket in flow.buckets:
+                bucket.refill(now)
+                if bucket.tokens < 0:
+                    in_debt = True
+            if not in_debt:
+                del self._throttled[flow]
+                flow.throttled = False
+                flow.resume()
+        if self._throttled:
+            self._handle = self.loop.call_later(self.refill_interval,
+                                                self._refill)
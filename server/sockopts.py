@@ -0,0 +1,141 @@
+"""Named socket option profiles applied to both legs of tunnels.
+
+  default      nothing set, kernel and asyncio defaults (asyncio turns
+               Nagle off on its own)
+  interactive  Nagle off and at most 16 KiB not yet sent held in kernel
+               send buffers, so writes go out at once and the write
+               buffer pauses reading early rather than queueing
+  bulk         Nagle on and 4 MiB send and receive buffers for long fat
+               pipes
+
+Both non-default profiles probe idle connections with TCP keepalive.
+Options are tuned and profiles added with --socket-option
+NAME.OPTION=VALUE. A listener applies its profile to client sockets, an
+ACL rule naming a profile has it applied to both legs of tunnels to the
+destinations it allows.
+"""
+import socket
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Option -> type of its value.
+OPTIONS = {
+    'nodelay': bool,
+    'rcvbuf': int,
+    'sndbuf': int,
+    # Seconds idle before the first probe, 0 turns keepalive off.
+    'keepalive_idle': int,
+    'keepalive_interval': int,
+    'keepalive_count': int,
+    'notsent_lowat': int,
+    'congestion': str,
+}
+
+_BOOLEANS = {'1': True, 'on': True, 'true': True, 'yes': True,
+             '0': False, 'off': False, 'false': False, 'no': False}
+
+class SocketProfile:
+
+    __slots__ = ('name',) + tuple(OPTIONS)
+
+    def __init__(self, name, **options):
+        self.name = name
+        for option in OPTIONS:
+            setattr(self, option, options.pop(option, None))
+        if options:
+            raise ValueError('unknown socket option {!r}'.format(
+                next(iter(options))))
+
+    def replace(self, **options):
+        """Return a copy with options changed."""
+        current = {option: getattr(self, option) for option in OPTIONS}
+        current.update(options)
+        return SocketProfile(self.name, **current)
+
+    def _settings(self):
+        """Yield (level, option, value) of the options set."""
+        if self.nodelay is not None:
+            yield socket.IPPROTO_TCP, socket.TCP_NODELAY, int(self.nodelay)
+        if self.rcvbuf is not None:
+            yield socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf
+        if self.sndbuf is not None:
+            yield socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf
+        if self.keepalive_idle is not None:
+            yield socket.SOL_SOCKET, socket.SO_KEEPALIVE, int(
+                self.keepalive_idle > 0)
+            if self.keepalive_idle > 0:
+                # TCP_KEEPALIVE is the name on macOS.
+                idle = getattr(socket, 'TCP_KEEPIDLE',
+                               getattr(socket, 'TCP_KEEPALIVE', None))
+                yield socket.IPPROTO_TCP, idle, self.keepalive_idle
+        if self.keepalive_interval is not None:
+            yield (socket.IPPROTO_TCP, getattr(socket, 'TCP_KEEPINTVL', None),
+                   self.keepalive_interval)
+        if self.keepalive_count is not None:
+            yield (socket.IPPROTO_TCP, getattr(socket, 'TCP_KEEPCNT', None),
+                   self.keepalive_count)
+        if self.notsent_lowat is not None:
+            yield (socket.IPPROTO_TCP,
+                   getattr(socket, 'TCP_NOTSENT_LOWAT', None),
+                   self.notsent_lowat)
+        if self.congestion is not None:
+            yield (socket.IPPROTO_TCP, getattr(socket, 'TCP_CONGESTION', None),
+                   self.congestion.encode())
+
+    def apply(self, sock, log_extra=None):
+        """Set the options on sock, skipping those the platform lacks."""
+        for level, option, value in self._settings():
+            if option is None:
+                continue
+            try:
+                sock.setsockopt(level, option, value)
+            except OSError as exc:
+                logger.debug('Socket option {} of profile {} not set: '
+                             '{}'.format(option, self.name, exc),
+                             extra=log_extra)
+
+    def __repr__(self):
+        return '<SocketProfile {}>'.format(self.name)
+
+_KEEPALIVE = {'keepalive_idle': 60, 'keepalive_interval': 10,
+              'keepalive_count': 6}
+
+PROFILES = {
+    'default': SocketProfile('default'),
+    'interactive': SocketProfile('interactive', nodelay=True,
+                                 notsent_lowat=16 * 1024, **_KEEPALIVE),
+    'bulk': SocketProfile('bulk', nodelay=False, rcvbuf=4 * 1024 * 1024,
+                          sndbuf=4 * 1024 * 1024, **_KEEPALIVE),
+}
+
+def parse_socket_option(value):
+    """Parse 'profile.option=value' into (profile, option, value)."""
+    key, sep, raw = value.partition('=')
+    name, dot, option = key.partition('.')
+    if not sep or not dot or not name:
+        raise ValueError('socket option must be PROFILE.OPTION=VALUE, got '
+                         '{!r}'.format(value))
+    kind = OPTIONS.get(option)
+    if kind is None:
+        raise ValueError('unknown socket option {!r}, one of {}'.format(
+            option, ', '.join(OPTIONS)))
+    if kind is bool:
+        if raw.lower() not in _BOOLEANS:
+            raise ValueError('{} must be on or off, got {!r}'.format(
+                option, raw))
+        return name, option, _BOOLEANS[raw.lower()]
+    if kind is int:
+        if not raw.isdigit():
+            raise ValueError('{} must be a number, got {!r}'.format(
+                option, raw))
+        return name, option, int(raw)
+    return name, option, raw
+
+def build_profiles(options=()):
+    """Return built-in profiles changed and extended by parsed options."""
+    profiles = dict(PROFILES)
+    for name, option, value in options:
+        profile = profiles.get(name) or SocketProfile(name)
+        profiles[name] = profile.replace(**{option: value})
+    return profiles
@@ -0,0 +1,107 @@
+import math
+
+DEFAULT_TICK = 1.0
+DEFAULT_SLOT_COUNT = 512
+
+class Timer:
+
+    __slots__ = ('expires', 'callback', 'args', 'cancelled')
+
+    def __init__(self, expires, callback, args):
+        self.expires = expires
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        # Removed from its slot lazily when the wheel reaches it.
+        self.cancelled = True
+
+class TimerWheel:
+    """Hashed timer wheel for coarse per-connection timeouts.
+
+    Timers are hashed by expiry tick into one of slot_count slots, so
+    scheduling and cancelling are O(1) and a single event loop handle
+    drives all of them, however many connections are open. Timers fire
+    up to one tick late.
+    """
+
+    def __init__(self, loop, tick=DEFAULT_TICK, slot_count=DEFAULT_SLOT_COUNT):
+        self._loop = loop
+        self.tick = tick
+        self._slots = [[] for _ in range(slot_count)]
+        self._pending = 0
+        self._handle = None
+        self._started = loop.time()
+        self.ticks = 0
+
+    def __len__(self):
+        """Timers not yet fired, including cancelled ones not reaped yet."""
+        return self._pending
+
+    def call_later(self, delay, callback, *args):
+        """Call callback(*args) after delay seconds, return its Timer."""
+        if self._handle is None:
+            # Wheel stops turning while empty, skip ticks passed meanwhile.
+            self.ticks = self._current_tick()
+        # Never hash into a slot the wheel already passed.
+        now = max(self.ticks, self._current_tick())
+        timer = Timer(now + max(1, math.ceil(delay / self.tick)),
+                      callback, args)
+        self._slots[timer.expires % len(self._slots)].append(timer)
+        self._pending += 1
+        if self._handle is None:
+            self._schedule()
+        return timer
+
+    def _current_tick(self):
+        return int((self._loop.time() - self._started) / self.tick)
+
+    def _schedule(self):
+        self._handle = self._loop.call_at(
+            self._started + (self.ticks + 1) * self.tick, self._advance)
+
+    def _advance(self):
+        # Turn by as many ticks as passed, a busy loop may run late.
+        target = max(self.ticks + 1, self._current_tick())
+        while self.ticks < target and self._pending:
+            self.ticks += 1
+            index = self.ticks % len(self._slots)
+            slot = self._slots[index]
+            due = [timer for timer in slot if timer.expires <= self.ticks]
+            if not due:
+                continue
+            self._slots[index] = [timer for timer in slot
+                                  if timer.expires > self.ticks]
+            self._pending -= len(due)
+            for timer in due:
+                if not timer.cancelled:
+                    self._run(timer)
+
+        # Handle is kept until here so callbacks scheduling timers do
+        # not move the wheel while it turns.
+        if self._pending:
+            self.ticks = target
+            self._schedule()
+        else:
+            self._handle = None
+
+    def _run(self, timer):
+        # A failing callback must not stop the timers due after it, nor
+        # leave the wheel unscheduled; report it like the loop would.
+        try:
+            timer.callback(*timer.args)
+        except Exception as exc:
+            self._loop.call_exception_handler({
+                'message': 'Exception in timer callback {!r}'.format(
+                    timer.callback),
+                'exception': exc,
+            })
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        for slot in self._slots:
+            slot.clear()
+        self._pending = 0
@@ -0,0 +1,319 @@
+"""Datagram relay of SOCKS5 UDP ASSOCIATE requests.
+
+An association owns one socket its client sends encapsulated datagrams
+to, and one socket per address family datagrams leave for remote hosts
+from. Remote addresses are mapped the way a NAT maps them: a datagram
+from a remote address is relayed to the client only while a mapping,
+created and refreshed by the client sending to that address, is alive.
+"""
+import socket
+import asyncio
+import logging
+import functools
+
+from exception import InvalidRequest
+from server.handshake import parse_udp_header, pack_address
+from server.resolver import is_ip_address
+
+logger = logging.getLogger(__name__)
+
+# Seconds a mapping lives after the client last sent through it, and
+# mappings an association keeps at most.
+DEFAULT_MAPPING_TIMEOUT = 60.0
+DEFAULT_MAX_MAPPINGS = 1024
+# Datagrams held per destination while its domain name is resolved.
+MAX_PENDING_DATAGRAMS = 16
+
+# RSV | FRAG of the header of datagrams relayed to clients.
+_HEADER_PREFIX = b'\x00\x00\x00'
+
+class _Endpoint(asyncio.DatagramProtocol):
+    """Protocol of one socket of an association, handled by the
+    UdpAssociation owning it."""
+
+    __slots__ = ('association', 'transport', 'paused')
+
+    def __init__(self, association):
+        self.association = association
+        self.transport = None
+        # Datagrams are dropped rather than buffered while paused.
+        self.paused = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+
+    def error_received(self, exc):
+        # ICMP errors of datagrams sent earlier, nothing to answer them.
+        logger.debug('UDP relay error: {}'.format(exc),
+                     extra=self.association.log_extra)
+
+class _ClientEndpoint(_Endpoint):
+
+    __slots__ = ()
+
+    def datagram_received(self, data, addr):
+        self.association.client_datagram_received(data, addr)
+
+class _RemoteEndpoint(_Endpoint):
+
+    __slots__ = ()
+
+    def datagram_received(self, data, addr):
+        self.association.remote_datagram_received(data, addr)
+
+class Mapping:
+    """Remote address the client sent datagrams to."""
+
+    __slots__ = ('family', 'address', 'header', 'last_used')
+
+    def __init__(self, family, address, last_used):
+        self.family = family
+        self.address = address
+        # Header of datagrams from address, packed once per mapping.
+        self.header = _HEADER_PREFIX + pack_address(*address)
+        self.last_used = last_used
+
+class UdpAssociation:
+    """Relay of datagrams between one client and any remote hosts.
+
+    Datagrams are accepted from the IP address of the client's TCP
+    connection only, the port of the first of them is where datagrams
+    from remote hosts are sent to. Fragmented datagrams are dropped.
+    Destinations are checked against acl when their mapping is created,
+    a domain name is resolved once for the lifetime of its mapping.
+    """
+
+    def __init__(self, loop, client_host, resolver, timers, acl=None,
+                 metrics=None, mapping_timeout=DEFAULT_MAPPING_TIMEOUT,
+                 max_mappings=DEFAULT_MAX_MAPPINGS, log_extra=None):
+        self._loop = loop
+        self.client_host = client_host
+        self.resolver = resolver
+        self.timers = timers
+        self.acl = acl
+        self.metrics = metrics
+        self.mapping_timeout = mapping_timeout
+        self.max_mappings = max_mappings
+        self.log_extra = log_extra
+        self.closed = False
+        self.last_active = loop.time()
+
+        self._client = None
+        self._client_addr = None
+        self._remotes = {} # family -> _RemoteEndpoint
+        # Destinations as requested by the client and remote addresses
+        # datagrams come from, both -> Mapping.
+        self._routes = {}
+        self._mappings = {}
+        self._resolving = {} # (name, port) -> held payloads
+        self._tasks = set()
+        self._sweep_timer = None
+
+        self.to_remote = 0
+        self.to_client = 0
+        self.dropped = 0
+
+    @asyncio.coroutine
+    def start(self, bind_host):
+        """Open the sockets, return the address clients send datagrams to.
+
+        Raises OSError when the client socket cannot be opened.
+        """
+        _, self._client = yield from self._loop.create_datagram_endpoint(
+            functools.partial(_ClientEndpoint, self),
+            local_addr=(bind_host, 0))
+        for family, any_host in ((socket.AF_INET, '0.0.0.0'),
+                                 (socket.AF_INET6, '::')):
+            try:
+                _, endpoint = yield from self._loop.create_datagram_endpoint(
+                    functools.partial(_RemoteEndpoint, self),
+                    local_addr=(any_host, 0), family=family)
+            except OSError as exc:
+                logger.debug('No UDP relay socket of family {}: {}'.format(
+                    family, exc), extra=self.log_extra)
+                continue
+            self._remotes[family] = endpoint
+        self._sweep_timer = self.timers.call_later(
+            self.mapping_timeout, self._sweep)
+        return self._client.transport.get_extra_info('sockname')[:2]
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self._sweep_timer is not None:
+            self._sweep_timer.cancel()
+        for task in self._tasks:
+            task.cancel()
+        endpoints = list(self._remotes.values())
+        if self._client is not None:
+            endpoints.append(self._client)
+        for endpoint in endpoints:
+            endpoint.transport.close()
+        self._routes.clear()
+        self._mappings.clear()
+
+    def stats(self):
+        return {'to_remote': self.to_remote,
+                'to_client': self.to_client,
+                'dropped': self.dropped,
+                'mappings': len(self._mappings)}
+
+    def _drop(self, reason, count=1):
+        logger.debug('Dropped {} datagram(s): {}.'.format(count, reason),
+                     extra=self.log_extra)
+        self.dropped += count
+        if self.metrics is not None:
+            self.metrics.udp_datagrams.inc('dropped', amount=count)
+
+    def client_datagram_received(self, data, addr):
+        if addr != self._client_addr:
+            if self._client_addr is not None or addr[0] != self.client_host:
+                self._drop('unexpected sender {}'.format(addr))
+                return
+            self._client_addr = addr
+
+        try:
+            frag, host, port, consumed = parse_udp_header(data)
+        except InvalidRequest:
+            self._drop('invalid header')
+            return
+        if frag:
+            self._drop('fragment')
+            return
+
+        now = self._loop.time()
+        self.last_active = now
+        # Payload is sent from a view of the datagram, not a copy.
+        payload = memoryview(data)[consumed:]
+        mapping = self._routes.get((host, port))
+        if mapping is not None:
+            mapping.last_used = now
+            self._send(mapping, payload)
+        else:
+            self._route(host, port, payload)
+
+    def _send(self, mapping, payload):
+        endpoint = self._remotes.get(mapping.family)
+        if endpoint is None:
+            self._drop('no socket of family {}'.format(mapping.family))
+            return
+        if endpoint.paused:
+            self._drop('socket buffer full')
+            return
+        endpoint.transport.sendto(payload, mapping.address)
+        self.to_remote += 1
+        if self.metrics is not None:
+            self.metrics.udp_datagrams.inc('to_remote')
+            self.metrics.bytes_relayed.inc('to_remote', amount=len(payload))
+
+    def _route(self, host, port, payload):
+        """Map a destination the client did not send to before."""
+        family = is_ip_address(host)
+        if family is None:
+            self._resolve_route(host, port, payload)
+            return
+        if self.acl is not None and not self.acl.match(host, port).allow:
+            self._drop('{}:{} denied'.format(host, port))
+            return
+        mapping = self._map(family, (host, port))
+        if mapping is not None:
+            self._routes[(host, port)] = mapping
+            self._send(mapping, payload)
+
+    def _resolve_route(self, name, port, payload):
+        key = (name, port)
+        held = self._resolving.get(key)
+        if held is not None:
+            if len(held) < MAX_PENDING_DATAGRAMS:
+                held.append(payload)
+            else:
+                self._drop('{} still resolving'.format(name))
+            return
+
+        rule = None
+        if self.acl is not None:
+            rule = self.acl.match(name, port)
+            if rule is not None and not rule.allow:
+                self._drop('{}:{} denied'.format(name, port))
+                return
+        self._resolving[key] = [payload]
+        task = self._loop.create_task(self._resolve(name, port, rule))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    @asyncio.coroutine
+    def _resolve(self, name, port, rule):
+        try:
+            addr_infos = yield from self.resolver.resolve(name, port)
+        except (OSError, asyncio.TimeoutError) as exc:
+            logger.debug('Resolving {} failed: {!r}'.format(name, exc),
+                         extra=self.log_extra)
+            addr_infos = []
+        finally:
+            # Later datagrams to name start over instead of being held.
+            held = self._resolving.pop((name, port))
+
+        addr_infos = [info for info in addr_infos if info[0] in self._remotes]
+        if self.acl is not None and rule is None:
+            addr_infos, rule = self.acl.filter(addr_infos, port)
+        if not addr_infos:
+            self._drop('no allowed address of {}'.format(name), len(held))
+            return
+        family, _, _, _, address = addr_infos[0]
+        mapping = self._map(family, address[:2])
+        if mapping is None:
+            self._drop('mapping table full', len(held) - 1)
+            return
+        self._routes[(name, port)] = mapping
+        for payload in held:
+            self._send(mapping, payload)
+
+    def _map(self, family, address):
+        mapping = self._mappings.get(address)
+        if mapping is not None:
+            return mapping
+        if len(self._mappings) >= self.max_mappings:
+            self._drop('mapping table full')
+            return None
+        mapping = self._mappings[address] = Mapping(
+            family, address, self._loop.time())
+        return mapping
+
+    def remote_datagram_received(self, data, addr):
+        now = self._loop.time()
+        mapping = self._mappings.get(addr[:2])
+        if (mapping is None or
+                now - mapping.last_used > self.mapping_timeout):
+            # Endpoint-dependent filtering, like a port-restricted NAT.
+            self._drop('no mapping of {}'.format(addr))
+            return
+        if self._client.paused:
+            self._drop('client socket buffer full')
+            return
+
+        self.last_active = now
+        self._client.transport.sendto(mapping.header + data,
+                                      self._client_addr)
+        self.to_client += 1
+        if self.metrics is not None:
+            self.metrics.udp_datagrams.inc('to_client')
+            self.metrics.bytes_relayed.inc('to_client', amount=len(data))
+
+    def _sweep(self):
+        """Remove mappings and routes through them gone idle."""
+        expired_before = self._loop.time() - self.mapping_timeout
+        self._mappings = {address: mapping
+                          for address, mapping in self._mappings.items()
+                          if mapping.last_used > expired_before}
+        self._routes = {destination: mapping
+                        for destination, mapping in self._routes.items()
+                        if mapping.last_used > expired_before}
+        self._sweep_timer = self.timers.call_later(
+            self.mapping_timeout, self._sweep)
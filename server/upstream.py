@@ -0,0 +1,375 @@
+"""Forwarding of CONNECT requests through an upstream SOCKS5 server.
+
+Tunnels either get a TCP connection of their own to the upstream server,
+or a stream of one of a few long-lived multiplexed sessions to an
+upstream asocks node accepting them, see server.mux.
+"""
+import struct
+import asyncio
+import logging
+
+import auth
+from networking import (SOCK_PROTOCOL_VERSION, AddressType, Command,
+                        ConnectionStatus as Status)
+from exception import InvalidRequest, ConnectToRemoteError
+from server.handshake import parse_request, pack_address
+from server.connector import (staggered_connect, DEFAULT_ATTEMPT_DELAY,
+                              DEFAULT_CONNECT_TIMEOUT)
+from server.mux import MuxSession
+from server.pool import parse_destination
+from server.resolver import is_ip_address
+
+logger = logging.getLogger(__name__)
+
+def parse_upstream(value):
+    """Parse '[username:password@]host:port' into (host, port, username,
+    password), username and password being None when not given."""
+    credentials, sep, destination = value.rpartition('@')
+    host, port = parse_destination(destination)
+    if not sep:
+        return host, port, None, None
+    username, sep, password = credentials.partition(':')
+    if not sep or not username:
+        raise ValueError('upstream credentials must be username:password')
+    return host, port, username, password
+
+def build_connect_request(host, port):
+    """Pack VER | CMD | RSV | ATYP | DST.ADDR | DST.PORT of CONNECT."""
+    if is_ip_address(host) is not None:
+        address = pack_address(host, port)
+    else:
+        name = host.encode('idna')
+        address = (struct.pack('>BB', AddressType.DomainName, len(name)) +
+                   name + struct.pack('>H', port))
+    return struct.pack('>BBB', SOCK_PROTOCOL_VERSION, Command.CONNECT,
+                       0) + address
+
+class UpstreamHandshake(asyncio.Protocol):
+    """Client side of a SOCKS5 handshake on a new transport or stream.
+
+    done resolves once the CONNECT reply arrives, or fails with
+    ConnectToRemoteError carrying the status to reply to the client.
+    Bytes past the reply, and those arriving until hand_over() passes the
+    transport on, are kept for the protocol taking over. With pipeline,
+    greeting, credentials and request are sent in one flight, which only
+    servers reading them as a stream accept.
+    """
+
+    def __init__(self, host, port, username=None, password=None,
+                 pipeline=False):
+        self.request = build_connect_request(host, port)
+        self.username = username
+        self.password = password
+        self.pipeline = pipeline
+        self.done = asyncio.Future()
+        self.transport = None
+        self._buffer = bytearray()
+        self._expecting = 'selection'
+        self._replied = False
+        self._eof = False
+        # (exc,) once the transport is lost after the reply.
+        self._lost = None
+
+    def _auth_request(self):
+        username = self.username.encode('utf-8')
+        password = self.password.encode('utf-8')
+        return (struct.pack('>BB', auth.UsernamePassword.version,
+                            len(username)) + username +
+                struct.pack('>B', len(password)) + password)
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.username is not None:
+            method = auth.UsernamePassword.method_code
+        else:
+            method = auth.NoAuthRequired.method_code
+        greeting = struct.pack('>BBB', SOCK_PROTOCOL_VERSION, 1, method)
+        if not self.pipeline:
+            transport.write(greeting)
+        elif self.username is not None:
+            transport.write(greeting + self._auth_request() + self.request)
+        else:
+            transport.write(greeting + self.request)
+
+    def data_received(self, data):
+        if self._replied:
+            self._buffer.extend(data)
+            return
+        if self.done.done():
+            return
+        self._buffer.extend(data)
+        try:
+            self._process()
+        except InvalidRequest:
+            logger.error('Invalid reply from upstream server.')
+            self._fail(Status.GENERAL_FAIL)
+        except ConnectToRemoteError as exc:
+            self._fail(exc.args[0])
+
+    def _process(self):
+        if self._expecting == 'selection':
+            if len(self._buffer) < 2:
+                return
+            version, method = self._buffer[:2]
+            del self._buffer[:2]
+            if version != SOCK_PROTOCOL_VERSION:
+                raise InvalidRequest
+            if self.username is not None:
+                expected = auth.UsernamePassword.method_code
+            else:
+                expected = auth.NoAuthRequired.method_code
+            if method != expected:
+                logger.error('Upstream server refused authentication '
+                             'method {}.'.format(expected))
+                raise ConnectToRemoteError(Status.GENERAL_FAIL)
+            if self.username is not None:
+                self._expecting = 'auth'
+                if not self.pipeline:
+                    self.transport.write(self._auth_request())
+            else:
+                self._expecting = 'reply'
+                if not self.pipeline:
+                    self.transport.write(self.request)
+
+        if self._expecting == 'auth':
+            if len(self._buffer) < 2:
+                return
+            status = self._buffer[1]
+            del self._buffer[:2]
+            if status != auth.UsernamePassword.SUCCEEDED:
+                logger.error('Upstream server refused credentials of user '
+                             '{}.'.format(self.username))
+                raise ConnectToRemoteError(Status.GENERAL_FAIL)
+            self._expecting = 'reply'
+            if not self.pipeline:
+                self.transport.write(self.request)
+
+        if self._expecting == 'reply':
+            # Replies are laid out like requests, REP in place of CMD.
+            parsed = parse_request(self._buffer)
+            if parsed is None:
+                return
+            status, _, host, _, consumed = parsed
+            if host is None:
+                raise InvalidRequest
+            if status != Status.SUCCEEDED:
+                raise ConnectToRemoteError(status)
+            del self._buffer[:consumed]
+            self._replied = True
+            self.done.set_result(None)
+
+    def hand_over(self, protocol):
+        """Make protocol serve the transport, passing on the bytes, EOF
+        and loss received since the CONNECT reply."""
+        self.transport.set_protocol(protocol)
+        protocol.connection_made(self.transport)
+        if self._buffer:
+            data = bytes(self._buffer)
+            self._buffer.clear()
+            protocol.data_received(data)
+        if self._eof and not protocol.eof_received():
+            self.transport.close()
+        if self._lost is not None:
+            protocol.connection_lost(self._lost[0])
+
+    def _fail(self, status):
+        if not self.done.done():
+            self.done.set_exception(ConnectToRemoteError(status))
+        self.transport.close()
+
+    def eof_received(self):
+        if not self._replied:
+            if not self.done.done():
+                self.done.set_exception(
+                    ConnectToRemoteError(Status.GENERAL_FAIL))
+            return False
+        # The protocol taking over decides whether to close.
+        self._eof = True
+        return True
+
+    def connection_lost(self, exc):
+        if not self.done.done():
+            self.done.set_exception(
+                ConnectToRemoteError(Status.GENERAL_FAIL))
+        elif self._replied:
+            self._lost = (exc,)
+
+class _UpstreamSession(MuxSession):
+    """Session to an upstream node, opened by offering method X'81'."""
+
+    def __init__(self, loop, on_closed=None):
+        super().__init__(loop, on_closed=on_closed)
+        self.ready = asyncio.Future()
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        transport.write(struct.pack('>BBB', SOCK_PROTOCOL_VERSION, 1,
+                                    auth.Multiplex.method_code))
+
+    def data_received(self, data):
+        if not self.ready.done():
+            self._buffer.extend(data)
+            if len(self._buffer) < 2:
+                return
+            if bytes(self._buffer[:2]) != struct.pack(
+                    '>BB', SOCK_PROTOCOL_VERSION, auth.Multiplex.method_code):
+                self.ready.set_exception(
+                    ConnectToRemoteError(Status.GENERAL_FAIL))
+                self.transport.close()
+                return
+            self.ready.set_result(self)
+            data = bytes(self._buffer[2:])
+            self._buffer.clear()
+        super().data_received(data)
+
+    def connection_lost(self, exc):
+        if not self.ready.done():
+            self.ready.set_exception(
+                ConnectToRemoteError(Status.GENERAL_FAIL))
+        super().connection_lost(exc)
+
+class Upstream:
+    """Upstream SOCKS5 server CONNECT requests are forwarded to.
+
+    With mux_connections, tunnels are streams spread over that many
+    sessions to an upstream asocks node run with --accept-mux, so no
+    TCP handshake is paid per tunnel and congestion windows stay warm.
+    Sessions lost are reopened when the next tunnel needs one.
+    """
+
+    def __init__(self, loop, host, port, resolver, username=None,
+                 password=None, mux_connections=0,
+                 attempt_delay=DEFAULT_ATTEMPT_DELAY,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT):
+        self._loop = loop
+        self.host = host
+        self.port = port
+        self.resolver = resolver
+        self.username = username
+        self.password = password
+        self.mux_connections = mux_connections
+        self.attempt_delay = attempt_delay
+        self.connect_timeout = connect_timeout
+        self._sessions = []
+        self._opening = set() # tasks opening sessions
+        self._closed = False
+
+        self.tunnels = 0
+        self.session_failures = 0
+
+    def start(self):
+        for _ in range(self.mux_connections):
+            self._open_session()
+
+    def close(self):
+        self._closed = True
+        for task in self._opening:
+            task.cancel()
+        for session in self._sessions:
+            session.close()
+
+    def stats(self):
+        return {'tunnels': self.tunnels,
+                'sessions': len(self._sessions),
+                'streams': sum(len(session.streams)
+                               for session in self._sessions),
+                'session_failures': self.session_failures}
+
+    @asyncio.coroutine
+    def _connect_socket(self):
+        addr_infos = yield from self.resolver.resolve(self.host, self.port)
+        return (yield from staggered_connect(self._loop, addr_infos,
+                                             self.attempt_delay))
+
+    @asyncio.coroutine
+    def connect(self, host, port, protocol_factory):
+        """Open a tunnel to host:port through the upstream server.
+
+        Returns (transport, protocol) like loop.create_connection().
+        """
+        handshake = UpstreamHandshake(host, port, self.username,
+                                      self.password,
+                                      pipeline=bool(self.mux_connections))
+        if self.mux_connections:
+            session = yield from self._session()
+            transport = session.open_stream(handshake)
+        else:
+            sock = yield from self._connect_socket()
+            try:
+                transport, _ = yield from self._loop.create_connection(
+                    lambda: handshake, sock=sock)
+            except BaseException:
+                sock.close()
+                raise
+        try:
+            yield from handshake.done
+        except BaseException:
+            transport.abort()
+            raise
+
+        self.tunnels += 1
+        protocol = protocol_factory()
+        handshake.hand_over(protocol)
+        return transport, protocol
+
+    @asyncio.coroutine
+    def _session(self):
+        """Return the open session carrying fewest streams."""
+        if len(self._sessions) + len(self._opening) < self.mux_connections:
+            self._open_session()
+        if self._sessions:
+            return min(self._sessions, key=lambda session: len(session.streams))
+        # Waiting must not cancel a session other tunnels wait on.
+        return (yield from asyncio.shield(next(iter(self._opening))))
+
+    def _open_session(self):
+        if self._closed:
+            return
+        task = self._loop.create_task(self._session_opened())
+        self._opening.add(task)
+        task.add_done_callback(self._session_done)
+
+    def _session_done(self, task):
+        self._opening.discard(task)
+        if not task.cancelled():
+            # Failures are logged, tunnels waiting on task get them too.
+            task.exception()
+
+    @asyncio.coroutine
+    def _session_opened(self):
+        try:
+            sock = yield from asyncio.wait_for(self._connect_socket(),
+                                               self.connect_timeout)
+            try:
+                _, session = yield from self._loop.create_connection(
+                    lambda: _UpstreamSession(self._loop,
+                                             on_closed=self._session_closed),
+                    sock=sock)
+            except BaseException:
+                sock.close()
+                raise
+            try:
+                yield from asyncio.wait_for(asyncio.shield(session.ready),
+                                            self.connect_timeout)
+            except BaseException:
+                session.close()
+                raise
+        except (OSError, asyncio.TimeoutError, ConnectToRemoteError) as exc:
+            self.session_failures += 1
+            logger.error('Opening session to upstream {}:{} failed: '
+                         '{}'.format(self.host, self.port,
+                                     type(exc).__name__))
+            raise
+        if self._closed:
+            session.close()
+        else:
+            self._sessions.append(session)
+            logger.info('Opened session to upstream {}:{}.'.format(
+                self.host, self.port))
+        return session
+
+    def _session_closed(self, session):
+        if session in self._sessions:
+            self._sessions.remove(session)
+            logger.warning('Session to upstream {}:{} closed.'.format(
+                self.host, self.port))
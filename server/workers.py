@@ -0,0 +1,97 @@
+import os
+import sys
+import time
+import signal
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Workers dying sooner than this after start are restarted with a delay
+# so a broken configuration does not turn into a fork loop.
+MIN_WORKER_UPTIME = 1.0
+
+def _stop_on_signal(signum, frame):
+    """Turn the first SIGTERM/SIGINT into KeyboardInterrupt, ignore later ones."""
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    raise KeyboardInterrupt
+
+class WorkerSupervisor:
+    """Forks worker processes each running their own event loop.
+
+    Every worker binds the listening address with SO_REUSEPORT so the
+    kernel spreads incoming connections across them. Crashed workers are
+    restarted, SIGTERM/SIGINT received by the supervisor are passed on to
+    all workers.
+    """
+
+    def __init__(self, worker_count, serve, **kwargs):
+        self.worker_count = worker_count
+        self.serve = serve
+        self.kwargs = kwargs
+        self.workers = {} # pid -> (worker index, start time)
+        self._stopping = False
+
+    def _spawn(self, index):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, _stop_on_signal)
+            signal.signal(signal.SIGINT, _stop_on_signal)
+            exit_code = 0
+            try:
+                self.serve(worker_index=index, **self.kwargs)
+            except Exception:
+                logger.exception('Worker {} failed.'.format(os.getpid()))
+                exit_code = 1
+            finally:
+                sys.stdout.flush()
+                os._exit(exit_code)
+
+        self.workers[pid] = (index, time.monotonic())
+        logger.info('Started worker {} ({}).'.format(index, pid))
+
+    def _forward_signal(self, signum, frame):
+        self._stopping = True
+        for pid in self.workers:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._forward_signal)
+        signal.signal(signal.SIGINT, self._forward_signal)
+
+        for index in range(self.worker_count):
+            self._spawn(index)
+
+        while self.workers:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+
+            worker = self.workers.pop(pid, None)
+            if worker is None:
+                continue
+            index, started = worker
+
+            if os.WIFSIGNALED(status):
+                reason = 'signal {}'.format(os.WTERMSIG(status))
+            else:
+                reason = 'exit code {}'.format(os.WEXITSTATUS(status))
+
+            if self._stopping:
+                logger.info('Worker {} stopped with {}.'.format(pid, reason))
+                continue
+
+            logger.error('Worker {} died with {}, restarting.'.format(
+                pid, reason))
+            if time.monotonic() - started < MIN_WORKER_UPTIME:
+                time.sleep(MIN_WORKER_UPTIME)
+            if not self._stopping:
+                self._spawn(index)
+
+        logger.info('All workers stopped.')
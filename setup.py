@@ -16,11 +16,20 @@ setup(
         # 5: Production/Stable
 	'Developemnt Status :: 3 - Alpha',
 
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5'
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10'
     ],
-    packages=['server'],
+    # Protocols are slotted, which asyncio.Protocol only allows from 3.8,
+    # and asyncio.coroutine, which the code is written with, is gone in
+    # 3.11. The tests pass on each version listed above.
+    python_requires='>=3.8, <3.11',
+    packages=['server', 'client'],
     py_modules=['auth', 'networking', 'logger', 'exception'],
+    extras_require={
+        'uvloop': ['uvloop'],
+        'bcrypt': ['bcrypt'],
+    },
     entry_points={
         'console_scripts':[
             'asocks-server=server.__main__:main' 
@@ -0,0 +1,85 @@
+"""Transports and protocols standing in for sockets in tests."""
+import asyncio
+
+class FakeTransport(asyncio.Transport):
+    """Transport recording writes, driving the protocol it is given."""
+
+    def __init__(self, protocol=None):
+        super().__init__()
+        self.protocol = protocol
+        self.written = bytearray()
+        self.eof_written = False
+        self.closed = False
+        self.aborted = False
+        self.reading_paused = False
+
+    def set_protocol(self, protocol):
+        self.protocol = protocol
+
+    def get_protocol(self):
+        return self.protocol
+
+    def get_extra_info(self, name, default=None):
+        return default
+
+    def write(self, data):
+        self.written.extend(data)
+
+    def writelines(self, chunks):
+        for data in chunks:
+            self.write(data)
+
+    def write_eof(self):
+        self.eof_written = True
+
+    def can_write_eof(self):
+        return True
+
+    def pause_reading(self):
+        self.reading_paused = True
+
+    def resume_reading(self):
+        self.reading_paused = False
+
+    def is_closing(self):
+        return self.closed
+
+    def close(self):
+        self.closed = True
+
+    def abort(self):
+        self.aborted = self.closed = True
+
+class RecordingProtocol(asyncio.Protocol):
+    """Protocol recording what its transport hands it."""
+
+    def __init__(self, keep_open=True):
+        self.keep_open = keep_open
+        self.transport = None
+        self.received = bytearray()
+        self.eof = False
+        self.lost = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.received.extend(data)
+
+    def eof_received(self):
+        self.eof = True
+        return self.keep_open
+
+    def connection_lost(self, exc):
+        self.lost = True
+
+class LoopTestCase:
+    """Mixin giving each test an event loop of its own."""
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
@@ -0,0 +1,127 @@
+import random
+import socket
+import unittest
+
+from exception import InvalidRuleset
+from server.acl import Ruleset, PrefixTree, DomainTree, AccessList
+
+RULES = '''
+# comment
+allow 10.0.0.0/8
+deny  10.1.0.0/16 22
+allow 10.1.2.0/24 22 profile=interactive
+deny  10.1.2.3
+allow 2001:db8::/32 443
+allow example.com 80,443,8000-8100
+deny  ads.example.com
+allow *  443
+'''
+
+def ruleset():
+    return Ruleset.parse(RULES.splitlines())
+
+class PrefixTreeTest(unittest.TestCase):
+
+    def test_matches_like_a_linear_scan(self):
+        # Seeded so a failure reproduces.
+        generator = random.Random(17)
+        tree = PrefixTree(32)
+        prefixes = []
+        for index in range(300):
+            length = generator.choice((0, 1, 7, 8, 16, 20, 24, 31, 32))
+            key = generator.getrandbits(32)
+            if length < 32:
+                key &= ~((1 << (32 - length)) - 1) & 0xffffffff
+            tree.insert(key, length, index)
+            prefixes.append((key, length, index))
+        for _ in range(2000):
+            address = generator.choice(prefixes)[0]
+            # Flip some host bits of a known prefix, or none at all;
+            # getrandbits(0) is only allowed from Python 3.9.
+            host_bits = generator.choice((0, 4, 12, 32))
+            if host_bits:
+                address ^= generator.getrandbits(host_bits)
+            expected = {}
+            for key, length, index in prefixes:
+                if (address ^ key) >> (32 - length) == 0:
+                    expected.setdefault(length, []).append(index)
+            self.assertEqual(tree.lookup(address),
+                             [expected[length] for length in sorted(expected)])
+
+class DomainTreeTest(unittest.TestCase):
+
+    def test_suffixes_longest_last(self):
+        tree = DomainTree()
+        tree.insert('com', 'com')
+        tree.insert('example.com', 'example')
+        tree.insert('a.example.com', 'a')
+        self.assertEqual(tree.lookup('x.a.example.com'),
+                         [['com'], ['example'], ['a']])
+        self.assertEqual(tree.lookup('example.org'), [])
+        # Labels match whole, not as string suffixes.
+        self.assertEqual(tree.lookup('badexample.com'), [['com']])
+
+class RulesetTest(unittest.TestCase):
+
+    def assertDecision(self, rule, allow, lineno=None):
+        self.assertEqual(rule.allow, allow)
+        if lineno is not None:
+            self.assertEqual(rule.lineno, lineno)
+
+    def test_most_specific_network_wins(self):
+        rules = ruleset()
+        self.assertDecision(rules.match_address('10.9.9.9', 22), True, 3)
+        self.assertDecision(rules.match_address('10.1.9.9', 22), False, 4)
+        self.assertDecision(rules.match_address('10.1.9.9', 80), True, 3)
+        rule = rules.match_address('10.1.2.9', 22)
+        self.assertDecision(rule, True, 5)
+        self.assertEqual(rule.profile, 'interactive')
+        self.assertDecision(rules.match_address('10.1.2.3', 22), False, 6)
+
+    def test_any_and_default(self):
+        rules = ruleset()
+        self.assertDecision(rules.match_address('192.0.2.1', 443), True, 10)
+        self.assertDecision(rules.match_address('192.0.2.1', 80), False)
+        self.assertDecision(rules.match_address('2001:db8::1', 443), True, 7)
+        self.assertDecision(rules.match_address('2001:db9::1', 22), False)
+
+    def test_domains(self):
+        rules = ruleset()
+        self.assertDecision(rules.match_domain('www.Example.com.', 8050),
+                            True, 8)
+        self.assertDecision(rules.match_domain('ads.example.com', 443),
+                            False, 9)
+        self.assertIsNone(rules.match_domain('example.com', 22))
+        self.assertIsNone(rules.match_domain('example.org', 80))
+        self.assertEqual(rules.profiles, {'interactive'})
+        self.assertEqual(rules.count, 8)
+
+    def test_invalid_rules(self):
+        for line in ('permit 10.0.0.0/8', 'allow 10.0.0.1/8',
+                     'allow 10.0.0.0/33', 'allow example.com 0',
+                     'allow example.com 90-80', 'allow',
+                     'allow example.com 80 tls=on'):
+            with self.subTest(line=line):
+                with self.assertRaises(InvalidRuleset):
+                    Ruleset.parse([line])
+
+class AccessListTest(unittest.TestCase):
+
+    def access_list(self):
+        access_list = AccessList(None, '<rules>')
+        access_list.ruleset = ruleset()
+        return access_list
+
+    def test_domain_decided_by_addresses(self):
+        access_list = self.access_list()
+        self.assertIsNone(access_list.match('unknown.test', 443))
+        infos = [(socket.AF_INET, socket.SOCK_STREAM, 6, '', (host, 22))
+                 for host in ('10.1.2.3', '10.1.2.4', '10.2.0.1')]
+        allowed, rule = access_list.filter(infos, 22)
+        self.assertEqual([info[4][0] for info in allowed],
+                         ['10.1.2.4', '10.2.0.1'])
+        self.assertEqual(rule.profile, 'interactive')
+        self.assertEqual(access_list.stats()['allowed'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
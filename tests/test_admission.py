@@ -0,0 +1,43 @@
+import unittest
+
+from server.admission import AdmissionController
+from tests.helpers import LoopTestCase
+
+class AdmissionTest(LoopTestCase, unittest.TestCase):
+
+    def test_unlimited_by_default(self):
+        admission = AdmissionController(self.loop, None)
+        for _ in range(1000):
+            self.assertTrue(admission.try_admit('10.0.0.1'))
+        self.assertEqual(admission.stats()['active'], 1000)
+
+    def test_per_ip_without_global_limit(self):
+        admission = AdmissionController(self.loop, None, max_per_ip=2)
+        self.assertTrue(admission.try_admit('10.0.0.1'))
+        self.assertTrue(admission.try_admit('10.0.0.1'))
+        self.assertFalse(admission.try_admit('10.0.0.1'))
+        self.assertTrue(admission.try_admit('10.0.0.2'))
+        self.assertEqual(admission.shed_per_ip, 1)
+        self.assertEqual(admission.shed_global, 0)
+
+    def test_global_limit(self):
+        admission = AdmissionController(self.loop, 2)
+        self.assertTrue(admission.try_admit('10.0.0.1'))
+        self.assertTrue(admission.try_admit('10.0.0.2'))
+        self.assertFalse(admission.try_admit('10.0.0.3'))
+        admission.release('10.0.0.1')
+        self.assertTrue(admission.try_admit('10.0.0.3'))
+        self.assertEqual(admission.shed_global, 1)
+
+    def test_queued_connection_gets_released_slot(self):
+        admission = AdmissionController(self.loop, 1, policy='queue',
+                                        queue_timeout=1)
+        self.assertTrue(admission.try_admit('10.0.0.1'))
+        self.assertFalse(admission.try_admit('10.0.0.2'))
+        waiting = self.loop.create_task(admission.wait_admit('10.0.0.2'))
+        self.loop.call_soon(admission.release, '10.0.0.1')
+        self.assertTrue(self.loop.run_until_complete(waiting))
+        self.assertEqual(admission.stats()['active'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
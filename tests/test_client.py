@@ -0,0 +1,99 @@
+import unittest
+
+from exception import ProtocolError, ProxyAuthError, RequestNotSucceed
+from client.client_protocol import (ClientProtocol, ClientState,
+                                    build_connect_request, reply_length)
+from tests.helpers import FakeTransport, RecordingProtocol, LoopTestCase
+
+REPLY = b'\x05\x00\x00\x01\x0a\x00\x00\x01\x04\x38'
+DEST = ('example.com', 25)
+
+class ConnectRequestTest(unittest.TestCase):
+
+    def test_address_types(self):
+        self.assertEqual(build_connect_request(('10.0.0.1', 80)),
+                         b'\x05\x01\x00\x01\x0a\x00\x00\x01\x00\x50')
+        self.assertEqual(build_connect_request(('::1', 80))[3], 4)
+        self.assertEqual(build_connect_request(DEST),
+                         b'\x05\x01\x00\x03\x0bexample.com\x00\x19')
+
+    def test_reply_length(self):
+        self.assertEqual(reply_length(REPLY[:5]), len(REPLY))
+        self.assertEqual(reply_length(b'\x05\x00\x00\x03\x04'), 11)
+        with self.assertRaises(ProtocolError):
+            reply_length(b'\x04\x00\x00\x01\x00')
+
+class ClientProtocolTest(LoopTestCase, unittest.TestCase):
+
+    def protocol(self, *args, **kwargs):
+        protocol = ClientProtocol(*args, **kwargs)
+        transport = FakeTransport(protocol)
+        protocol.connection_made(transport)
+        return protocol, transport
+
+    def test_pipelined_handshake(self):
+        protocol, transport = self.protocol('bob', 'secret', DEST)
+        self.assertEqual(bytes(transport.written),
+                         b'\x05\x01\x02\x01\x03bob\x06secret' +
+                         build_connect_request(DEST))
+        protocol.data_received(b'\x05\x02\x01\x00' + REPLY)
+        self.assertEqual(protocol.state, ClientState.CONNECTED_TO_REMOTE)
+        self.assertTrue(protocol.connected.done())
+
+    def test_connect_after_negotiation(self):
+        protocol, transport = self.protocol(pipeline=False)
+        protocol.data_received(b'\x05\x00')
+        self.assertTrue(protocol.negotiated.done())
+        written = len(transport.written)
+        connected = protocol.connect(DEST)
+        self.assertEqual(bytes(transport.written[written:]),
+                         build_connect_request(DEST))
+        protocol.data_received(REPLY)
+        self.assertTrue(connected.done())
+
+    def test_reply_and_data_in_one_read(self):
+        protocol, transport = self.protocol(dest=DEST)
+        protocol.data_received(b'\x05\x00' + REPLY + b'220 mail')
+        # More arrives before the caller's protocol takes over.
+        protocol.data_received(b'.example.com ESMTP\r\n')
+        protocol.eof_received()
+        self.loop.run_until_complete(protocol.connected)
+        stream = RecordingProtocol()
+        protocol.hand_over(stream)
+        self.assertIs(transport.protocol, stream)
+        self.assertEqual(bytes(stream.received),
+                         b'220 mail.example.com ESMTP\r\n')
+        self.assertTrue(stream.eof)
+        self.assertFalse(transport.closed)
+
+    def test_loss_before_hand_over(self):
+        protocol, transport = self.protocol(dest=DEST)
+        protocol.data_received(b'\x05\x00' + REPLY)
+        protocol.connection_lost(None)
+        self.loop.run_until_complete(protocol.connected)
+        stream = RecordingProtocol()
+        protocol.hand_over(stream)
+        self.assertTrue(stream.lost)
+
+    def test_refused_request(self):
+        protocol, transport = self.protocol(dest=DEST)
+        protocol.data_received(b'\x05\x00\x05\x02' + REPLY[2:])
+        with self.assertRaises(RequestNotSucceed):
+            self.loop.run_until_complete(protocol.connected)
+        self.assertTrue(transport.closed)
+
+    def test_refused_credentials(self):
+        protocol, transport = self.protocol('bob', 'wrong')
+        protocol.data_received(b'\x05\x02\x01\x01')
+        with self.assertRaises(ProxyAuthError):
+            self.loop.run_until_complete(protocol.negotiated)
+
+    def test_eof_during_handshake(self):
+        protocol, transport = self.protocol(dest=DEST)
+        protocol.data_received(b'\x05\x00')
+        protocol.eof_received()
+        with self.assertRaises(ProtocolError):
+            self.loop.run_until_complete(protocol.connected)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import socket
+import unittest
+from unittest import mock
+
+from server import connector
+from server.connector import interleave_addr_infos, staggered_connect
+from tests.helpers import LoopTestCase
+
+def addr_info(family, host):
+    return (family, socket.SOCK_STREAM, socket.IPPROTO_TCP, '', (host, 0))
+
+class InterleaveTest(unittest.TestCase):
+
+    def test_alternates_families(self):
+        infos = [addr_info(socket.AF_INET6, '::1'),
+                 addr_info(socket.AF_INET6, '::2'),
+                 addr_info(socket.AF_INET6, '::3'),
+                 addr_info(socket.AF_INET, '10.0.0.1')]
+        self.assertEqual([info[4][0] for info in interleave_addr_infos(infos)],
+                         ['::1', '10.0.0.1', '::2', '::3'])
+
+class RecordingSocket(socket.socket):
+
+    options = []
+
+    def setsockopt(self, level, option, value):
+        self.options.append((level, option))
+        super().setsockopt(level, option, value)
+
+class StaggeredConnectTest(LoopTestCase, unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.listening = socket.socket()
+        self.listening.bind(('127.0.0.1', 0))
+        self.listening.listen(4)
+        self.addCleanup(self.listening.close)
+        RecordingSocket.options = []
+
+    def connect(self, fast_open):
+        infos = [(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP, '',
+                  self.listening.getsockname())]
+        with mock.patch.object(connector.socket, 'socket', RecordingSocket):
+            sock = self.loop.run_until_complete(
+                staggered_connect(self.loop, infos, fast_open=fast_open))
+        sock.close()
+
+    def test_fast_open_off_without_the_option(self):
+        with mock.patch.object(connector, 'TCP_FASTOPEN_CONNECT', None):
+            self.connect(fast_open=True)
+        self.assertEqual(RecordingSocket.options, [])
+
+    @unittest.skipUnless(connector.TCP_FASTOPEN_CONNECT is not None,
+                         'no TCP_FASTOPEN_CONNECT on this platform')
+    def test_fast_open(self):
+        self.connect(fast_open=True)
+        self.assertEqual(RecordingSocket.options,
+                         [(socket.IPPROTO_TCP, connector.TCP_FASTOPEN_CONNECT)])
+
+if __name__ == '__main__':
+    unittest.main()
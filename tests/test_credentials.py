@@ -0,0 +1,143 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from server import credentials
+from server.credentials import (PlainCredentialStore, HtpasswdCredentialStore,
+                                md5_crypt)
+from tests.helpers import LoopTestCase
+
+HASHES = {
+    '{SHA}': '{SHA}5en6G6MezRroT3XKqkdPOmY/BfQ=',
+    '$apr1$': '$apr1$r31..G5a$lcOkaGj3zqnmF/DVL1Elh.',
+    '$1$': '$1$abcdefgh$cHJi5PXp/ki/ktXzqlk6I1',
+    '$5$': '$5$saltsalt$0IyaXrmV7.sGNS6tirgqHLqX/G.FBvgkYA.lpPdS5sA',
+    '$6$': ('$6$saltsalt$TVLlQcbpFVof5W3Yz4DTP6gRstiNuHwwTt6GLc1E5n0U0aDehy0'
+            'S5knV8wiOQSpT0Y77vwPZN.Pq.H91p5hVO1'),
+}
+
+class Md5CryptTest(unittest.TestCase):
+
+    def test_apache_and_freebsd_vectors(self):
+        self.assertEqual(md5_crypt(b'secret', 'r31..G5a', '$apr1$'),
+                         HASHES['$apr1$'])
+        self.assertEqual(md5_crypt(b'secret', 'abcdefgh', '$1$'),
+                         HASHES['$1$'])
+
+class StoreTestCase(LoopTestCase):
+
+    def store(self, store_class, lines):
+        fd, path = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as users:
+            users.write('\n'.join(lines) + '\n')
+        self.addCleanup(os.unlink, path)
+        store = store_class(self.loop, path)
+        store.load()
+        return store
+
+    def verify(self, store, username, password):
+        return self.loop.run_until_complete(
+            store.verify(username.encode(), password.encode()))
+
+class PlainCredentialStoreTest(StoreTestCase, unittest.TestCase):
+
+    def test_verify(self):
+        store = self.store(PlainCredentialStore,
+                           ['# comment', 'alice:secret', 'broken'])
+        self.assertEqual(store.stats()['users'], 1)
+        self.assertTrue(self.verify(store, 'alice', 'secret'))
+        self.assertFalse(self.verify(store, 'alice', 'wrong'))
+        self.assertFalse(self.verify(store, 'mallory', 'secret'))
+
+    def test_reload_drops_cached_password(self):
+        store = self.store(PlainCredentialStore, ['alice:secret'])
+        self.assertTrue(self.verify(store, 'alice', 'secret'))
+        with open(store.path, 'w') as users:
+            users.write('alice:changed\n')
+        store.load()
+        self.assertFalse(self.verify(store, 'alice', 'secret'))
+        self.assertTrue(self.verify(store, 'alice', 'changed'))
+
+    def test_reload_in_executor(self):
+        store = self.store(PlainCredentialStore, ['alice:secret'])
+        with open(store.path, 'w') as users:
+            users.write('alice:secret\nbob:other\n')
+        store._file_stamp = None
+        with mock.patch.object(store, '_read', wraps=store._read) as read:
+            store._reload_if_changed()
+            # Nothing is read on the loop itself.
+            read.assert_not_called()
+            self.assertEqual(store.stats()['users'], 1)
+            self.loop.run_until_complete(store._reloading)
+        read.assert_called_once_with()
+        self.assertEqual(store.stats()['users'], 2)
+        self.assertEqual(store.reloads, 1)
+        self.assertIsNotNone(store._reload_handle)
+        store.close()
+
+class HtpasswdCredentialStoreTest(StoreTestCase, unittest.TestCase):
+
+    def schemes(self):
+        schemes = ['{SHA}', '$apr1$', '$1$']
+        if credentials.crypt is not None:
+            schemes += ['$5$', '$6$']
+        return schemes
+
+    def test_schemes(self):
+        for scheme in self.schemes():
+            with self.subTest(scheme=scheme):
+                store = self.store(HtpasswdCredentialStore,
+                                   ['alice:' + HASHES[scheme]])
+                self.assertTrue(self.verify(store, 'alice', 'secret'))
+                self.assertFalse(self.verify(store, 'alice', 'Secret'))
+
+    @unittest.skipIf(credentials.bcrypt is None, 'bcrypt not installed')
+    def test_bcrypt(self):
+        hashed = credentials.bcrypt.hashpw(
+            b'secret', credentials.bcrypt.gensalt(4)).decode('ascii')
+        store = self.store(HtpasswdCredentialStore, ['alice:' + hashed])
+        self.assertTrue(self.verify(store, 'alice', 'secret'))
+        self.assertTrue(store._dummy.startswith(hashed[:7]))
+
+    def test_unsupported_hash_skipped(self):
+        store = self.store(HtpasswdCredentialStore,
+                           ['alice:$9$whatever', 'bob:' + HASHES['$apr1$']])
+        self.assertEqual(store.stats()['users'], 1)
+
+    def test_unknown_user_checked_against_dummy(self):
+        for scheme in self.schemes():
+            with self.subTest(scheme=scheme):
+                store = self.store(HtpasswdCredentialStore,
+                                   ['alice:' + HASHES[scheme]])
+                self.assertTrue(store._dummy.startswith(scheme))
+                self.assertNotEqual(store._dummy, HASHES[scheme])
+                checked = []
+                verify = store._verify
+                store._verify = lambda verifier, password: checked.append(
+                    verifier) or verify(verifier, password)
+                self.assertFalse(self.verify(store, 'mallory', 'secret'))
+                self.assertEqual(checked, [store._dummy])
+
+    @unittest.skipIf(credentials.crypt is None, 'crypt not available')
+    def test_dummy_when_crypt_rejects_salt(self):
+        with mock.patch.object(credentials.crypt, 'crypt', return_value=None):
+            store = self.store(HtpasswdCredentialStore,
+                               ['alice:' + HASHES['$6$']])
+        # Still checked at the cost of a real secret, never refused early.
+        self.assertEqual(store._dummy, HASHES['$6$'])
+        checked = []
+        verify = store._verify
+        store._verify = lambda verifier, password: checked.append(
+            verifier) or verify(verifier, password)
+        # Refused even though the password matches the dummy.
+        self.assertFalse(self.verify(store, 'mallory', 'secret'))
+        self.assertEqual(checked, [HASHES['$6$']])
+
+    def test_no_users_refuses_at_once(self):
+        store = self.store(HtpasswdCredentialStore, ['# nobody'])
+        self.assertIsNone(store._dummy)
+        self.assertFalse(self.verify(store, 'mallory', 'secret'))
+
+if __name__ == '__main__':
+    unittest.main()
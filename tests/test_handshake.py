@@ -0,0 +1,99 @@
+import unittest
+
+from exception import InvalidRequest, WrongProtocol
+from networking import AddressType
+from server.handshake import (parse_greeting, parse_auth_request,
+                              parse_request, parse_udp_header, pack_address)
+
+GREETING = b'\x05\x02\x00\x02'
+AUTH = b'\x01\x05alice\x06secret'
+REQUESTS = {
+    ('10.0.0.1', 80): b'\x05\x01\x00\x01\x0a\x00\x00\x01\x00\x50',
+    ('2001:db8::1', 443): (b'\x05\x01\x00\x04' +
+                           bytes.fromhex('20010db8' + '00' * 11 + '01') +
+                           b'\x01\xbb'),
+    ('example.com', 22): b'\x05\x01\x00\x03\x0bexample.com\x00\x16',
+}
+
+class IncrementalParseTest(unittest.TestCase):
+
+    def assertIncremental(self, parse, message):
+        """Every proper prefix of message is incomplete."""
+        for end in range(len(message)):
+            self.assertIsNone(parse(bytearray(message[:end])),
+                              'prefix of {} bytes'.format(end))
+
+    def test_greeting(self):
+        self.assertIncremental(parse_greeting, GREETING)
+        self.assertEqual(parse_greeting(bytearray(GREETING + AUTH)),
+                         (b'\x00\x02', len(GREETING)))
+        with self.assertRaises(WrongProtocol):
+            parse_greeting(b'\x04\x01\x00')
+        with self.assertRaises(InvalidRequest):
+            parse_greeting(b'\x05\x00')
+
+    def test_auth_request(self):
+        self.assertIncremental(parse_auth_request, AUTH)
+        self.assertEqual(parse_auth_request(bytearray(AUTH + b'\x05')),
+                         (b'alice', b'secret', len(AUTH)))
+        self.assertEqual(parse_auth_request(b'\x01\x00\x00'),
+                         (b'', b'', 3))
+        with self.assertRaises(InvalidRequest):
+            parse_auth_request(b'\x05\x01')
+
+    def test_requests(self):
+        for (host, port), message in REQUESTS.items():
+            with self.subTest(host=host):
+                self.assertIncremental(parse_request, message)
+                command, _, parsed_host, parsed_port, consumed = (
+                    parse_request(bytearray(message + b'early data')))
+                self.assertEqual((command, parsed_host, parsed_port),
+                                 (1, host, port))
+                self.assertEqual(consumed, len(message))
+
+    def test_pipelined_handshake(self):
+        buffer = bytearray(GREETING + AUTH +
+                           REQUESTS[('example.com', 22)] + b'GET')
+        _, consumed = parse_greeting(buffer)
+        del buffer[:consumed]
+        _, _, consumed = parse_auth_request(buffer)
+        del buffer[:consumed]
+        *_, consumed = parse_request(buffer)
+        self.assertEqual(bytes(buffer[consumed:]), b'GET')
+
+    def test_unsupported_address_type(self):
+        self.assertEqual(parse_request(b'\x05\x01\x00\x09\x00'),
+                         (1, 9, None, None, 4))
+
+    def test_invalid_domain_name(self):
+        with self.assertRaises(InvalidRequest):
+            parse_request(b'\x05\x01\x00\x03\x01\xff\x00\x50')
+        with self.assertRaises(WrongProtocol):
+            parse_request(b'\x04\x01\x00\x01\x00')
+
+class UdpHeaderTest(unittest.TestCase):
+
+    def test_header(self):
+        datagram = b'\x00\x00\x00' + pack_address('10.0.0.1', 53) + b'query'
+        frag, host, port, consumed = parse_udp_header(datagram)
+        self.assertEqual((frag, host, port), (0, '10.0.0.1', 53))
+        self.assertEqual(datagram[consumed:], b'query')
+
+    def test_truncated(self):
+        datagram = b'\x00\x00\x00' + pack_address('10.0.0.1', 53)
+        for end in range(len(datagram)):
+            with self.assertRaises(InvalidRequest):
+                parse_udp_header(datagram[:end])
+        with self.assertRaises(InvalidRequest):
+            parse_udp_header(b'\x00\x00\x00\x09\x00\x00')
+
+class PackAddressTest(unittest.TestCase):
+
+    def test_families(self):
+        self.assertEqual(pack_address('10.0.0.1', 80)[0], AddressType.IPv4)
+        self.assertEqual(pack_address('fe80::1%eth0', 80),
+                         pack_address('fe80::1', 80))
+        self.assertEqual(len(pack_address('::1', 80)), 1 + 16 + 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import os
+import socket
+import unittest
+
+from server import lifecycle
+
+class HandoffTest(unittest.TestCase):
+
+    def setUp(self):
+        self.listening = []
+        for _ in range(2):
+            sock = socket.socket()
+            sock.bind(('127.0.0.1', 0))
+            sock.listen(1)
+            self.listening.append(sock)
+
+    def tearDown(self):
+        for sock in self.listening:
+            sock.close()
+
+    def test_fds_with_listener_indexes(self):
+        sender, receiver = socket.socketpair()
+        with sender, receiver:
+            lifecycle._send_fds(sender, bytes([0, 3]),
+                                [sock.fileno() for sock in self.listening])
+            data, fds = lifecycle._recv_fds(receiver, 16, 16)
+        sockets = lifecycle._by_listener(data, fds)
+        self.assertEqual(sorted(sockets), [0, 3])
+        for index, sock in zip((0, 3), self.listening):
+            received, = sockets[index]
+            with received:
+                self.assertEqual(received.getsockname(), sock.getsockname())
+
+    def test_inherited_sockets(self):
+        ready, child_ready = socket.socketpair()
+        duplicates = [os.dup(sock.fileno()) for sock in self.listening]
+        os.environ[lifecycle.LISTEN_FDS_ENV] = '0:{},1:{}'.format(*duplicates)
+        os.environ[lifecycle.READY_FD_ENV] = str(os.dup(child_ready.fileno()))
+        child_ready.close()
+        sockets, channel = lifecycle.inherited_sockets()
+        self.assertNotIn(lifecycle.LISTEN_FDS_ENV, os.environ)
+        lifecycle.notify_ready(channel)
+        with ready:
+            self.assertEqual(ready.recv(1), lifecycle._READY)
+        for index, sock in enumerate(self.listening):
+            received, = sockets[index]
+            with received:
+                self.assertEqual(received.getsockname(), sock.getsockname())
+
+    def test_nothing_inherited(self):
+        os.environ.pop(lifecycle.LISTEN_FDS_ENV, None)
+        self.assertIsNone(lifecycle.inherited_sockets())
+
+if __name__ == '__main__':
+    unittest.main()
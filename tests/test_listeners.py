@@ -0,0 +1,87 @@
+import os
+import stat
+import socket
+import asyncio
+import tempfile
+import unittest
+from unittest import mock
+
+from server.listeners import Listener, parse_listen
+from tests.helpers import LoopTestCase, RecordingProtocol
+
+class ParseListenTest(unittest.TestCase):
+
+    def test_options(self):
+        listener = parse_listen('unix:/run/asocks.sock,mode=660,auth=off')
+        self.assertEqual(listener.path, '/run/asocks.sock')
+        self.assertEqual(listener.mode, 0o660)
+        self.assertFalse(listener.auth)
+        listener = parse_listen('[::1]:1080,backlog=64,profile=bulk')
+        self.assertEqual((listener.host, listener.port), ('::1', 1080))
+        self.assertEqual((listener.backlog, listener.profile), (64, 'bulk'))
+        self.assertEqual(str(listener), '[::1]:1080')
+
+    def test_invalid(self):
+        for value in ('unix:', '127.0.0.1:1080,mode=600',
+                      '127.0.0.1:1080,auth=maybe', '127.0.0.1:1080,backlog'):
+            with self.subTest(value=value), self.assertRaises(ValueError):
+                parse_listen(value)
+
+class UnixListenerTest(LoopTestCase, unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(os.rmdir, directory)
+        self.path = os.path.join(directory, 'asocks.sock')
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.close()
+            self.loop.run_until_complete(server.wait_closed())
+        super().tearDown()
+
+    def serve(self, listener):
+        server, = self.loop.run_until_complete(
+            listener.serve(self.loop, RecordingProtocol, 16))
+        self.servers.append(server)
+        self.addCleanup(listener.unlink)
+        return server
+
+    def test_mode_applied_before_listening(self):
+        applied = []
+        chmod = os.chmod
+        def record(path, mode):
+            # Bound with owner only permissions and not accepting yet.
+            probe = socket.socket(socket.AF_UNIX)
+            with probe, self.assertRaises(ConnectionRefusedError):
+                probe.connect(path)
+            applied.append((stat.S_IMODE(os.stat(path).st_mode), mode))
+            chmod(path, mode)
+        with mock.patch('os.chmod', record):
+            self.serve(Listener(path=self.path, mode=0o660))
+        self.assertEqual(applied, [(0o600, 0o660)])
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o660)
+
+    def test_replaces_stale_socket(self):
+        stale = socket.socket(socket.AF_UNIX)
+        stale.bind(self.path)
+        stale.close()
+        self.serve(Listener(path=self.path))
+        _, protocol = self.loop.run_until_complete(
+            self.loop.create_unix_connection(RecordingProtocol, self.path))
+        protocol.transport.close()
+        self.loop.run_until_complete(asyncio.sleep(0))
+
+    def test_keeps_other_files(self):
+        with open(self.path, 'w'):
+            pass
+        self.addCleanup(os.unlink, self.path)
+        with self.assertRaises(OSError):
+            self.loop.run_until_complete(
+                Listener(path=self.path).serve(self.loop, RecordingProtocol,
+                                               16))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,36 @@
+import sys
+import asyncio
+import unittest
+from unittest import mock
+
+from server import __main__ as main
+
+class InstallEventLoopTest(unittest.TestCase):
+
+    def tearDown(self):
+        asyncio.set_event_loop_policy(None)
+
+    def test_asyncio(self):
+        self.assertEqual(main.install_event_loop('asyncio'), 'asyncio')
+        self.assertIs(type(asyncio.get_event_loop_policy()),
+                      asyncio.DefaultEventLoopPolicy)
+
+    def test_uvloop_missing_falls_back(self):
+        # A None entry makes the import fail like a missing package.
+        with mock.patch.dict(sys.modules, {'uvloop': None}), \
+                self.assertLogs(main.logger, 'WARNING'):
+            self.assertEqual(main.install_event_loop('uvloop'), 'asyncio')
+        self.assertIs(type(asyncio.get_event_loop_policy()),
+                      asyncio.DefaultEventLoopPolicy)
+
+    def test_uvloop(self):
+        try:
+            import uvloop
+        except ImportError:
+            self.skipTest('uvloop is not installed')
+        self.assertEqual(main.install_event_loop('uvloop'), 'uvloop')
+        self.assertIsInstance(asyncio.get_event_loop_policy(),
+                              uvloop.EventLoopPolicy)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+import asyncio
+import unittest
+
+from server.mux import (MuxSession, FRAME_HEADER, OPEN, DATA, CLOSE,
+                        MAX_FRAME_PAYLOAD)
+from tests.helpers import FakeTransport, RecordingProtocol, LoopTestCase
+
+WINDOW = 64 * 1024
+
+def frames(data):
+    """Split bytes written by a session into (type, stream id, payload)."""
+    data = bytes(data)
+    parsed = []
+    while data:
+        frame_type, stream_id, length = FRAME_HEADER.unpack_from(data)
+        end = FRAME_HEADER.size + length
+        parsed.append((frame_type, stream_id, data[FRAME_HEADER.size:end]))
+        data = data[end:]
+    return parsed
+
+class WritingProtocol(RecordingProtocol):
+
+    def __init__(self):
+        super().__init__()
+        self.paused = False
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+
+class MuxSessionTest(LoopTestCase, unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.opened = []
+        self.connecting = self.session(initiator=True)
+        self.accepting = self.session(initiator=False, accept=True)
+
+    def session(self, initiator, accept=False, **kwargs):
+        def stream_factory():
+            protocol = WritingProtocol()
+            self.opened.append(protocol)
+            return protocol
+        session = MuxSession(self.loop,
+                             stream_factory if accept else None,
+                             window=WINDOW, initiator=initiator, **kwargs)
+        session.connection_made(FakeTransport(session))
+        return session
+
+    def pump(self):
+        """Hand frames written by each session to the other until quiet."""
+        while (self.connecting.transport.written or
+               self.accepting.transport.written):
+            for source, target in ((self.connecting, self.accepting),
+                                   (self.accepting, self.connecting)):
+                data = bytes(source.transport.written)
+                source.transport.written.clear()
+                if data:
+                    target.data_received(data)
+
+    def test_stream_round_trip(self):
+        client = WritingProtocol()
+        stream = self.connecting.open_stream(client)
+        self.assertEqual(stream.stream_id, 1)
+        stream.write(b'hello')
+        self.pump()
+        server, = self.opened
+        self.assertEqual(bytes(server.received), b'hello')
+        server.transport.write(b'world')
+        server.transport.write_eof()
+        self.pump()
+        self.assertEqual(bytes(client.received), b'world')
+        self.assertTrue(client.eof)
+        stream.close()
+        self.pump()
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.assertTrue(client.lost)
+        self.assertTrue(server.lost)
+        self.assertEqual(self.connecting.streams, {})
+        self.assertEqual(self.accepting.streams, {})
+
+    def test_frames_split_across_reads(self):
+        stream = self.connecting.open_stream(WritingProtocol())
+        stream.write(b'x' * 100)
+        data = bytes(self.connecting.transport.written)
+        for index in range(len(data)):
+            self.accepting.data_received(data[index:index + 1])
+        server, = self.opened
+        self.assertEqual(bytes(server.received), b'x' * 100)
+
+    def test_large_writes_cut_into_frames(self):
+        stream = self.connecting.open_stream(WritingProtocol())
+        stream.write(b'x' * (MAX_FRAME_PAYLOAD * 2 + 1))
+        sizes = [len(payload) for frame_type, _, payload in
+                 frames(self.connecting.transport.written)
+                 if frame_type == DATA]
+        self.assertEqual(sizes, [MAX_FRAME_PAYLOAD, MAX_FRAME_PAYLOAD, 1])
+
+    def test_window_limits_data_in_flight(self):
+        client = WritingProtocol()
+        stream = self.connecting.open_stream(client)
+        self.pump()
+        server, = self.opened
+        server.transport.pause_reading()
+        stream.write(b'x' * (WINDOW * 3))
+        self.assertTrue(client.paused)
+        self.assertEqual(stream.get_write_buffer_size(), WINDOW * 2)
+        self.pump()
+        # A stalled consumer gets no more than a window.
+        self.assertEqual(len(server.received), 0)
+        server.transport.resume_reading()
+        self.pump()
+        self.assertEqual(len(server.received), WINDOW * 3)
+        self.assertEqual(stream.get_write_buffer_size(), 0)
+        self.assertFalse(client.paused)
+
+    def test_window_overrun_resets_stream(self):
+        self.accepting.data_received(FRAME_HEADER.pack(OPEN, 1, 0))
+        self.opened[0].transport.pause_reading()
+        payload = b'x' * MAX_FRAME_PAYLOAD
+        for _ in range(WINDOW // MAX_FRAME_PAYLOAD + 1):
+            self.accepting.data_received(
+                FRAME_HEADER.pack(DATA, 1, len(payload)) + payload)
+        self.assertEqual(self.accepting.streams, {})
+        self.assertIn((CLOSE, 1, b''),
+                      frames(self.accepting.transport.written))
+
+    def test_open_with_own_parity_aborts_session(self):
+        # Even ids are the accepting side's own.
+        self.accepting.data_received(FRAME_HEADER.pack(OPEN, 2, 0))
+        self.assertTrue(self.accepting.transport.aborted)
+        self.assertEqual(self.opened, [])
+
+    def test_reopening_stream_refused(self):
+        self.accepting.data_received(FRAME_HEADER.pack(OPEN, 1, 0) +
+                                     FRAME_HEADER.pack(OPEN, 1, 0))
+        self.assertEqual(len(self.opened), 1)
+        self.assertEqual(frames(self.accepting.transport.written),
+                         [(CLOSE, 1, b'')])
+
+    def test_streams_capped(self):
+        accepting = self.session(initiator=False, accept=True,
+                                 max_streams=2)
+        for stream_id in (1, 3, 5):
+            accepting.data_received(FRAME_HEADER.pack(OPEN, stream_id, 0))
+        self.assertEqual(sorted(accepting.streams), [1, 3])
+        self.assertEqual(frames(accepting.transport.written),
+                         [(CLOSE, 5, b'')])
+
+    def test_session_without_factory_refuses_streams(self):
+        self.connecting.data_received(FRAME_HEADER.pack(OPEN, 2, 0))
+        self.assertEqual(frames(self.connecting.transport.written),
+                         [(CLOSE, 2, b'')])
+
+    def test_session_lost_reaches_streams(self):
+        client = WritingProtocol()
+        self.connecting.open_stream(client)
+        self.connecting.connection_lost(None)
+        self.assertTrue(client.lost)
+        self.assertEqual(self.connecting.streams, {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import socket
+import asyncio
+import unittest
+
+from server.pool import ConnectionPool, parse_destination
+from tests.helpers import LoopTestCase
+
+class Resolver:
+
+    @asyncio.coroutine
+    def resolve(self, host, port):
+        return [(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP, '',
+                 (host, port))]
+
+class ParseDestinationTest(unittest.TestCase):
+
+    def test_parse(self):
+        self.assertEqual(parse_destination('example.com:80'),
+                         ('example.com', 80))
+        self.assertEqual(parse_destination('[::1]:443'), ('::1', 443))
+        for value in ('example.com', ':80', 'example.com:http'):
+            with self.subTest(value=value), self.assertRaises(ValueError):
+                parse_destination(value)
+
+class ConnectionPoolTest(LoopTestCase, unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.accepted = []
+        self.server = self.loop.run_until_complete(
+            asyncio.start_server(self.count, '127.0.0.1', 0))
+        self.dest = self.server.sockets[0].getsockname()[:2]
+        self.pool = ConnectionPool(self.loop, [self.dest], Resolver(),
+                                   size=2, idle_timeout=0.2)
+
+    def tearDown(self):
+        self.pool.close()
+        for writer in self.accepted:
+            writer.close()
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+        super().tearDown()
+
+    def count(self, reader, writer):
+        # Held open, or the pool would find the sockets unhealthy.
+        self.accepted.append(writer)
+
+    def sleep(self, seconds):
+        self.loop.run_until_complete(asyncio.sleep(seconds))
+
+    def test_acquire_replaces_socket(self):
+        self.pool.start()
+        self.sleep(0.05)
+        self.assertEqual(self.pool.stats()['idle'], 2)
+        sock = self.pool.acquire(*self.dest)
+        self.assertIsNotNone(sock)
+        sock.close()
+        self.sleep(0.05)
+        self.assertEqual(self.pool.stats(),
+                         {'hits': 1, 'misses': 0, 'idle': 2})
+        self.assertIsNone(self.pool.acquire('example.com', 80))
+
+    def test_unused_pool_shrinks(self):
+        self.pool.start()
+        self.sleep(0.7)
+        # Not reconnected every idle timeout while nobody asks.
+        self.assertEqual(len(self.accepted), 2)
+        self.assertEqual(self.pool.stats()['idle'], 0)
+        self.assertIsNone(self.pool.acquire(*self.dest))
+        self.sleep(0.05)
+        self.assertEqual(self.pool.stats()['idle'], 2)
+        self.assertEqual(self.pool.misses, 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import socket
+import asyncio
+import unittest
+
+from server.resolver import Resolver, is_ip_address
+from tests.helpers import LoopTestCase
+
+class ResolverTest(LoopTestCase, unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.queries = []
+        self.loop.getaddrinfo = self.getaddrinfo
+
+    @asyncio.coroutine
+    def getaddrinfo(self, host, port, type=0):
+        self.queries.append(host)
+        yield from asyncio.sleep(0)
+        if host.endswith('.invalid'):
+            raise socket.gaierror(socket.EAI_NONAME, 'unknown name')
+        return [(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP, '',
+                 ('192.0.2.1', 0))]
+
+    def resolve(self, resolver, host, port=80):
+        return self.loop.run_until_complete(resolver.resolve(host, port))
+
+    def test_ip_address_not_looked_up(self):
+        resolver = Resolver(self.loop)
+        infos = self.resolve(resolver, '::1', 443)
+        self.assertEqual(infos[0][0], socket.AF_INET6)
+        self.assertEqual(infos[0][4], ('::1', 443))
+        self.assertEqual(self.queries, [])
+        self.assertEqual(is_ip_address('example.com'), None)
+
+    def test_cached_with_port(self):
+        resolver = Resolver(self.loop)
+        self.assertEqual(self.resolve(resolver, 'a.test', 80)[0][4],
+                         ('192.0.2.1', 80))
+        self.assertEqual(self.resolve(resolver, 'a.test', 443)[0][4],
+                         ('192.0.2.1', 443))
+        self.assertEqual(self.queries, ['a.test'])
+        self.assertEqual(resolver.hits, 1)
+
+    def test_concurrent_lookups_coalesced(self):
+        resolver = Resolver(self.loop)
+        self.loop.run_until_complete(asyncio.gather(
+            *[resolver.resolve('a.test', 80) for _ in range(3)]))
+        self.assertEqual(self.queries, ['a.test'])
+        self.assertEqual(resolver.coalesced, 2)
+
+    def test_failure_cached(self):
+        resolver = Resolver(self.loop)
+        for _ in range(2):
+            with self.assertRaises(socket.gaierror):
+                self.resolve(resolver, 'x.invalid')
+        self.assertEqual(self.queries, ['x.invalid'])
+
+    def test_evicts_least_recently_used(self):
+        resolver = Resolver(self.loop, max_entries=2)
+        self.resolve(resolver, 'a.test')
+        self.resolve(resolver, 'b.test')
+        # A hit makes a.test the most recently used.
+        self.resolve(resolver, 'a.test')
+        self.resolve(resolver, 'c.test')
+        self.assertEqual(resolver.stats()['cached'], 2)
+        self.resolve(resolver, 'a.test')
+        self.resolve(resolver, 'b.test')
+        self.assertEqual(self.queries,
+                         ['a.test', 'b.test', 'c.test', 'b.test'])
+
+if __name__ == '__main__':
+    unittest.main()
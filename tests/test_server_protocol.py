@@ -0,0 +1,56 @@
+import unittest
+
+from server import relay, timers
+from server.server_protocol import ServerClientProtocol, ServerRemoteProtocol
+
+class Tunnel:
+    """Records the remote leg events forwarded to it."""
+
+    def __init__(self):
+        self.events = []
+
+    def __getattr__(self, name):
+        return lambda *args: self.events.append((name,) + args) or True
+
+class SlotsTest(unittest.TestCase):
+    """Objects held per tunnel carry no instance __dict__."""
+
+    def assertSlotted(self, cls):
+        for base in cls.__mro__[:-1]:
+            self.assertIn('__slots__', vars(base), base)
+
+    def test_classes(self):
+        for cls in (ServerClientProtocol, ServerRemoteProtocol, timers.Timer,
+                    relay.SpliceRelay, relay._Direction):
+            with self.subTest(cls=cls.__name__):
+                self.assertSlotted(cls)
+
+    def test_instances(self):
+        tunnel = ServerClientProtocol()
+        for instance in (tunnel, ServerRemoteProtocol(tunnel),
+                         timers.Timer(0, print, ())):
+            self.assertFalse(hasattr(instance, '__dict__'), instance)
+        with self.assertRaises(AttributeError):
+            tunnel.remote_host = 'example.com'
+
+class RemoteProtocolTest(unittest.TestCase):
+
+    def test_forwards_to_tunnel(self):
+        tunnel = Tunnel()
+        protocol = ServerRemoteProtocol(tunnel)
+        protocol.connection_made('transport')
+        protocol.data_received(b'data')
+        self.assertTrue(protocol.eof_received())
+        protocol.pause_writing()
+        protocol.resume_writing()
+        protocol.connection_lost(None)
+        self.assertEqual(tunnel.events, [
+            ('remote_connection_made', 'transport'),
+            ('remote_data_received', b'data'),
+            ('remote_eof_received',),
+            ('remote_pause_writing',),
+            ('remote_resume_writing',),
+            ('remote_connection_lost', None)])
+
+if __name__ == '__main__':
+    unittest.main()
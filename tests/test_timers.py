@@ -0,0 +1,137 @@
+import unittest
+
+from server.timers import TimerWheel
+
+class Handle:
+
+    def __init__(self, when, callback):
+        self.when = when
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class ClockLoop:
+    """Loop with a clock moved by hand, running handles as it passes."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.handles = []
+        self.errors = []
+
+    def time(self):
+        return self.now
+
+    def call_at(self, when, callback):
+        handle = Handle(when, callback)
+        self.handles.append(handle)
+        return handle
+
+    def call_exception_handler(self, context):
+        self.errors.append(context)
+
+    def advance(self, seconds):
+        end = self.now + seconds
+        while True:
+            due = [handle for handle in self.handles
+                   if not handle.cancelled and handle.when <= end]
+            if not due:
+                break
+            handle = min(due, key=lambda handle: handle.when)
+            self.handles.remove(handle)
+            self.now = max(self.now, handle.when)
+            handle.callback()
+        self.now = end
+
+class TimerWheelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = ClockLoop()
+        self.wheel = TimerWheel(self.loop, tick=1.0, slot_count=8)
+        self.fired = []
+
+    def fire(self, name):
+        self.fired.append((name, self.loop.now - 1000.0))
+
+    def test_fires_at_most_a_tick_late(self):
+        self.wheel.call_later(2.5, self.fire, 'a')
+        self.wheel.call_later(0.1, self.fire, 'b')
+        self.loop.advance(10)
+        self.assertEqual([name for name, _ in self.fired], ['b', 'a'])
+        for name, delay in (('b', 0.1), ('a', 2.5)):
+            at = dict(self.fired)[name]
+            self.assertGreaterEqual(at, delay)
+            self.assertLessEqual(at, delay + 1.0)
+
+    def test_cancel(self):
+        timer = self.wheel.call_later(3, self.fire, 'a')
+        self.wheel.call_later(3, self.fire, 'b')
+        timer.cancel()
+        self.loop.advance(10)
+        self.assertEqual([name for name, _ in self.fired], ['b'])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_delays_longer_than_the_wheel(self):
+        self.wheel.call_later(20, self.fire, 'late')
+        self.wheel.call_later(4, self.fire, 'early')
+        self.loop.advance(19)
+        self.assertEqual([name for name, _ in self.fired], ['early'])
+        self.loop.advance(2)
+        self.assertEqual([name for name, _ in self.fired], ['early', 'late'])
+
+    def test_stops_turning_while_empty(self):
+        self.wheel.call_later(1, self.fire, 'a')
+        self.loop.advance(5)
+        self.assertEqual(self.loop.handles, [])
+        # Ticks passed while idle are skipped, not fired through.
+        self.loop.advance(100)
+        self.wheel.call_later(2, self.fire, 'b')
+        self.loop.advance(3)
+        self.assertAlmostEqual(dict(self.fired)['b'], 107.0, delta=1.0)
+
+    def test_rearm_from_callback(self):
+        def rearm(count):
+            self.fire(count)
+            if count < 3:
+                self.wheel.call_later(2, rearm, count + 1)
+        self.wheel.call_later(2, rearm, 1)
+        self.loop.advance(20)
+        self.assertEqual([name for name, _ in self.fired], [1, 2, 3])
+
+    def test_late_loop_catches_up(self):
+        for delay in range(1, 6):
+            self.wheel.call_later(delay, self.fire, delay)
+        # A busy loop runs the wheel's handle late, once.
+        handle, = self.loop.handles
+        self.loop.now += 4.5
+        self.loop.handles.remove(handle)
+        handle.callback()
+        self.assertEqual([name for name, _ in self.fired], [1, 2, 3, 4])
+
+    def test_failing_callback(self):
+        def fail():
+            raise RuntimeError('boom')
+        self.wheel.call_later(1, self.fire, 'before')
+        self.wheel.call_later(1, fail)
+        self.wheel.call_later(1, self.fire, 'same tick')
+        self.wheel.call_later(3, self.fire, 'later')
+        self.loop.advance(10)
+        self.assertEqual([name for name, _ in self.fired],
+                         ['before', 'same tick', 'later'])
+        error, = self.loop.errors
+        self.assertIsInstance(error['exception'], RuntimeError)
+        # The wheel is re-armed by timers scheduled afterwards.
+        self.wheel.call_later(1, self.fire, 'next')
+        self.loop.advance(3)
+        self.assertEqual(self.fired[-1][0], 'next')
+
+    def test_close(self):
+        self.wheel.call_later(1, self.fire, 'a')
+        self.wheel.close()
+        self.loop.advance(5)
+        self.assertEqual(self.fired, [])
+        self.assertEqual(len(self.wheel), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import socket
+import asyncio
+import unittest
+
+from server.handshake import pack_address
+from server.resolver import is_ip_address
+from server.udp_relay import UdpAssociation, _RemoteEndpoint
+from tests.helpers import LoopTestCase
+
+CLIENT = ('127.0.0.1', 40000)
+
+def datagram(host, port, payload):
+    if is_ip_address(host) is not None:
+        address = pack_address(host, port)
+    else:
+        name = host.encode()
+        address = bytes([3, len(name)]) + name + port.to_bytes(2, 'big')
+    return b'\x00\x00\x00' + address + payload
+
+class DatagramTransport:
+
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data, addr):
+        self.sent.append((bytes(data), addr))
+
+    def close(self):
+        pass
+
+class Resolver:
+
+    def __init__(self, results):
+        self.results = results
+
+    @asyncio.coroutine
+    def resolve(self, host, port):
+        result = self.results.pop(0)
+        if isinstance(result, BaseException):
+            raise result
+        return [(socket.AF_INET, socket.SOCK_DGRAM, 0, '', (result, port))]
+
+class UdpAssociationTest(LoopTestCase, unittest.TestCase):
+
+    def association(self, results=()):
+        association = UdpAssociation(self.loop, CLIENT[0],
+                                     Resolver(list(results)), timers=None)
+        # IPv4 only, like a host without IPv6.
+        endpoint = _RemoteEndpoint(association)
+        endpoint.connection_made(DatagramTransport())
+        association._remotes[socket.AF_INET] = endpoint
+        return association, endpoint.transport
+
+    def settle(self):
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.loop.run_until_complete(asyncio.sleep(0))
+
+    def test_relays_to_ip_address(self):
+        association, transport = self.association()
+        association.client_datagram_received(
+            datagram('10.0.0.1', 53, b'query'), CLIENT)
+        self.assertEqual(transport.sent, [(b'query', ('10.0.0.1', 53))])
+
+    def test_family_without_socket_is_dropped(self):
+        association, transport = self.association()
+        association.client_datagram_received(
+            datagram('2001:db8::1', 53, b'query'), CLIENT)
+        self.assertEqual(transport.sent, [])
+        self.assertEqual(association.dropped, 1)
+
+    def test_fragments_and_strangers_are_dropped(self):
+        association, transport = self.association()
+        association.client_datagram_received(
+            b'\x00\x00\x01' + pack_address('10.0.0.1', 53) + b'x', CLIENT)
+        association.client_datagram_received(
+            datagram('10.0.0.1', 53, b'x'), ('127.0.0.2', 40000))
+        self.assertEqual(transport.sent, [])
+        self.assertEqual(association.dropped, 2)
+
+    def test_held_while_resolving(self):
+        association, transport = self.association(['10.0.0.2'])
+        for payload in (b'one', b'two'):
+            association.client_datagram_received(
+                datagram('example.com', 53, payload), CLIENT)
+        self.settle()
+        self.assertEqual(transport.sent, [(b'one', ('10.0.0.2', 53)),
+                                          (b'two', ('10.0.0.2', 53))])
+
+    def test_failed_resolution_is_not_held_forever(self):
+        association, transport = self.association(
+            [asyncio.TimeoutError(), '10.0.0.2'])
+        association.client_datagram_received(
+            datagram('example.com', 53, b'lost'), CLIENT)
+        self.settle()
+        self.assertEqual(association._resolving, {})
+        association.client_datagram_received(
+            datagram('example.com', 53, b'retried'), CLIENT)
+        self.settle()
+        self.assertEqual(transport.sent, [(b'retried', ('10.0.0.2', 53))])
+
+if __name__ == '__main__':
+    unittest.main()
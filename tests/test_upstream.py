@@ -0,0 +1,133 @@
+import asyncio
+import unittest
+
+from networking import ConnectionStatus as Status
+from exception import ConnectToRemoteError
+from server.handshake import pack_address
+from server.mux import FRAME_HEADER, DATA
+from server.upstream import (UpstreamHandshake, Upstream, _UpstreamSession,
+                             parse_upstream)
+from tests.helpers import FakeTransport, RecordingProtocol, LoopTestCase
+
+SELECTED = b'\x05\x00'
+REPLY = b'\x05\x00\x00' + pack_address('10.0.0.1', 1080)
+BANNER = b'SSH-2.0-OpenSSH_9.6\r\n'
+
+def data_frame(stream_id, payload):
+    return FRAME_HEADER.pack(DATA, stream_id, len(payload)) + payload
+
+class ParseUpstreamTest(unittest.TestCase):
+
+    def test_without_credentials(self):
+        self.assertEqual(parse_upstream('proxy:1080'),
+                         ('proxy', 1080, None, None))
+
+    def test_with_credentials(self):
+        self.assertEqual(parse_upstream('bob:secret@proxy:1080'),
+                         ('proxy', 1080, 'bob', 'secret'))
+        self.assertEqual(parse_upstream('bob:p@ss@[::1]:1080'),
+                         ('::1', 1080, 'bob', 'p@ss'))
+
+    def test_credentials_need_password(self):
+        with self.assertRaises(ValueError):
+            parse_upstream('bob@proxy:1080')
+
+class UpstreamHandshakeTest(LoopTestCase, unittest.TestCase):
+
+    def handshake(self, **kwargs):
+        handshake = UpstreamHandshake('example.com', 22, **kwargs)
+        transport = FakeTransport(handshake)
+        handshake.connection_made(transport)
+        return handshake, transport
+
+    def test_sends_request_after_selection(self):
+        handshake, transport = self.handshake()
+        self.assertEqual(bytes(transport.written), b'\x05\x01\x00')
+        handshake.data_received(SELECTED)
+        self.assertTrue(transport.written.endswith(handshake.request))
+        handshake.data_received(REPLY)
+        self.assertTrue(handshake.done.done())
+
+    def test_pipelined_with_credentials(self):
+        handshake, transport = self.handshake(username='bob',
+                                              password='secret',
+                                              pipeline=True)
+        self.assertEqual(bytes(transport.written),
+                         b'\x05\x01\x02\x01\x03bob\x06secret' +
+                         handshake.request)
+        handshake.data_received(b'\x05\x02\x01\x00' + REPLY)
+        self.assertTrue(handshake.done.done())
+
+    def test_reply_and_data_in_one_read(self):
+        handshake, transport = self.handshake()
+        handshake.data_received(SELECTED + REPLY + BANNER[:8])
+        # More arrives before the tunnel's protocol takes over.
+        handshake.data_received(BANNER[8:])
+        self.loop.run_until_complete(handshake.done)
+        protocol = RecordingProtocol()
+        handshake.hand_over(protocol)
+        self.assertIs(transport.protocol, protocol)
+        self.assertIs(protocol.transport, transport)
+        self.assertEqual(bytes(protocol.received), BANNER)
+
+    def test_eof_and_loss_before_hand_over(self):
+        handshake, transport = self.handshake()
+        handshake.data_received(SELECTED + REPLY + BANNER)
+        self.assertTrue(handshake.eof_received())
+        handshake.connection_lost(None)
+        protocol = RecordingProtocol(keep_open=False)
+        handshake.hand_over(protocol)
+        self.assertEqual(bytes(protocol.received), BANNER)
+        self.assertTrue(protocol.eof)
+        self.assertTrue(transport.closed)
+        self.assertTrue(protocol.lost)
+
+    def test_failure_status(self):
+        handshake, transport = self.handshake()
+        handshake.data_received(SELECTED + b'\x05\x05\x00' +
+                                pack_address('0.0.0.0', 0))
+        with self.assertRaises(ConnectToRemoteError) as raised:
+            self.loop.run_until_complete(handshake.done)
+        self.assertEqual(raised.exception.args[0],
+                         Status.CONN_REFUSED)
+        self.assertTrue(transport.closed)
+
+    def test_refused_method(self):
+        handshake, transport = self.handshake(username='bob',
+                                              password='secret')
+        handshake.data_received(b'\x05\xff')
+        with self.assertRaises(ConnectToRemoteError):
+            self.loop.run_until_complete(handshake.done)
+
+    def test_eof_before_reply(self):
+        handshake, transport = self.handshake()
+        handshake.data_received(SELECTED)
+        self.assertFalse(handshake.eof_received())
+        with self.assertRaises(ConnectToRemoteError):
+            self.loop.run_until_complete(handshake.done)
+
+class UpstreamMuxTest(LoopTestCase, unittest.TestCase):
+
+    def test_server_first_banner_survives(self):
+        session = _UpstreamSession(self.loop)
+        session_transport = FakeTransport(session)
+        session.connection_made(session_transport)
+        session.data_received(b'\x05\x81')
+        upstream = Upstream(self.loop, 'upstream', 1080, resolver=None,
+                            mux_connections=1)
+        upstream._sessions.append(session)
+        connecting = self.loop.create_task(
+            upstream.connect('example.com', 22, RecordingProtocol))
+        while not session.streams:
+            self.loop.run_until_complete(asyncio.sleep(0))
+        stream_id, = session.streams
+        # The reply and the banner held by the upstream node arrive as
+        # two frames in one read.
+        session.data_received(data_frame(stream_id, SELECTED + REPLY) +
+                              data_frame(stream_id, BANNER))
+        transport, protocol = self.loop.run_until_complete(connecting)
+        self.assertEqual(bytes(protocol.received), BANNER)
+        self.assertEqual(upstream.tunnels, 1)
+
+if __name__ == '__main__':
+    unittest.main()